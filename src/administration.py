@@ -7,7 +7,11 @@ import simplejson as json
 
 from . import database as db
 from . import config
+from . import metrics
+from . import perf
+from . import profiling
 from . import security
+from . import utils
 import git
 import os
 import sys
@@ -16,6 +20,10 @@ import io
 class Administration(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
+        # Intents.all() caches every member, user and recent message, these show up with /debug memory
+        profiling.watch("discord members cached", lambda: sum(len(guild.members) for guild in bot.guilds))
+        profiling.watch("discord users cached", lambda: len(bot.users))
+        profiling.watch("discord messages cached", lambda: len(bot.cached_messages))
 
     @slash_command(name='git', description='Get currently running git information.')
     async def git(self, ctx: discord.ApplicationContext):
@@ -61,6 +69,113 @@ class Administration(commands.Cog):
             return
 
 
+    debug = discord.SlashCommandGroup("debug", "Bot internals, for sudoers.")
+
+    @debug.command(name='metrics', description='Show the bot\'s metrics.')
+    @option(name='filter', description='Only show metrics containing this.', type=str, required=False)
+    async def debug_metrics(self, ctx: discord.ApplicationContext, filter: str = None):
+        if not security.is_sudoer(ctx.author):
+            return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+
+        text = metrics.render()
+        lines = [line for line in text.splitlines() if not line.startswith("#") and (not filter or filter in line)]
+        # buckets are for scrapers, the summary only shows counts and sums
+        summary = [line for line in lines if "_bucket{" not in line]
+        shown = "\n".join(summary)
+        if len(shown) > 3900:
+            shown = shown[:3900].rsplit("\n", 1)[0] + "\n..."
+        embed = discord.Embed(title="Metrics", description=f"```\n{shown or 'Nothing matched.'}\n```")
+        embed.set_footer(text=f"{len(lines)} series, the attached file has all of them")
+        await ctx.respond(embed=embed, file=discord.File(io.BytesIO(text.encode()), filename="metrics.txt"), ephemeral=True)
+
+    @debug.command(name='perf', description='Show command latency percentiles.')
+    async def debug_perf(self, ctx: discord.ApplicationContext):
+        if not security.is_sudoer(ctx.author):
+            return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+
+        entries = perf.report()
+        if not entries:
+            return await ctx.respond("No commands have run yet.", ephemeral=True)
+
+        def ms(seconds):
+            return f"{round(seconds * 1000)}ms" if seconds is not None else "-"
+
+        embed = discord.Embed(title="Command Latency", description=f"Last {perf.WINDOW} runs per command, slowest first. ⚠️ is within {int(perf.WARN_AT * 100)}% of the {perf.DEADLINE:g}s interaction deadline.")
+        for entry in entries[:25]:
+            embed.add_field(
+                name=f"{'⚠️ ' if entry['at_risk'] else ''}/{entry['command']} ({entry['count']})",
+                value=f"p50 {ms(entry['p50'])} · p95 {ms(entry['p95'])} · p99 {ms(entry['p99'])}\nfirst response p95 {ms(entry['first_response_p95'])} · db {ms(entry['db_avg'])} · discord {ms(entry['http_avg'])} avg",
+                inline=False
+            )
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @debug.command(name='profile', description='Sample what the bot is doing for a while.')
+    @option(name='seconds', description='How long to sample for.', type=int, required=False, default=30, min_value=1, max_value=300)
+    @option(name='top', description='How many functions to show.', type=int, required=False, default=10, min_value=1, max_value=25)
+    async def debug_profile(self, ctx: discord.ApplicationContext, seconds: int = 30, top: int = 10):
+        if not security.is_sudoer(ctx.author):
+            return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+        if profiling.SESSION_LOCK.locked():
+            return await ctx.respond("A profile is already running, wait for it to finish.", ephemeral=True)
+
+        await ctx.defer(ephemeral=True)
+        try:
+            profile = await profiling.profileCPU(seconds)
+        except profiling.ProfileBusy:
+            return await ctx.followup.send("A profile is already running, wait for it to finish.", ephemeral=True)
+
+        lines = [f"{own / max(profile.samples, 1):>6.1%} {total / max(profile.samples, 1):>6.1%}  {name}" for name, own, total in profile.topFunctions(top)]
+        shown = "\n".join(lines)
+        if len(shown) > 3800:
+            shown = shown[:3800].rsplit("\n", 1)[0] + "\n..."
+        embed = discord.Embed(title="CPU Profile", description=f"```\n   own  total  function\n{shown or 'No samples.'}\n```")
+        embed.set_footer(text=f"{profile.samples} samples over {seconds}s, {round(profile.idle / max(profile.samples, 1) * 100, 1)}% idle · {profile.path}")
+        await ctx.followup.send(embed=embed, files=[
+            discord.File(io.BytesIO(profile.report().encode()), filename="profile.txt"),
+            discord.File(io.BytesIO(profile.collapsed().encode()), filename="profile.collapsed"),
+        ], ephemeral=True)
+
+    @debug.command(name='memory', description='Trace allocations and diff memory snapshots.')
+    @option(name='action', description='Start tracing, take a snapshot, or stop tracing.', type=str, required=False, default="snapshot", choices=["start", "snapshot", "stop"])
+    @option(name='top', description='How many lines to show per section.', type=int, required=False, default=8, min_value=1, max_value=25)
+    @option(name='dump', description='Also write the report and raw snapshot to logs/profiles/.', type=bool, required=False, default=False)
+    async def debug_memory(self, ctx: discord.ApplicationContext, action: str = "snapshot", top: int = 8, dump: bool = False):
+        if not security.is_sudoer(ctx.author):
+            return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+
+        if action == "stop":
+            if not profiling.isTracing():
+                return await ctx.respond("Allocations aren't being traced.", ephemeral=True)
+            profiling.stopTracing()
+            return await ctx.respond("Stopped tracing allocations, snapshots were dropped.", ephemeral=True)
+
+        await ctx.defer(ephemeral=True)
+        try:
+            if action == "start":
+                await profiling.startTracing()
+            else:
+                await profiling.takeSnapshot()
+        except profiling.ProfileBusy:
+            return await ctx.followup.send("A memory snapshot is already being taken, wait for it to finish.", ephemeral=True)
+
+        embed = discord.Embed(title="Memory", description="Tracing started, this is the baseline." if action == "start" else None)
+        for title, section in profiling.memoryReport(top).items():
+            value = "\n".join(section) or "nothing"
+            if len(value) > 900:  # six of these have to fit in one embed
+                value = value[:900].rsplit("\n", 1)[0] + "\n..."
+            embed.add_field(name=title, value=f"```\n{value}\n```", inline=False)
+        footer = f"{len(profiling.SNAPSHOTS)} snapshots kept" if profiling.isTracing() else "Allocation tracing is off, /debug memory start turns it on"
+        if dump:
+            path = await utils.inThread(profiling.dumpSnapshot)
+            footer += f" · {path}"
+        embed.set_footer(text=footer)
+        await ctx.followup.send(embed=embed, file=discord.File(io.BytesIO(profiling.memoryReportText().encode()), filename="memory.txt"), ephemeral=True)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        await metrics.serve()
+        profiling.startWatchdog()
+
     @commands.Cog.listener()
     async def on_message(self, message):
         return
@@ -1,5 +1,6 @@
 from openai import AsyncOpenAI
 from . import config
+from . import metrics
 from typing import List
 import discord
 import asyncio
@@ -12,19 +13,24 @@ aclient = AsyncOpenAI(api_key=config.C["openai"]["key"])
 
 max_errors = 6 # 1 and a half minutes
 
+async def timed_completion(model: str, messages: List[dict]):
+    try:
+        with metrics.OPENAI_SECONDS.time(model=model):
+            return await aclient.chat.completions.create(model=model, messages=messages)
+    except Exception:
+        metrics.OPENAI_ERRORS.inc(model=model)
+        raise
+
 async def make_chatgpt_request(messages: List[dict]):
-    res = await aclient.chat.completions.create(model="gpt-3.5-turbo",
-    messages=messages)
+    res = await timed_completion("gpt-3.5-turbo", messages)
     return res.choices[0].message
 
 async def make_vetting_chatgpt_request(messages: List[dict]):
-    res = await aclient.chat.completions.create(model=config.C["openai"]["vettingmodel"],
-    messages=messages)
+    res = await timed_completion(config.C["openai"]["vettingmodel"], messages)
     return res.choices[0].message
 
 async def make_chatgpt4_request(messages: List[dict]):
-    res = await aclient.chat.completions.create(model="gpt-4",
-    messages=messages)
+    res = await timed_completion("gpt-4", messages)
     return res["choices"][0]["message"]
 
 def build_verification_embed(user, messages, verdict):
@@ -139,7 +145,8 @@ class VettingInterviewer:
             try:
                 message = await ctx.bot.wait_for("message", check=lambda m: m.author == user and not m.guild, timeout=60*20)  # 20 minutes to answer
                 self.messages.append({"role": "user", "content": message.clean_content})
-                log("aivetting", "readmessage", f"{lid(self)} Read message from {log_user(user)}: {message.clean_content}")
+                log("aivetting", "readmessage", f"{lid(self)} Read message from {log_user(user)} ({len(message.clean_content)} characters)")
+                log("aivetting", "readmessagefull", lambda: f"{lid(self)} Read message from {log_user(user)}: {message.clean_content}", level="debug")
             except asyncio.TimeoutError:
                 log("aivetting", "timeout", f"User {log_user(user)} timed out.")
                 await user.send("SYSTEM: You have timed out (20 minutes). Please try again later.")
@@ -187,6 +194,7 @@ class BetaVettingInterviewer(VettingInterviewer):
                 return {"role": "assistant", "content": content}
             else:
                 log("aivetting", "openaierror", f"Error {lid(e)} {self.errors_in_a_row}/{max_errors} in OpenAI request: {e} for interviewer {id(self)}. Retrying in 15 seconds.")
+                metrics.OPENAI_RETRIES.inc()
                 await asyncio.sleep(15)
                 log("aivetting", "openaierror", f"Error {lid(e)} retrying now.")
                 return await self.openai_request(messages)
@@ -215,5 +223,5 @@ class BetaVettingInterviewer(VettingInterviewer):
                 return await self.generate_response()
 
         self.messages.append({"role": "assistant", "content": response})
-        log("aivetting", "betaairesponse", f"Beta AI {lid(self)} Generated response: {response}")
+        log("aivetting", "betaairesponse", lambda: f"Beta AI {lid(self)} Generated response: {response}", level="debug")
         return response
@@ -0,0 +1,163 @@
+import bisect
+import re
+import time
+from typing import *
+
+from . import metrics
+
+"""
+Autocomplete for slash command options.
+Discord asks for options on every keystroke, so instead of formatting every case / piece of evidence / warrant each time,
+each kind of thing has a PrefixIndex that gets updated as things are added and removed.
+Every word of an option is indexed, typing the start of any of them finds it. Results are capped at discord's 25, and a
+search stops early once it goes over its latency budget (the stats say how often that happens).
+Options can be put under scopes (like the case a piece of evidence belongs to) so a per-user lookup only walks their part
+of the index, and a predicate can filter on the thing itself for anything that changes too often to index.
+"""
+
+MAX_RESULTS = 25
+MAX_LABEL = 100  # discord's limit on choice names and values
+
+def optionLabel(text: str, id: str) -> str:
+    # "text: id", commands parse the id back out with split(" ")[-1] so the text is what gets cut if it's too long
+    suffix = f": {id}"
+    text = str(text)
+    if len(text) + len(suffix) > MAX_LABEL:
+        text = text[:MAX_LABEL - len(suffix) - 1] + "…"
+    return text + suffix
+
+WORD_SEPARATORS = re.compile(r"[\s:,./_()\[\]-]+")
+
+def terms(*texts) -> Set[str]:
+    # every word of every text, and the whole texts themselves
+    out = set()
+    for text in texts:
+        if text is None:
+            continue
+        text = str(text).lower()
+        out.add(text)
+        out.update(WORD_SEPARATORS.split(text))
+    out.discard("")
+    return out
+
+class PrefixIndex:
+    def __init__(self, name: str, budget_ms: float = 25):
+        self.name = name
+        self.budget = budget_ms / 1000
+        self.options: Dict[str, dict] = {}  # key -> label, terms, rank, scopes, value
+        self.by_term: Dict[Any, List[Tuple[str, str]]] = {None: []}  # scope -> sorted (term, key), None is everything
+        self.by_rank: Dict[Any, List[Tuple[float, str]]] = {None: []}  # scope -> sorted (-rank, key), for empty searches
+        self.stats = {"calls": 0, "total_ms": 0.0, "max_ms": 0.0, "over_budget": 0}
+
+    def __len__(self):
+        return len(self.options)
+
+    def clear(self):
+        self.options.clear()
+        self.by_term = {None: []}
+        self.by_rank = {None: []}
+
+    def add(self, key: str, label: str, search_terms: Iterable[str], rank: float = 0, scopes: Iterable = (), value = None):
+        # adding something that's already there replaces it
+        if key in self.options:
+            self.remove(key)
+        option = {"label": label, "terms": set(search_terms), "rank": rank, "scopes": list(scopes), "value": value}
+        self.options[key] = option
+        for scope in [None, *option["scopes"]]:
+            by_term = self.by_term.setdefault(scope, [])
+            for term in option["terms"]:
+                bisect.insort(by_term, (term, key))
+            bisect.insort(self.by_rank.setdefault(scope, []), (-rank, key))
+
+    def remove(self, key: str):
+        option = self.options.pop(key, None)
+        if option is None:
+            return
+        for scope in [None, *option["scopes"]]:
+            by_term = self.by_term.get(scope, [])
+            for term in option["terms"]:
+                _discard(by_term, (term, key))
+            _discard(self.by_rank.get(scope, []), (-option["rank"], key))
+            if scope is not None and not self.by_rank.get(scope):
+                self.by_term.pop(scope, None)
+                self.by_rank.pop(scope, None)
+
+    def search(self, query: str, scope = None, predicate: Callable[[Any], bool] = None) -> List[str]:
+        t = time.perf_counter()
+        deadline = t + self.budget
+        words = [word for word in WORD_SEPARATORS.split((query or "").lower()) if word]
+        by_term = self.by_term.get(scope, [])
+        by_rank = self.by_rank.get(scope, [])
+
+        def accept(key, check):
+            option = self.options[key]
+            if any(not any(term.startswith(word) for term in option["terms"]) for word in check):
+                return False
+            return predicate is None or predicate(option["value"])
+
+        def overBudget(i):
+            if i % 64 == 63 and time.perf_counter() > deadline:
+                self.stats["over_budget"] += 1
+                return True
+            return False
+
+        # the word that matches the fewest terms narrows things down the most
+        ranges = {word: _prefixRange(by_term, word) for word in words}
+        narrowest = min(ranges, key=lambda word: ranges[word][1] - ranges[word][0]) if words else None
+
+        found = []
+        if narrowest is None or ranges[narrowest][1] - ranges[narrowest][0] > len(by_rank) // 4:
+            # nothing typed yet, or so much matches that going down the ranking finds 25 sooner
+            for i, (_, key) in enumerate(by_rank):
+                if accept(key, words):
+                    found.append(key)
+                    if len(found) >= MAX_RESULTS:
+                        break
+                if overBudget(i):
+                    break
+        else:
+            # everything the narrowest word matches, the rest of the words are checked per option
+            others = [word for word in words if word != narrowest]
+            seen = set()
+            for i in range(*ranges[narrowest]):
+                key = by_term[i][1]
+                if key not in seen:
+                    seen.add(key)
+                    if accept(key, others):
+                        found.append(key)
+                if overBudget(i):
+                    break
+            found.sort(key=lambda key: -self.options[key]["rank"])
+            found = found[:MAX_RESULTS]
+
+        elapsed = (time.perf_counter() - t) * 1000
+        self.stats["calls"] += 1
+        self.stats["total_ms"] += elapsed
+        self.stats["max_ms"] = max(self.stats["max_ms"], elapsed)
+        return [self.options[key]["label"] for key in found]
+
+def _prefixRange(sorted_terms: list, prefix: str):
+    # start and end of the (term, key) entries whose term starts with prefix
+    return bisect.bisect_left(sorted_terms, (prefix,)), bisect.bisect_left(sorted_terms, (prefix + chr(0x10FFFF),))
+
+def _discard(sorted_list: list, item):
+    i = bisect.bisect_left(sorted_list, item)
+    if i < len(sorted_list) and sorted_list[i] == item:
+        del sorted_list[i]
+
+CASES = PrefixIndex("cases")
+EVIDENCE = PrefixIndex("evidence")
+WARRANTS = PrefixIndex("warrants")
+
+INDEXES = [CASES, EVIDENCE, WARRANTS]
+
+def autocompleteStats():
+    return {
+        index.name: {
+            **index.stats,
+            "options": len(index),
+            "avg_ms": round(index.stats["total_ms"] / index.stats["calls"], 4) if index.stats["calls"] else None
+        } for index in INDEXES
+    }
+
+metrics.collect("autocomplete", autocompleteStats)
@@ -2,4 +2,5 @@ from .casemanager import *
 from .evidence import *
 from .penalties import *
 from .motion import *
+from .reconciler import *
 from . import penaltywriter
\ No newline at end of file
@@ -4,17 +4,21 @@ import asyncio
 import datetime
 import io
 import random
+import re
 import time
 import zipfile
 from typing import *
 
+import bson
 import discord
 import simplejson as json
 from discord import Embed
 
-from .. import config
+from .. import autocomplete, config
 from .. import database as db
-from .. import utils, warden
+from .. import metrics
+from .. import profiling
+from .. import gridfs, utils, warden
 from ..stasilogging import *
 from . import evidence
 from .motion import *
@@ -32,6 +36,7 @@ Court cases are basically just a collection of metadata, a list of motions, and
 They are designed to allow for more public participation in server moderation, and to get "public" interest up.
 
 Cases are stored in a database, and are loaded into memory when the bot starts up.
+With lazy_case_loading only a summary of each case is loaded at startup, and the rest is pulled in by Case.hydrate().
 Cases are also saved to the database when they are updated, and when the bot shuts down.
 Cases are not saved to the database when they are closed, as they are archived and removed from memory.
 When this happens, they are saved to a zip file and sent to relevant discord channels. 
@@ -100,6 +105,13 @@ When ran by the defense, allows them to accept or decline a plea deal.
 
 ACTIVECASES: List[Case] = []
 
+metrics.gauge("active_cases", "Cases loaded in ACTIVECASES.", fn=lambda: len(ACTIVECASES))
+profiling.watch("casemanager.ACTIVECASES", lambda: len(ACTIVECASES))
+profiling.watch("casemanager.ACTIVECASES events", lambda: sum(len(getattr(case, "event_log", None) or ()) for case in ACTIVECASES))
+CASE_SAVE_SECONDS = metrics.histogram("case_save_seconds", "Case.Save latency.")
+CASE_SAVE_BYTES = metrics.histogram("case_save_bytes", "BSON size of the document Case.Save writes.", buckets=metrics.SIZE_BUCKETS)
+CASE_TICK_SECONDS = metrics.histogram("case_tick_seconds", "Case.Tick latency in the case manager loop.")
+
 JURY_SIZE = 5
 FIRE_UNREACHABLE_JURORS = True
 
@@ -114,18 +126,74 @@ def getCaseByID(case_id: str) -> Case:
 
     return None
 
+async def fetchCaseByID(case_id: str) -> Case:
+    # same as getCaseByID, but makes sure the full case document is loaded before handing it back
+    case = getCaseByID(case_id)
+    if case is None:
+        return None
+    return await case.hydrate()
+
+# when lazy loading is on, only these fields are pulled at startup, the rest of the document is
+# loaded by Case.hydrate() the first time a command or the case manager actually needs it
+SUMMARY_PROJECTION = {
+    "_id": True,
+    "title": True,
+    "status": True,
+    "stage": True,
+    "no_tick": True,
+    "prosecutor_id": True,
+    "defense_id": True,
+    "jury_pool_ids": True,
+    "jury_invites": True,
+    "plea_deal_expiration": True,
+    "closed": True,
+    "motion_queue.expiry": True,
+    "evidence.id": True,
+    "evidence.filename": True,
+    "evidence.created": True,
+}
+
+def lazyLoadingEnabled() -> bool:
+    return config.C.get("lazy_case_loading", True)
+
+# case id -> in-flight hydration task, so concurrent hydrate() calls for the same case share one query
+HYDRATING: Dict[str, asyncio.Task] = {}
+
 async def populateActiveCases(bot, guild: discord.Guild) -> List[Case]:
     t = time.time()
-    log("Case", "populateActiveCases", f"Populating active cases for guild {guild.id} ({guild.name})")
+    lazy = lazyLoadingEnabled()
+    log("Case", "populateActiveCases", f"Populating active cases for guild {guild.id} ({guild.name}) (lazy: {lazy})")
     db_ = await db.create_connection("cases")
-    cases = await db_.find().to_list(None)
+    if lazy:
+        cases = await db_.find({}, SUMMARY_PROJECTION).to_list(None)
+    else:
+        cases = await db_.find().to_list(None)
     for case in cases:
         new_case = Case(bot, guild)
-        new_case.loadFromDict(case)
+        if lazy:
+            new_case.loadSummary(case)
+        else:
+            new_case.loadFromDict(case)
         ACTIVECASES.append(new_case)
-    log("Case", "populateActiveCases", f"Populated {len(ACTIVECASES)} active cases for guild {guild.id} ({guild.name}) in {round(time.time() - t, 5)} seconds")
+        indexCase(new_case)
+    log("Case", "populateActiveCases", f"Populated {len(ACTIVECASES)} active cases for guild {guild.id} ({guild.name}) in {round(time.time() - t, 5)} seconds (lazy: {lazy})")
     return ACTIVECASES
 
+def indexCase(case: Case):
+    # keeps the autocomplete indexes up to date, the case and all of its evidence
+    autocomplete.CASES.add(case.id, autocomplete.optionLabel(case, case.id), autocomplete.terms(case.id, case.title), value=case)
+    for e in case.evidenceSummary():
+        indexEvidence(case, e)
+
+def indexEvidence(case: Case, e: dict):
+    created = e["created"].timestamp() if e.get("created") else 0
+    autocomplete.EVIDENCE.add(e["id"], autocomplete.optionLabel(e["filename"], e["id"]), autocomplete.terms(e["id"], e["filename"]), created, scopes=[case.id])
+
+def unindexCase(case: Case):
+    autocomplete.CASES.remove(case.id)
+    for e in case.evidenceSummary():
+        autocomplete.EVIDENCE.remove(e["id"])
+
 def memberIsJuror(member: discord.Member) -> bool:
     member = member if isinstance(member, int) else member.id  # we don't actually care about the member object, just the id
     for case in ACTIVECASES:
@@ -213,7 +281,9 @@ class Case:
         
         await self.Announce(None, embed=eventToEmbed(event, f"{self} ({self.id})"), jurors=True, defense=True, prosecution=True, news_wire=True)
 
-        log("CaseEventLog", "newEvent", f"New event {self} ({self.id}): {event}", False)
+        # the whole event is only dumped at debug, the name is enough otherwise
+        log("CaseEventLog", "newEvent", f"New event {self} ({self.id}): {event_id} {name}", False, case=self.id, event_id=event_id)
+        log("CaseEventLog", "newEventFull", lambda: f"New event {self} ({self.id}): {event}", False, level="debug", case=self.id)
 
         return event
     
@@ -341,6 +411,7 @@ class Case:
     async def closeCase(self, reason: str = None):
         self.no_tick = True 
         self.stage = 3
+        self.closed = datetime.datetime.now(datetime.timezone.utc)
         self.motion_queue = []
         self.motion_in_consideration = None
 
@@ -363,12 +434,46 @@ class Case:
 
         await self.sendZipArchive()
 
+        await self.Save()  # so the archiver picks it up even if the bot restarts before then
         
         log("Case", "CLOSE", f"{self} ({self.id}): {status}")
         return
 
+    async def Archive(self):
+        # moves a closed case out of the cases collection and out of memory
+        # the final zips are rendered once and kept in gridfs so dumping an archived case doesn't rebuild them
+        if self.stage != 3 or self.archived:
+            return False
+
+        t = time.time()
+        log("Case", "Archive", f"Archiving case {self} ({self.id})")
+
+        zip_file = await self.Zip()
+        zip_admin = await self.Zip(admin=True)
+
+        archive = self.toDict()
+        archive["archived"] = datetime.datetime.now(datetime.timezone.utc)
+        archive["archive_zip_id"] = await gridfs.update_file(f"{self.id}.zip", zip_file, case=self.id, admin=False)
+        archive["archive_zip_admin_id"] = await gridfs.update_file(f"{self.id} (Admin).zip", zip_admin, case=self.id, admin=True)
+
+        archived_ = await db.create_connection("archived_cases")
+        await archived_.update_one({"_id": self.id}, {"$set": archive}, upsert=True)
+
+        cases_ = await db.create_connection("cases")
+        await cases_.delete_one({"_id": self.id})
+
+        self.archived = True
+        if self in ACTIVECASES:
+            ACTIVECASES.remove(self)
+        unindexCase(self)
+
+        log("Case", "Archive", f"Archived case {self} ({self.id}) in {round(time.time() - t, 5)} seconds")
+        return True
+
     async def deleteCase(self):
-        ACTIVECASES.remove(self)
+        if self in ACTIVECASES:
+            ACTIVECASES.remove(self)
+        unindexCase(self)
         for evidence in self.evidence:
             await evidence.delete()
         db_ = await db.create_connection("cases")
@@ -786,6 +891,12 @@ class Case:
                 return motion
         return None
     
+    def evidenceSummary(self) -> List[dict]:
+        # id, filename and created for every piece of evidence, works whether or not the case is hydrated
+        if self.hydrated:
+            return [{"id": e.id, "filename": e.filename, "created": e.created} for e in self.evidence]
+        return self.evidence_summary
+
     def getEvidenceByID(self, evidenceid: str) -> evidence.Evidence:
         evidenceid = evidenceid.lower()
         for evidence in self.evidence:
@@ -816,7 +927,7 @@ class Case:
     def jury_pool(self):
         return [self.fetchUser(user) for user in self.jury_pool_ids]
 
-    async def newEvidence(self, author: discord.Member, filename: str, file: io.BytesIO) -> evidence.Evidence:
+    async def newEvidence(self, author: discord.Member, filename: str, file: io.BytesIO, max_size: int = None, progress = None) -> evidence.Evidence:
 
         self.registerUser(author)  
 
@@ -830,7 +941,7 @@ class Case:
 
         evidence_id = f"{self.id}-{evidence_tag}{self.evidence_number}"
         new_evidence = evidence.Evidence(evidence_id)
-        await new_evidence.New(filename, file, author.id)
+        await new_evidence.New(filename, file, author.id, max_size, progress)
 
         self.evidence.append(new_evidence)
         self.event_log.append(await self.newEvent(
@@ -842,6 +953,8 @@ class Case:
 
         self.evidence_number += 1
         await self.Save()
+        indexEvidence(self, {"id": new_evidence.id, "filename": new_evidence.filename, "created": new_evidence.created})
+        evidence.queuePreview(self.id, new_evidence)
         return new_evidence
 
     async def New(self, prosecutor: discord.Member, defense: discord.Member, penalties: List[Penalty], description: str) -> Case:
@@ -895,6 +1008,11 @@ class Case:
 
         # if this is set to true, Tick() won't do anything, good for completely freezing the case 
         self.no_tick: bool = False
+        self.closed: datetime.datetime = None
+
+        self.next_deadline = None
+        self.evidence_summary = []
+        self.hydrated = True
 
         log("Case", "New", f"Created new case {self.id} with title {self.title}")
 
@@ -903,6 +1021,7 @@ class Case:
         await self.Save()
 
         ACTIVECASES.append(self)
+        indexCase(self)
 
         return self
     
@@ -910,11 +1029,36 @@ class Case:
     # instead of having to manually add them to the functions
 
     async def Save(self):
-        
+
+        if not self.hydrated:  # saving a summary would overwrite the full document with a partial one
+            log("Case", "Save", f"Refusing to save case {self.id}, it has not been hydrated")
+            return None
+
+        if self.archived:  # archived cases are read-only copies loaded from archived_cases
+            log("Case", "Save", f"Refusing to save case {self.id}, it has been archived")
+            return None
+
         t = time.time()
         log("Case", "Save", f"Saving case {self.id} to database")
 
-        case_dict = {
+        self.next_deadline = self.nextDeadline()
+
+        case_dict = self.toDict()
+
+        db_ = await db.create_connection("cases")
+        await db_.update_one({"_id": self.id}, {"$set": case_dict}, upsert=True)
+
+        CASE_SAVE_SECONDS.observe(time.time() - t)
+        try:
+            CASE_SAVE_BYTES.observe(len(bson.encode(case_dict)))
+        except Exception:  # not worth failing a save over
+            pass
+        log("Case", "Save", f"Saved case {self.id} to database in {round(time.time() - t, 5)} seconds")
+
+        return case_dict
+
+    def toDict(self) -> dict:
+        return {
                 # metadata
                 "_id": self.id,
                 "title": self.title,
@@ -957,16 +1101,10 @@ class Case:
                 "event_log": self.event_log,
                 "juror_chat_log": self.juror_chat_log,
                 
-                "no_tick": self.no_tick
+                "no_tick": self.no_tick,
+                "closed": self.closed
             }
 
-        db_ = await db.create_connection("cases")
-        await db_.update_one({"_id": self.id}, {"$set": case_dict}, upsert=True)
-
-        log("Case", "Save", f"Saved case {self.id} to database in {round(time.time() - t, 5)} seconds")
-
-        return case_dict
-
     def loadFromDict(self, d: dict):
         t = time.time()
 
@@ -1007,10 +1145,86 @@ class Case:
         self.votes = d["votes"]
 
         self.no_tick = d["no_tick"]
+        self.closed = d.get("closed")
+
+        self.next_deadline = self.nextDeadline()
+        self.evidence_summary = []
+        self.hydrated = True
 
         log("Case", "Load", f"Loaded saved case {self.id} with title {self.title} in {round(time.time() - t, 5)} seconds")
 
         return self
+
+    def loadSummary(self, d: dict):
+        # only loads what SUMMARY_PROJECTION pulls, enough for lookups, autocomplete and juror checks
+        self.id = d["_id"]
+        self.title = d["title"]
+        self.status = d["status"]
+        self.stage = d["stage"]
+        self.no_tick = d["no_tick"]
+
+        self.prosecutor_id = d["prosecutor_id"]
+        self.defense_id = d["defense_id"]
+        self.jury_pool_ids = d["jury_pool_ids"]
+        self.jury_invites = d["jury_invites"]
+        self.closed = d.get("closed")
+
+        deadlines = [motion["expiry"] for motion in d.get("motion_queue", []) if motion.get("expiry")]
+        if d.get("plea_deal_expiration"):
+            deadlines.append(d["plea_deal_expiration"])
+        deadlines = [deadline.replace(tzinfo=datetime.timezone.utc) for deadline in deadlines]
+        self.next_deadline = min(deadlines) if deadlines else None
+        self.unscheduled_motions = any(not motion.get("expiry") for motion in d.get("motion_queue", []))
+
+        self.evidence_summary = [
+            {"id": e["id"], "filename": e["filename"], "created": e["created"].replace(tzinfo=datetime.timezone.utc)}
+            for e in d.get("evidence", [])
+        ]
+
+        self.hydrated = False
+        return self
+
+    def needsTick(self, now: datetime.datetime) -> bool:
+        # whether the case manager has to hydrate this case to tick it. a summary-only case in argumentation with a full
+        # jury and every motion already up for a vote has nothing to do until its next motion or plea deal deadline
+        if self.hydrated or self.no_tick:
+            return not self.no_tick
+        if self.stage != 2 or self.unscheduled_motions:
+            return True
+        if len(self.jury_pool_ids) < JURY_SIZE or any(not self.guild.get_member(juror_id) for juror_id in self.jury_pool_ids):
+            return True
+        return self.next_deadline is not None and self.next_deadline <= now
+
+    def nextDeadline(self) -> Optional[datetime.datetime]:
+        deadlines = [motion.expiry for motion in self.motion_queue if motion.expiry]
+        if self.plea_deal_expiration:
+            deadlines.append(self.plea_deal_expiration)
+        deadlines = [deadline if deadline.tzinfo else deadline.replace(tzinfo=datetime.timezone.utc) for deadline in deadlines]
+        return min(deadlines) if deadlines else None
+
+    async def hydrate(self) -> Case:
+        if self.hydrated:
+            return self
+
+        task = HYDRATING.get(self.id)
+        if task is None:
+            task = asyncio.ensure_future(self._hydrate())
+            HYDRATING[self.id] = task
+            task.add_done_callback(lambda _: HYDRATING.pop(self.id, None))
+
+        # shielded so one waiter timing out doesn't cancel the load for everyone else
+        return await asyncio.shield(task)
+
+    async def _hydrate(self) -> Case:
+        t = time.time()
+        db_ = await db.create_connection("cases")
+        d = await db_.find_one({"_id": self.id})
+        if d is None:
+            log("Case", "hydrate", f"Case {self.id} has a summary loaded but no document in the database")
+            return None
+        self.loadFromDict(d)
+        log("Case", "hydrate", f"Hydrated case {self.id} in {round(time.time() - t, 5)} seconds")
+        return self
     
     def __del__(self):
         log("Case", "CaseDelete", f"Case {self} ({self.id}) has been deleted")
@@ -1104,6 +1318,8 @@ class Case:
             evidence_manifest += f"\tAuthor: {self.nameUserByID(evidence.author)}\n"
             if evidence.alt_text:
                 evidence_manifest += f"\tAlt Text: {evidence.alt_text}\n"
+            if evidence.preview:
+                evidence_manifest += f"\tFile: {evidence.describePreview()}\n"
 
             evidence_manifest += "\n"
 
@@ -1111,6 +1327,8 @@ class Case:
             evidence_manifest_admin += f"\tAuthor: {self.nameUserByIDNoAnon(evidence.author)} ({evidence.author})\n"
             if evidence.alt_text:
                 evidence_manifest_admin += f"\tAlt Text: {evidence.alt_text}\n"
+            if evidence.preview:
+                evidence_manifest_admin += f"\tFile: {evidence.describePreview()}\n"
             
             evidence_manifest_admin += f"\n"
             
@@ -1200,19 +1418,91 @@ class Case:
         self.bot = bot
         self.guild = guild
         self.id = random.randint(100000000000000000, 999999999999999999)
+        self.hydrated = False
+        self.archived = False
         return
 
 def getEvidenceByIDGlobal(evidenceid: str) -> (Case, evidence.Evidence):
     evidenceid = evidenceid.lower()
     for case in ACTIVECASES:
+        if not case.hydrated:
+            continue
         for evidence in case.evidence:
             if evidence.id.lower() == evidenceid:
                 return case, evidence
     return None, None
 
+async def fetchEvidenceByIDGlobal(evidenceid: str) -> (Case, evidence.Evidence):
+    # evidence ids are always "{caseid}-{tag}{number}", so the owning case can be found without hydrating every case
+    case_id = evidenceid.rsplit("-", 1)[0]
+    case = await fetchCaseByID(case_id)
+    if case is None:
+        case = await fetchArchivedCase(case_id)
+    if case is None:
+        return None, None
+    return case, case.getEvidenceByID(evidenceid)
+
+# closed cases are left alone for this long before being archived, so anything still acting on them
+# (like a withdrawal deleting the case outright) gets to finish first
+ARCHIVE_GRACE = datetime.timedelta(hours=1)
+
+async def archiveClosedCases() -> int:
+    archived = 0
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for case in ACTIVECASES.copy():
+        if case.stage != 3:
+            continue
+        if case.closed is None:
+            # closed before it was recorded, start the grace period now instead of archiving it right away
+            case.closed = now
+            cases_ = await db.create_connection("cases")
+            await cases_.update_one({"_id": case.id}, {"$set": {"closed": now}})
+            continue
+        closed = case.closed if case.closed.tzinfo else case.closed.replace(tzinfo=datetime.timezone.utc)
+        if now - closed < ARCHIVE_GRACE:
+            continue
+        # the summary is enough to decide, only the cases actually being archived get loaded
+        if not await case.hydrate():
+            continue
+        if await case.Archive():
+            archived += 1
+    if archived:
+        log("Case", "archiveClosedCases", f"Archived {archived} closed cases, {len(ACTIVECASES)} remain active")
+    return archived
+
+async def fetchArchivedCase(case_id: str) -> Optional[Case]:
+    # loads an archived case on demand, it is never put back in ACTIVECASES and can't be saved
+    db_ = await db.create_connection("archived_cases")
+    d = await db_.find_one({"_id": case_id.lower()})
+    if d is None:
+        return None
+    bot = config.get_global("bot")
+    case = Case(bot, config.get_global("guild")).loadFromDict(d)
+    case.archived = True
+    return case
+
+async def searchArchivedCases(query: str, limit: int = 25) -> List[dict]:
+    db_ = await db.create_connection("archived_cases")
+    pattern = {"$regex": re.escape(query), "$options": "i"}
+    return await db_.find(
+        {"$or": [{"_id": pattern}, {"title": pattern}, {"description": pattern}]},
+        {"_id": True, "title": True, "status": True, "closed": True, "archived": True}
+    ).sort("archived", -1).to_list(limit)
+
+async def getArchivedZip(case_id: str, admin: bool = False) -> Optional[io.BytesIO]:
+    db_ = await db.create_connection("archived_cases")
+    d = await db_.find_one({"_id": case_id.lower()}, {"archive_zip_id": True, "archive_zip_admin_id": True})
+    if d is None:
+        return None
+    file = await gridfs.get_file(d["archive_zip_admin_id"] if admin else d["archive_zip_id"])
+    if file is None:
+        return None
+    return file["file"]
+
 async def removeJurorFromCases(juror_id: int, reason: str):
     if isinstance(juror_id, discord.Member):
         juror_id = juror_id.id
     for case in ACTIVECASES:
         if juror_id in case.jury_pool_ids:
-            await case.removeJuror(juror_id, reason)
\ No newline at end of file
+            if await case.hydrate():
+                await case.removeJuror(juror_id, reason)
\ No newline at end of file
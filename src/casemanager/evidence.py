@@ -1,11 +1,24 @@
+import asyncio
 import datetime
+import io
+import mimetypes
+import os
+import re
+import time
 from typing import *
 
+import aiohttp
 import discord
 
+from .. import database as db
 from .. import gridfs, utils
 from ..stasilogging import *
 
+try:
+    from PIL import Image
+except ImportError:  # no thumbnails without pillow, everything else still gets previews
+    Image = None
+
 
 class Seal:
 
@@ -41,6 +54,8 @@ class Evidence:
         self.created = None
         self.certified = False
         self.alt_text = None
+        self.sha256 = None
+        self.preview = None  # filled in by the preview workers after upload, see buildPreview()
         self.seals: List[Seal] = []  # key -> desc
 
     def fromDict(self, data):
@@ -52,6 +67,8 @@ class Evidence:
         self.created = data["created"].replace(tzinfo=datetime.timezone.utc)
         self.certified = data["certified"]
         self.alt_text = data["alt_text"]
+        self.sha256 = data.get("sha256")
+        self.preview = data.get("preview")
         return self
     
     def toDict(self):
@@ -63,7 +80,9 @@ class Evidence:
             "id": self.id,
             "seals": [seal.toDict() for seal in self.seals],
             "created": self.created,
-            "certified": self.certified
+            "certified": self.certified,
+            "sha256": self.sha256,
+            "preview": self.preview
         }
     
     def addSeal(self, desc, author_id: int):
@@ -81,14 +100,15 @@ class Evidence:
     def isSealed(self):
         return len(self.seals) > 0
 
-    async def New(self, filename, bytes_io, author_id: int):
+    async def New(self, filename, bytes_io, author_id: int, max_size: int = None, progress = None):
+        # bytes_io can also be an async iterator of chunks, see streamAttachment()
         if isinstance(author_id, discord.Member):
             author_id = author_id.id
 
         self.filename = filename
         self.created = datetime.datetime.now(datetime.timezone.utc)
         self.author = author_id
-        self.file_id = await gridfs.update_file(filename, bytes_io, created=self.created)
+        self.file_id, self.sha256 = await gridfs.store_blob(filename, bytes_io, max_size=max_size, progress=progress, created=self.created)
         return self
 
     async def update(self, filename, bytes_io):
@@ -97,7 +117,9 @@ class Evidence:
         await self.save()
 
     async def delete(self):
-        await gridfs.delete_file(self.file_id)
+        await gridfs.release_blob(self.file_id)
+        if self.preview and self.preview.get("sidecar_id"):
+            await gridfs.delete_file(self.preview["sidecar_id"])
 
     async def save(self):
         await gridfs.update_file_by_id(self.file_id, self.filename, self.bytes_io, created=self.created)
@@ -107,5 +129,138 @@ class Evidence:
 
     async def getRawFile(self):
         file = await self.getFile()
-        return file["filename"], file["file"] 
+        # deduplicated blobs keep the name they were first uploaded under, this evidence's own name wins
+        return self.filename or file["filename"], file["file"] 
+
+    async def getPreviewFile(self):
+        # the thumbnail or text excerpt, None if there isn't one (yet)
+        if not self.preview or not self.preview.get("sidecar_id"):
+            return None
+        return await gridfs.get_file(self.preview["sidecar_id"])
+
+    def describePreview(self):
+        if not self.preview:
+            return None
+        desc = [self.preview["kind"]]
+        if "dimensions" in self.preview:
+            desc.append("x".join(str(d) for d in self.preview["dimensions"]))
+        if "pages" in self.preview:
+            desc.append(f"{self.preview['pages']} page{'s' if self.preview['pages'] != 1 else ''}")
+        if "lines" in self.preview:
+            desc.append(f"{self.preview['lines']} line{'s' if self.preview['lines'] != 1 else ''}")
+        desc.append(utils.bytes_to_human(self.preview["size"]))
+        return ", ".join(desc)
+
+    async def generatePreview(self, case_id):
+        t = time.time()
+        file = await self.getFile()
+        if file is None:
+            return
+        preview, sidecar = await utils.inThread(buildPreview, self.filename, file["file"].getvalue())
+        if sidecar:
+            sidecar_name, sidecar_bytes = sidecar
+            preview["sidecar_id"] = await gridfs.update_file(sidecar_name, io.BytesIO(sidecar_bytes), preview_of=self.file_id)
+
+        # straight into the evidence entry, the case might not be saved again for a while
+        db_ = await db.create_connection("cases")
+        result = await db_.update_one({"_id": case_id}, {"$set": {"evidence.$[e].preview": preview}}, array_filters=[{"e.id": self.id}])
+        if not result.matched_count:  # the case got archived (or deleted) in the meantime, nothing would point at the sidecar
+            if preview.get("sidecar_id"):
+                await gridfs.delete_file(preview["sidecar_id"])
+            log("Case", "preview", f"Dropped the preview for {self.id}, case {case_id} is no longer active", False)
+            return
+        self.preview = preview
+        log("Case", "preview", f"Generated {preview['kind']} preview for {self.id} in {round(time.time() - t, 5)} seconds", False)
+
+
+# previews are made in the background right after upload so /case evidence view and the zip manifest don't need the
+# whole file: image thumbnails, the first lines of text files, page counts for pdfs and the size of everything else.
+# thumbnails and text excerpts are stored as their own small gridfs files, the rest lives on the evidence entry
+
+PREVIEW_WORKERS = 2
+PREVIEW_LINES = 15
+PREVIEW_CHARS = 900  # has to fit in an embed field with the code block around it
+THUMBNAIL_SIZE = (320, 320)
+
+PREVIEW_QUEUE: asyncio.Queue = None
+PREVIEW_TASKS: List[asyncio.Task] = []
+PREVIEWS_PENDING: Set[Tuple[str, str]] = set()  # (case id, evidence id) queued or being built, so each is only built once
+
+def queuePreview(case_id: str, evidence: Evidence):
+    # only for evidence in active cases, previews are written to the cases collection
+    global PREVIEW_QUEUE
+    if (case_id, evidence.id) in PREVIEWS_PENDING:
+        return
+    if PREVIEW_QUEUE is None:
+        PREVIEW_QUEUE = asyncio.Queue()
+        for i in range(PREVIEW_WORKERS):
+            PREVIEW_TASKS.append(asyncio.create_task(previewWorker(i)))
+    PREVIEWS_PENDING.add((case_id, evidence.id))
+    PREVIEW_QUEUE.put_nowait((case_id, evidence))
+
+async def previewWorker(n: int):
+    while True:
+        case_id, evidence = await PREVIEW_QUEUE.get()
+        try:
+            await evidence.generatePreview(case_id)
+        except Exception as e:
+            log("Case", "preview", f"Preview worker {n} failed on {evidence.id}: {type(e).__name__}: {e}")
+        finally:
+            PREVIEWS_PENDING.discard((case_id, evidence.id))
+            PREVIEW_QUEUE.task_done()
+
+def buildPreview(filename: str, data: bytes):
+    # runs in a thread, returns the preview dict and optionally (name, bytes) of a sidecar file to store
+    mime, _ = mimetypes.guess_type(filename or "")
+    preview = {"size": len(data), "mime": mime}
+    stem = os.path.splitext(filename or "evidence")[0]
+
+    if Image is not None and (mime or "").startswith("image/"):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                preview["kind"] = "image"
+                preview["dimensions"] = list(image.size)
+                image.thumbnail(THUMBNAIL_SIZE)
+                if image.mode not in ("RGB", "RGBA", "L"):
+                    image = image.convert("RGBA")
+                thumbnail = io.BytesIO()
+                image.save(thumbnail, "PNG")
+            return preview, (f"{stem}.thumbnail.png", thumbnail.getvalue())
+        except (OSError, ValueError):  # not actually an image, or one pillow can't read
+            preview.pop("dimensions", None)
+
+    if data.startswith(b"%PDF"):
+        preview["kind"] = "pdf"
+        preview["pages"] = len(re.findall(rb"/Type\s*/Page\b", data))  # good enough, doesn't look inside object streams
+        return preview, None
+
+    text = decodeText(data)
+    if text is not None:
+        lines = text.splitlines()
+        preview["kind"] = "text"
+        preview["lines"] = len(lines)
+        excerpt = "\n".join(lines[:PREVIEW_LINES])[:PREVIEW_CHARS]
+        return preview, (f"{stem}.preview.txt", excerpt.encode())
+
+    preview["kind"] = "image" if (mime or "").startswith("image/") else "file"
+    return preview, None
+
+def decodeText(data: bytes):
+    # the file as text if it looks like text, otherwise None
+    if b"\x00" in data[:8192]:
+        return None
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        return None
+
+
 
+async def streamAttachment(attachment: discord.Attachment) -> AsyncIterator[bytes]:
+    # yields the attachment in chunks straight off the CDN instead of reading the whole thing into memory
+    # aclose() it when done, an upload that stops early would otherwise leave the session open until it's collected
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment.url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(gridfs.CHUNK_SIZE):
+                yield chunk
@@ -0,0 +1,132 @@
+import datetime
+import time
+from typing import *
+
+from .. import config
+from .. import database as db
+from .. import gridfs
+from ..stasilogging import *
+from .casemanager import ACTIVECASES
+
+"""
+Finds GridFS files that nothing points at anymore.
+Crashes between uploading and Case.Save, cases that were closed but never deleted, and Evidence.update all leave
+files behind. The reconciler walks fs.files in _id order a few batches at a time, checks each batch against the
+evidence (and previews and archive zips) of active and archived cases, and reports the orphans older than the
+grace period to the gridfs_orphans collection, deleting them too if that's turned on.
+Where it stopped is kept in the reconciler collection, so every run picks up where the last one left off and a
+full pass over a big bucket is spread out over many runs.
+"""
+
+RECONCILER_DEFAULTS = {
+    "delete": False,  # only report orphans until you trust it
+    "grace_hours": 24,
+    "batch_size": 500,
+    "batches_per_run": 4,
+}
+
+# every field in cases / archived_cases that holds a gridfs file id
+REFERENCE_FIELDS = ["evidence.file_id", "evidence.preview.sidecar_id", "archive_zip_id", "archive_zip_admin_id"]
+
+INDEXED = False
+
+def reconcilerConfig():
+    return {**RECONCILER_DEFAULTS, **(config.C.get("gridfs_reconciler", {}) or {})}
+
+async def ensureReferenceIndexes():
+    global INDEXED
+    if INDEXED:
+        return
+    for collection in ("cases", "archived_cases"):
+        db_ = await db.create_connection(collection)
+        for field in REFERENCE_FIELDS:
+            await db_.create_index(field, sparse=True)
+    blobs = await db.create_connection("blobs")
+    await blobs.create_index("file_id")
+    INDEXED = True
+
+def _documentFileIDs(d: dict):
+    for evidence in d.get("evidence", []):
+        yield evidence.get("file_id")
+        yield (evidence.get("preview") or {}).get("sidecar_id")
+    yield d.get("archive_zip_id")
+    yield d.get("archive_zip_admin_id")
+
+async def referencedFileIDs(ids: List[str]) -> Set[str]:
+    # which of these file ids are referenced by anything
+    referenced = set()
+
+    # evidence that's in memory but hasn't made it to the database yet
+    for case in ACTIVECASES:
+        for evidence in case.evidence if case.hydrated else []:
+            referenced.add(evidence.file_id)
+            referenced.add((evidence.preview or {}).get("sidecar_id"))
+
+    query = {"$or": [{field: {"$in": ids}} for field in REFERENCE_FIELDS]}
+    projection = {field: True for field in REFERENCE_FIELDS}
+    for collection in ("cases", "archived_cases"):
+        db_ = await db.create_connection(collection)
+        async for d in db_.find(query, projection):
+            referenced.update(_documentFileIDs(d))
+
+    return referenced & set(ids)
+
+async def reportOrphan(file, deleted: bool):
+    db_ = await db.create_connection("gridfs_orphans")
+    await db_.update_one({"_id": str(file._id)}, {"$set": {
+        "filename": file.filename,
+        "length": file.length,
+        "uploaded": file.upload_date,
+        "metadata": file.metadata,
+        "found": datetime.datetime.now(datetime.timezone.utc),
+        "deleted": deleted
+    }}, upsert=True)
+
+async def reconcileGridFS(batches: int = None) -> dict:
+    t = time.time()
+    options = reconcilerConfig()
+    await ensureReferenceIndexes()
+
+    state_db = await db.create_connection("reconciler")
+    state = await state_db.find_one({"_id": "gridfs"}) or {"last_id": None, "passes": 0}
+    last_id = state["last_id"]
+    passes = state["passes"]
+
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=options["grace_hours"])  # gridfs upload dates are naive utc
+    result = {"scanned": 0, "orphans": 0, "deleted": 0, "pass_finished": False}
+
+    for _ in range(batches or options["batches_per_run"]):
+        files = await gridfs.list_files(last_id, options["batch_size"])
+        ids = [str(file._id) for file in files]
+        referenced = await referencedFileIDs(ids) if ids else set()
+
+        orphans = deleted = 0
+        for file in files:
+            if str(file._id) in referenced or file.upload_date.replace(tzinfo=None) > cutoff:
+                continue
+            removed = options["delete"] and await gridfs.delete_orphan(file._id, cutoff)
+            await reportOrphan(file, bool(removed))
+            orphans += 1
+            deleted += 1 if removed else 0
+
+        result["scanned"] += len(files)
+        result["orphans"] += orphans
+        result["deleted"] += deleted
+        if len(files) < options["batch_size"]:  # reached the end, the next run starts over from the beginning
+            last_id = None
+            passes += 1
+            result["pass_finished"] = True
+        else:
+            last_id = files[-1]._id
+
+        # saved after every batch so a restart never redoes more than one
+        await state_db.update_one({"_id": "gridfs"}, {
+            "$set": {"last_id": last_id, "passes": passes, "updated": datetime.datetime.now(datetime.timezone.utc)},
+            "$inc": {"scanned": len(files), "orphans": orphans, "deleted": deleted}
+        }, upsert=True)
+
+        if result["pass_finished"]:
+            break
+
+    log("gridfs", "reconciler", f"Scanned {result['scanned']} files, found {result['orphans']} orphans, deleted {result['deleted']}{' and finished a pass' if result['pass_finished'] else ''} in {round(time.time() - t, 5)} seconds", False)
+    return result
@@ -9,6 +9,7 @@ import motor.motor_asyncio
 import pymongo
 import yaml
 
+from . import perf
 from . import utils
 from typing import List
 
@@ -30,9 +31,52 @@ loop.run_until_complete(establish_server_connection())
 del loop  # :troll:
 
 
+class TimedCursor:
+    # times to_list() on a find() cursor, sort/limit/skip keep returning this so chains still work
+    def __init__(self, cursor, collection: str):
+        self._cursor = cursor
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name in ("sort", "limit", "skip", "batch_size"):
+            def chained(*args, **kwargs):
+                attr(*args, **kwargs)
+                return self
+            return chained
+        return attr
+
+    def __aiter__(self):
+        return self._cursor.__aiter__()
+
+    async def to_list(self, *args, **kwargs):
+        with perf.timeDB(self._collection, "find"):
+            return await self._cursor.to_list(*args, **kwargs)
+
+class TimedCollection:
+    # hands everything through to the motor collection, recording how long each operation takes per collection
+    # and adding it to the running command's database time
+    TIMED = {"find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one", "delete_one", "delete_many", "find_one_and_update", "find_one_and_delete", "count_documents", "bulk_write"}
+
+    def __init__(self, collection):
+        self._collection = collection
+        self._name = collection.name
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in self.TIMED:
+            return attr
+        async def timed(*args, **kwargs):
+            with perf.timeDB(self._name, name):
+                return await attr(*args, **kwargs)
+        return timed
+
+    def find(self, *args, **kwargs):
+        return TimedCursor(self._collection.find(*args, **kwargs), self._name)
+
 async def create_connection(table):
     db = client[C["mongodb"]["name"]]
-    return db[table]
+    return TimedCollection(db[table])
 
 
 # global table
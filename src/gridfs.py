@@ -1,10 +1,26 @@
+import datetime
 import motor.motor_asyncio
+import os
+import pymongo
+import bson
 from bson import ObjectId
+from collections import OrderedDict
+from gridfs.errors import NoFile  # pymongo's gridfs package, not this module
 from io import BytesIO
+from . import config
 from . import database
+from . import metrics
+from . import utils
 from .stasilogging import *
+import hashlib
+import mimetypes
 import time
 
+try:
+    import zstandard
+except ImportError:  # without it everything is just stored raw
+    zstandard = None
+
 # Create a new instance of the MotorClient and get the database
 client = database.client
 db = client.gridfs # replace 'mydatabase' with your database name
@@ -12,9 +28,10 @@ fs = motor.motor_asyncio.AsyncIOMotorGridFSBucket(db)
 
 async def update_file(filename, bytes_io, **kwargs):
     t = time.time()
-    log("gridfs", "update_file", f"Updating file {filename}", False)
+    log("gridfs", "update_file", f"Updating file {filename}", False, level="debug")
     # Generate a random ObjectId as fileid
     fileid = ObjectId()
+    bytes_io, kwargs = _compress(filename, bytes_io, kwargs)
     # Upload the file to GridFS
     await fs.upload_from_stream_with_id(fileid, filename, bytes_io, metadata=kwargs)
     log("gridfs", "update_file", f"Updated file {filename} ({fileid}) in {round(time.time() - t, 5)} seconds", False)
@@ -23,37 +40,451 @@ async def update_file(filename, bytes_io, **kwargs):
 async def update_file_by_id(id, filename, bytes_io, **kwargs):
     # Upload the file to GridFS, using the given id, update if exists, insert if not
     t = time.time()
-    log("gridfs", "update_file_by_id", f"Updating file {id} with {filename}", False)
+    log("gridfs", "update_file_by_id", f"Updating file {id} with {filename}", False, level="debug")
+    bytes_io, kwargs = _compress(filename, bytes_io, kwargs)
     await fs.upload_from_stream_with_id(id, filename, bytes_io, metadata=kwargs)
+    await cache_invalidate(id)
     log("gridfs", "update_file_by_id", f"Updated file {id} with {filename} in {round(time.time() - t, 5)} seconds", False)
     return str(id)
 
 async def delete_file(id):
+    await cache_invalidate(id)
     try:
         # Delete the file from GridFS
         d = await fs.delete(ObjectId(id))
         log("gridfs", "delete_file", f"Deleted file {id}", False)
         return True
-    except motor.motor_asyncio.gridfs.NoFile:
+    except NoFile:
         log("gridfs", "delete_file_404", f"Tried to delete {id} but wasn't found", False)
         
         return False
 
 async def get_file(id):
     t = time.time()
-    log("gridfs", "get_file", f"Getting file {id}", False)
+    log("gridfs", "get_file", f"Getting file {id}", False, level="debug")
+
+    cached = await cache_get(id)
+    if cached is not None:
+        data, filename, metadata = cached
+        log("gridfs", "get_file", f"Got file {id} from cache in {round(time.time() - t, 5)} seconds", False, level="debug")
+        return {
+            "file": BytesIO(data),
+            "filename": filename,
+            **metadata
+        }
+
     try:
         # Get the file from GridFS
         grid_out = await fs.open_download_stream(ObjectId(id))
-        bytes_io = BytesIO()
-        bytes_io.write(await grid_out.read())
-        bytes_io.seek(0)
+        metadata = grid_out.metadata or {}
+        if metadata.get("compression") == "zstd":
+            data = await _decompress(grid_out)
+        else:
+            data = await grid_out.read()
         log("gridfs", "get_file", f"Got file {id} in {round(time.time() - t, 5)} seconds")
+        await cache_put(id, data, grid_out.filename, metadata)
         return {
-            "file": bytes_io,
+            "file": BytesIO(data),
             "filename": grid_out.filename,
-            **grid_out.metadata
+            **metadata
         }
-    except motor.motor_asyncio.gridfs.NoFile:
+    except NoFile:
         log("gridfs", "get_file_404", f"Tried to get {id} but wasn't found", False)
-        return None
\ No newline at end of file
+        return None
+
+async def list_files(after=None, limit=500):
+    # walks fs.files in _id order a batch at a time, for background jobs like the reconciler
+    query = {"_id": {"$gt": after}} if after is not None else {}
+    cursor = fs.find(query, sort=[("_id", 1)], limit=limit)
+    return await cursor.to_list(length=limit)
+
+async def delete_orphan(id, cutoff):
+    # deletes a file nothing references, unless a duplicate upload picked its blob up again after cutoff
+    # (the evidence pointing at it might just not be saved yet)
+    blobs = await database.create_connection("blobs")
+    blob = await blobs.find_one({"file_id": str(id)})
+    if blob is not None:
+        if blob.get("last_ref") and blob["last_ref"].replace(tzinfo=None) > cutoff:
+            return False
+        deleted = await blobs.delete_one({"_id": blob["_id"], "last_ref": blob.get("last_ref")})
+        if not deleted.deleted_count:  # lost a race with store_blob
+            return False
+    return await delete_file(id)
+
+# compression at rest, text logs / json / html exports compress really well and a lot of evidence is exactly that
+# compressed files get compression: "zstd" and their original size in the metadata, get_file undoes it transparently
+# configured under evidence_compression in config.yml, compression_stats() has the ratio and cpu time to tune it with
+
+COMPRESSION_STATS = {"compressed": 0, "skipped": 0, "raw_bytes": 0, "stored_bytes": 0, "compress_cpu": 0.0, "decompressed": 0, "decompress_cpu": 0.0}
+
+COMPRESSIBLE_TYPES = {"application/json", "application/xml", "application/javascript", "application/x-ndjson", "application/csv", "image/svg+xml"}
+
+# already compressed formats, not worth spending cpu on whatever the extension says
+COMPRESSED_MAGIC = (
+    b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"RIFF", b"PK\x03\x04", b"\x1f\x8b", b"(\xb5/\xfd", b"BZh", b"7z\xbc\xaf",
+    b"Rar!", b"OggS", b"ID3", b"fLaC", b"\x1aE\xdf\xa3", b"%PDF",
+)
+
+def _compression_config():
+    return config.C.get("evidence_compression", {}) or {}
+
+def _compressible(filename, head: bytes):
+    # decides from the name and the first chunk of the file
+    options = _compression_config()
+    if zstandard is None or not options.get("enabled", True):
+        return False
+    if len(head) < options.get("min_size", 1024):
+        return False
+    if head.startswith(COMPRESSED_MAGIC) or head[4:8] == b"ftyp":  # ftyp is mp4/mov/heic
+        return False
+
+    mime, encoding = mimetypes.guess_type(filename or "")
+    if encoding:  # .gz, .bz2 and friends
+        return False
+    if mime:
+        return mime.startswith("text/") or mime in COMPRESSIBLE_TYPES
+
+    # unknown extension, compress it if it looks like text
+    sample = head[:4096]
+    if b"\x00" in sample:
+        return False
+    try:
+        sample.decode("utf-8")
+        return True
+    except UnicodeDecodeError as e:
+        return e.start >= len(sample) - 3  # just cut off in the middle of a character
+
+def _compressor():
+    return zstandard.ZstdCompressor(level=_compression_config().get("level", 3))
+
+def _compress(filename, bytes_io, kwargs):
+    # for the upload-everything-at-once functions, returns what to upload and the metadata to upload it with
+    data = bytes_io if isinstance(bytes_io, (bytes, bytearray)) else bytes_io.read()
+    if not _compressible(filename, data[:CHUNK_SIZE]):
+        COMPRESSION_STATS["skipped"] += 1
+        return BytesIO(data), kwargs
+
+    cpu = time.thread_time()
+    compressed = _compressor().compress(data)
+    cpu = time.thread_time() - cpu
+
+    if len(compressed) * _compression_config().get("min_ratio", 1.25) > len(data):  # sniffing guessed wrong
+        COMPRESSION_STATS["skipped"] += 1
+        COMPRESSION_STATS["compress_cpu"] += cpu
+        return BytesIO(data), kwargs
+
+    _record_compression(filename, len(data), len(compressed), cpu)
+    return BytesIO(compressed), {**kwargs, "compression": "zstd", "size": len(data)}
+
+def _record_compression(filename, raw, stored, cpu):
+    COMPRESSION_STATS["compressed"] += 1
+    COMPRESSION_STATS["raw_bytes"] += raw
+    COMPRESSION_STATS["stored_bytes"] += stored
+    COMPRESSION_STATS["compress_cpu"] += cpu
+    log("gridfs", "compress", f"Compressed {filename} from {raw} to {stored} bytes ({round(raw / max(stored, 1), 2)}x) in {round(cpu, 5)} cpu seconds", False)
+
+async def _decompress(grid_out):
+    # feeds the chunks through as they come in instead of holding the compressed and decompressed copy at once
+    if zstandard is None:
+        raise RuntimeError(f"{grid_out.filename} is zstd compressed but zstandard isn't installed")
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    out = BytesIO()
+    cpu = 0.0
+    while chunk := await grid_out.readchunk():
+        t = time.thread_time()
+        out.write(decompressor.decompress(chunk))
+        cpu += time.thread_time() - t
+    COMPRESSION_STATS["decompressed"] += 1
+    COMPRESSION_STATS["decompress_cpu"] += cpu
+    return out.getvalue()
+
+def compression_stats():
+    return {
+        **COMPRESSION_STATS,
+        "ratio": round(COMPRESSION_STATS["raw_bytes"] / COMPRESSION_STATS["stored_bytes"], 3) if COMPRESSION_STATS["stored_bytes"] else None,
+    }
+
+metrics.collect("evidence_compression", compression_stats)
+
+# file cache in front of get_file, evidence gets viewed and zipped over and over during a case
+# level 1 is an in memory LRU bounded by total bytes, level 2 is an optional directory on disk with its own cap
+# configured under evidence_cache in config.yml, entries are keyed by file id and dropped on update/delete
+
+MEMORY_CACHE = OrderedDict()  # file id -> (bytes, filename, metadata), oldest first
+DISK_CACHE = None  # file id -> size on disk, oldest first, filled from the cache directory on first use
+DISK_WRITING = set()  # file ids being written to the disk cache right now
+DISK_INVALIDATED = set()  # ones of those that were invalidated while being written, they're dropped instead of indexed
+CACHE_STATS = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "memory_bytes": 0, "disk_bytes": 0}
+
+def _cache_config():
+    return config.C.get("evidence_cache", {}) or {}
+
+def _memory_limit():
+    return _cache_config().get("memory_bytes", 64 * 1024 * 1024)
+
+def _disk_dir():
+    return _cache_config().get("disk_path")
+
+def _disk_limit():
+    return _cache_config().get("disk_bytes", 1024 * 1024 * 1024)
+
+def _disk_paths(id):
+    return os.path.join(_disk_dir(), f"{id}.bin"), os.path.join(_disk_dir(), f"{id}.meta")
+
+def _disk_index():
+    global DISK_CACHE
+    if DISK_CACHE is None:
+        DISK_CACHE = OrderedDict()
+        os.makedirs(_disk_dir(), exist_ok=True)
+        entries = []
+        for name in os.listdir(_disk_dir()):
+            if name.endswith(".bin"):
+                stat = os.stat(os.path.join(_disk_dir(), name))
+                entries.append((stat.st_mtime, name[:-4], stat.st_size))
+        for _, id, size in sorted(entries):
+            DISK_CACHE[id] = size
+        CACHE_STATS["disk_bytes"] = sum(DISK_CACHE.values())
+    return DISK_CACHE
+
+def _disk_read(id):
+    data_path, meta_path = _disk_paths(id)
+    with open(data_path, "rb") as f:
+        data = f.read()
+    with open(meta_path, "rb") as f:
+        meta = bson.decode(f.read())
+    os.utime(data_path)  # keeps the lru order across restarts
+    return data, meta["filename"], meta["metadata"]
+
+def _disk_write(id, data, filename, metadata):
+    data_path, meta_path = _disk_paths(id)
+    with open(meta_path, "wb") as f:
+        f.write(bson.encode({"filename": filename, "metadata": metadata}))
+    with open(data_path, "wb") as f:
+        f.write(data)
+
+def _disk_remove(id):
+    for path in _disk_paths(id):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _memory_put(id, data, filename, metadata):
+    if len(data) > _memory_limit() // 4:  # one huge file shouldn't flush everything else out
+        return
+    if id in MEMORY_CACHE:
+        CACHE_STATS["memory_bytes"] -= len(MEMORY_CACHE.pop(id)[0])
+    MEMORY_CACHE[id] = (data, filename, metadata)
+    CACHE_STATS["memory_bytes"] += len(data)
+    while CACHE_STATS["memory_bytes"] > _memory_limit():
+        _, (old, _, _) = MEMORY_CACHE.popitem(last=False)
+        CACHE_STATS["memory_bytes"] -= len(old)
+        CACHE_STATS["evictions"] += 1
+
+async def cache_get(id):
+    id = str(id)
+    if id in MEMORY_CACHE:
+        MEMORY_CACHE.move_to_end(id)
+        CACHE_STATS["memory_hits"] += 1
+        return MEMORY_CACHE[id]
+
+    if _disk_dir() and id in _disk_index():
+        try:
+            entry = await utils.inThread(_disk_read, id)
+        except (OSError, bson.errors.BSONError) as e:
+            log("gridfs", "cache", f"Dropping unreadable disk cache entry {id}: {e}", False, level="warning")
+            await cache_invalidate(id)
+        else:
+            DISK_CACHE.move_to_end(id)
+            CACHE_STATS["disk_hits"] += 1
+            _memory_put(id, *entry)
+            return entry
+
+    CACHE_STATS["misses"] += 1
+    return None
+
+async def cache_put(id, data, filename, metadata):
+    id = str(id)
+    _memory_put(id, data, filename, metadata)
+
+    if not _disk_dir() or len(data) > _disk_limit():
+        return
+    index = _disk_index()
+    if id in index or id in DISK_WRITING:  # two misses on the same file at once only write it once
+        return
+    DISK_WRITING.add(id)
+    try:
+        await utils.inThread(_disk_write, id, data, filename, metadata)
+    except OSError as e:
+        log("gridfs", "cache", f"Couldn't write {id} to the disk cache: {e}", False, level="warning")
+        DISK_INVALIDATED.discard(id)
+        await utils.inThread(_disk_remove, id)
+        return
+    finally:
+        DISK_WRITING.discard(id)
+    if id in DISK_INVALIDATED:  # deleted or released while this was writing, what's on disk is stale
+        DISK_INVALIDATED.discard(id)
+        await utils.inThread(_disk_remove, id)
+        return
+    if id in index:
+        return
+    index[id] = len(data)
+    CACHE_STATS["disk_bytes"] += len(data)
+    while CACHE_STATS["disk_bytes"] > _disk_limit() and index:
+        old, size = index.popitem(last=False)
+        CACHE_STATS["disk_bytes"] -= size
+        CACHE_STATS["evictions"] += 1
+        await utils.inThread(_disk_remove, old)
+
+async def cache_invalidate(id):
+    id = str(id)
+    if id in MEMORY_CACHE:
+        CACHE_STATS["memory_bytes"] -= len(MEMORY_CACHE.pop(id)[0])
+    if id in DISK_WRITING:
+        DISK_INVALIDATED.add(id)
+    if _disk_dir() and id in _disk_index():
+        CACHE_STATS["disk_bytes"] -= DISK_CACHE.pop(id)
+        await utils.inThread(_disk_remove, id)
+
+def cache_stats():
+    lookups = CACHE_STATS["memory_hits"] + CACHE_STATS["disk_hits"] + CACHE_STATS["misses"]
+    return {
+        **CACHE_STATS,
+        "memory_entries": len(MEMORY_CACHE),
+        "disk_entries": len(DISK_CACHE or {}),
+        "hit_rate": round((CACHE_STATS["memory_hits"] + CACHE_STATS["disk_hits"]) / lookups, 4) if lookups else None,
+    }
+
+metrics.collect("evidence_cache", cache_stats)
+
+# content addressed storage, used for evidence
+# every unique file is stored once and indexed by its sha256 in the "blobs" collection, with a count of how many
+# things point at it. duplicate uploads are dropped and point at the existing file instead
+
+CHUNK_SIZE = 255 * 1024  # gridfs' own default chunk size
+
+class FileTooLarge(Exception):
+    pass
+
+async def _read_chunks(source):
+    # takes bytes, a file-like object, or an async iterator of chunks (like a download that's still coming in)
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+    if hasattr(source, "__aiter__"):
+        async for chunk in source:
+            yield chunk
+    else:
+        while chunk := source.read(CHUNK_SIZE):
+            yield chunk
+
+async def store_blob(filename, source, max_size: int = None, progress = None, **kwargs):
+    """Upload a file, hashing it as it streams into GridFS, and deduplicate it against the blob index.
+
+    Args:
+        filename (str): Name stored with the file
+        source (BytesIO | bytes | AsyncIterator[bytes]): File contents
+        max_size (int, optional): Abort the upload and raise FileTooLarge once more than this many bytes come in
+        progress (coroutine function, optional): Awaited with the number of bytes uploaded so far after every chunk
+        **kwargs: Stored as the file's metadata
+
+    Returns:
+        (str, str): The file id to reference, and the file's sha256
+    """
+    t = time.time()
+    fileid = ObjectId()
+    hasher = hashlib.sha256()
+    size = 0
+    stored = 0
+    cpu = 0.0
+
+    # the start of the file decides whether the whole thing gets compressed, the metadata has to be set before uploading
+    # network chunks can be tiny, so enough of them are collected to sniff (or the whole file, if it's smaller than that)
+    chunks = _read_chunks(source)
+    head = []
+    wanted = max(_compression_config().get("min_size", 1024), 4096)
+    while sum(len(chunk) for chunk in head) < wanted:
+        try:
+            head.append(await chunks.__anext__())  # not anext(), that's 3.10+
+        except StopAsyncIteration:
+            break
+    first = b"".join(head)
+    compressor = None
+    if _compressible(filename, first):
+        compressor = _compressor().compressobj()
+        kwargs["compression"] = "zstd"
+    else:
+        COMPRESSION_STATS["skipped"] += 1
+
+    async def everything():
+        yield first
+        async for chunk in chunks:
+            yield chunk
+
+    grid_in = fs.open_upload_stream_with_id(fileid, filename, metadata=kwargs)
+    try:
+        async for chunk in everything():
+            size += len(chunk)
+            if max_size is not None and size > max_size:
+                raise FileTooLarge(f"{filename} is larger than {max_size} bytes")
+            hasher.update(chunk)  # hashes what was uploaded, not what's stored, so dedup doesn't care about compression
+            if compressor:
+                c = time.thread_time()
+                chunk = compressor.compress(chunk)
+                cpu += time.thread_time() - c
+            if chunk:
+                stored += len(chunk)
+                await grid_in.write(chunk)
+            if progress:
+                await progress(size)
+        if compressor:
+            c = time.thread_time()
+            chunk = compressor.flush()
+            cpu += time.thread_time() - c
+            stored += len(chunk)
+            await grid_in.write(chunk)
+            kwargs["size"] = size  # the original size, like _compress sets. the stream writes this dict out on close
+        await grid_in.close()
+    except Exception:
+        await grid_in.abort()
+        log("gridfs", "store_blob", f"Aborted upload of {filename} after {size} bytes", False)
+        raise
+
+    if compressor:
+        _record_compression(filename, size, stored, cpu)
+
+    digest = hasher.hexdigest()
+    blobs = await database.create_connection("blobs")
+    # only the first uploader's file id sticks, everyone else just bumps the reference count
+    blob = await blobs.find_one_and_update(
+        {"_id": digest},
+        {"$inc": {"refs": 1}, "$set": {"last_ref": datetime.datetime.utcnow()}, "$setOnInsert": {"file_id": str(fileid), "size": size, "filename": filename}},
+        upsert=True,
+        return_document=pymongo.ReturnDocument.AFTER
+    )
+
+    if blob["file_id"] != str(fileid):
+        await fs.delete(fileid)
+        log("gridfs", "store_blob", f"Deduplicated {filename} ({digest}) against {blob['file_id']}, now {blob['refs']} references, in {round(time.time() - t, 5)} seconds", False)
+    else:
+        log("gridfs", "store_blob", f"Stored new blob {filename} ({digest}) as {fileid} ({size} bytes) in {round(time.time() - t, 5)} seconds", False)
+
+    return blob["file_id"], digest
+
+async def release_blob(id):
+    # drop one reference to a blob, and delete the file once nothing points at it anymore
+    blobs = await database.create_connection("blobs")
+    blob = await blobs.find_one_and_update({"file_id": str(id)}, {"$inc": {"refs": -1}}, return_document=pymongo.ReturnDocument.AFTER)
+
+    if blob is None:  # stored before deduplication existed, nothing else can be pointing at it
+        return await delete_file(id)
+
+    if blob["refs"] > 0:
+        log("gridfs", "release_blob", f"Released {id} ({blob['_id']}), {blob['refs']} references left", False)
+        return False
+
+    deleted = await blobs.delete_one({"_id": blob["_id"], "refs": {"$lte": 0}})
+    if not deleted.deleted_count:  # store_blob picked it up again in between, it's theirs now
+        log("gridfs", "release_blob", f"Released last reference to {id} ({blob['_id']}), but it was referenced again before it could be deleted", False)
+        return False
+    log("gridfs", "release_blob", f"Released last reference to {id} ({blob['_id']})", False)
+    return await delete_file(id)
@@ -9,16 +9,22 @@ import motor  # doing this locally instead of in database.py for greater modular
 from discord import option, slash_command
 from discord.ext import commands, tasks, pages
 
+from . import autocomplete
 from . import casemanager as cm
 from . import casemanagerui as cmui
 from . import config
 from . import database as db
+from . import gridfs
+from . import profiling
 from . import quickask as qa
 from . import report as rm
 from . import utils
 from .stasilogging import *
 
 case_selection = {}
+profiling.watch("justice.case_selection", lambda: len(case_selection))
+
+MAX_EVIDENCE_SIZE = 8388608*4  # 32MB
 
 def saveCaseSelection():
     return {str(k): str(v) for k, v in case_selection.items()}
@@ -30,8 +36,8 @@ async def setActiveCase(member: discord.Member, case: cm.Case):
     case_selection[member.id] = case.id
     await db.set_global(f"case_selection", saveCaseSelection())
 
-def getActiveCase(member: discord.Member) -> cm.Case:
-    return cm.getCaseByID(case_selection.get(member.id, None))
+async def getActiveCase(member: discord.Member) -> cm.Case:
+    return await cm.fetchCaseByID(case_selection.get(member.id, None))
 
 class Justice(commands.Cog):
     def __init__(self, bot):
@@ -40,19 +46,20 @@ class Justice(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
+        t = time.time()
         await cm.populateActiveCases(self.bot, self.bot.get_guild(config.C["guild_id"]))
         case_selection_new = await db.get_global("case_selection")
         if case_selection_new is not None:
             global case_selection
             case_selection = loadCaseSelection(case_selection_new)
-        log("Case", "CaseManager", "Justice module ready.")
+        log("Case", "CaseManager", f"Justice module ready in {round(time.time() - t, 5)} seconds (lazy: {cm.lazyLoadingEnabled()}).")
 
     async def active_case_options(ctx: discord.AutocompleteContext):
-        return [f"{case}: {case.id}" for case in cm.ACTIVECASES]
+        return autocomplete.CASES.search(ctx.value)
 
     case = discord.SlashCommandGroup("case", "Basic case management commands")
     @case.command(name="select", description="Select a case as your active case.")
-    async def select_case(self, ctx: discord.ApplicationContext, case: discord.Option(str, autocomplete=discord.utils.basic_autocomplete(active_case_options))):
+    async def select_case(self, ctx: discord.ApplicationContext, case: discord.Option(str, autocomplete=active_case_options)):
         case = cm.getCaseByID(case.split(" ")[-1])
         if case is None:
             return await ctx.respond("Invalid case ID.", ephemeral=True)
@@ -134,7 +141,7 @@ class Justice(commands.Cog):
     # TODO: Confirmation message
     @case.command(name="statement", description="Make a statement in your active case.")
     async def statement(self, ctx: discord.ApplicationContext, statement: str):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if not case.canSubmitMotions(ctx.author):
@@ -146,14 +153,14 @@ class Justice(commands.Cog):
 
     @case.command(name="info", description="Get information about a case.")
     async def case_info(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
     
         await cmui.caseInfoView(ctx, case)
     @case.command(name="vote", description="Vote on a motion in your active case.")
     async def case_vote(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if case.motion_in_consideration is None:
@@ -179,7 +186,7 @@ class Justice(commands.Cog):
         
     @case.command(name="withdraw", description="Used for the Prosecutor to withdraw a case.")
     async def case_withdraw(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
 
@@ -194,7 +201,7 @@ class Justice(commands.Cog):
     @case.command(name='eventlog', description='View the event log for your active case.')
     @option("reverse", bool, description="Whether to reverse the order of the event log.", default=False)
     async def case_eventlog(self, ctx: discord.ApplicationContext, reverse:bool = False):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         
@@ -217,7 +224,7 @@ class Justice(commands.Cog):
     @option("ephemeral", bool, description="Whether to make the message ephemeral", default=True)
     @option("admin", bool, description="Whether to include admin-only information.", default=False)
     async def case_dump(self, ctx: discord.ApplicationContext, ephemeral: bool = True, admin: bool = False):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
     
@@ -239,11 +246,42 @@ class Justice(commands.Cog):
 
         await response.edit_original_response(content=f"Case {case} ({case.id}) dumped in {seconds} seconds.", file=file)
 
+    archive = case.create_subgroup("archive", "Commands for looking up closed and archived cases.")
+
+    @archive.command(name="search", description="Search archived cases by ID, title or description.")
+    @option("query", str, description="Text to search for.")
+    async def archive_search(self, ctx: discord.ApplicationContext, query: str):
+        await ctx.interaction.response.defer(ephemeral=True)
+        results = await cm.searchArchivedCases(query)
+        if not results:
+            return await ctx.respond("No archived cases found.", ephemeral=True)
+
+        embed = discord.Embed(title="Archived Cases", description=f"Results for `{query}`")
+        for result in results:
+            closed = discord_dynamic_timestamp(result["closed"], "F") if result.get("closed") else "Unknown"
+            embed.add_field(name=f"{result['title']} ({result['_id']})", value=f"{result['status']}\nClosed: {closed}", inline=False)
+        await ctx.respond(embed=embed, ephemeral=True)
+
+    @archive.command(name="dump", description="Get the final zip of an archived case.")
+    @option("case_id", str, description="The ID of the archived case.")
+    @option("admin", bool, description="Whether to include admin-only information.", default=False)
+    async def archive_dump(self, ctx: discord.ApplicationContext, case_id: str, admin: bool = False):
+        if admin and not ctx.author.guild_permissions.administrator:
+            return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
+
+        await ctx.interaction.response.defer(ephemeral=True)
+        zip_file = await cm.getArchivedZip(case_id, admin)
+        if zip_file is None:
+            return await ctx.respond("Archived case not found.", ephemeral=True)
+
+        zip_name = f"{case_id} (Admin).zip" if admin else f"{case_id}.zip"
+        await ctx.respond(file=discord.File(zip_file, zip_name), ephemeral=True)
+
     move = case.create_subgroup("move", "Commands for basic case motions and management.")
 
     @move.command(name="statement", description="Move to have the court issue an official statement.")
     async def statement_motion(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if not case.canSubmitMotions(ctx.author):
@@ -270,7 +308,7 @@ class Justice(commands.Cog):
 
     @move.command(name="order", description="Move to have the court issue a binding order.")
     async def order_motion(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if not case.canSubmitMotions(ctx.author):
@@ -297,7 +335,7 @@ class Justice(commands.Cog):
 
     @evidence.command(name="upload", description="Upload a file as evidence to your active case.")
     async def evidence_upload(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if not case.canSubmitMotions(ctx.author):
@@ -319,47 +357,54 @@ class Justice(commands.Cog):
             return await ctx.respond("You can only upload one file.", ephemeral=True)
         
         file = file_message.attachments[0]
-        if file.size > 8388608*4:
+        if file.size > MAX_EVIDENCE_SIZE:
             return await ctx.respond("File size must be less than 32MB.", ephemeral=True)
         
         # give upload progress regularly 
         
-        msg = await ctx.respond(f"Processing file {file.filename}...", ephemeral=True)
-
-        file_bytes = await file.read()
+        msg = await ctx.respond(f"Uploading file {file.filename}...", ephemeral=True)
 
-        await msg.edit(content=f"Uploading file {file.filename}...", embed=None)
+        last_update = time.time()
+        async def progress(uploaded: int):
+            nonlocal last_update
+            if time.time() - last_update < 2:  # don't get rate limited editing the message
+                return
+            last_update = time.time()
+            await msg.edit(content=f"Uploading file {file.filename}... {round(uploaded / file.size * 100)}% ({uploaded}/{file.size} bytes)")
 
-        new_evidence = await case.newEvidence(ctx.author, file.filename, file_bytes)
+        # streamed straight from discord's cdn into gridfs, the size is checked again as it comes in
+        stream = cm.streamAttachment(file)
+        try:
+            new_evidence = await case.newEvidence(ctx.author, file.filename, stream, MAX_EVIDENCE_SIZE, progress)
+        except gridfs.FileTooLarge:
+            return await msg.edit(content="File size must be less than 32MB.")
+        except Exception as e:
+            log("Case", "evidence", f"Uploading {file.filename} to case {case.id} failed: {type(e).__name__}: {e}", level="error")
+            return await msg.edit(content=f"Uploading file {file.filename} failed, please try again.")
+        finally:
+            await stream.aclose()
         new_evidence.alt_text = alt_text
         await case.Save()
 
         await msg.edit(f"Uploaded evidence **{new_evidence.filename}** (`{new_evidence.id}`) to case **{case}** (`{case.id}`)")
 
     async def evidence_options(ctx: discord.AutocompleteContext):
-        case = getActiveCase(ctx.interaction.user)
- 
-        if case is None:     
-            pool = []   
-            for case in cm.ACTIVECASES:
-                pool.extend(case.evidence)
-            # sort based on 'created' attribute
-            pool.sort(key=lambda e: e.created, reverse=True)
-            return [f"{evidence.filename}: {evidence.id}" for evidence in pool]
-        else:
-            return [f"{evidence.filename}: {evidence.id}" for evidence in sorted(case.evidence, key = lambda e: e.created, reverse=True)]
+        # scoped to the user's active case if they have one, newest first
+        case = cm.getCaseByID(case_selection.get(ctx.interaction.user.id, None))
+        return autocomplete.EVIDENCE.search(ctx.value, scope=case.id if case else None)
 
     @evidence.command(name="view", description="View a piece of evidence in your active case.")
-    @option("evidence_id", str, description="The ID of the evidence to view.", autocomplete=discord.utils.basic_autocomplete(evidence_options))
+    @option("evidence_id", str, description="The ID of the evidence to view.", autocomplete=evidence_options)
     @option("ephemeral", bool, description="Whether to send the evidence privately.", default=True)
-    async def evidence_view(self, ctx: discord.ApplicationContext, evidence_id: str, ephemeral: bool = True):
+    @option("original", bool, description="Send the full original file instead of a preview.", default=False)
+    async def evidence_view(self, ctx: discord.ApplicationContext, evidence_id: str, ephemeral: bool = True, original: bool = False):
         if ":" in evidence_id:
             evidence_id = evidence_id.split(" ")[-1]
         
         case: cm.Case
         file: cm.Evidence
 
-        case, file = cm.getEvidenceByIDGlobal(evidence_id)
+        case, file = await cm.fetchEvidenceByIDGlobal(evidence_id)
         if file is None:
             return await ctx.respond("Invalid evidence ID.", ephemeral=True)
         
@@ -369,8 +414,7 @@ class Justice(commands.Cog):
         
         response = await ctx.respond(f"Loading evidence...", ephemeral=ephemeral)
     
-        file_name, file_bytes = await file.getRawFile()
-        embed = discord.Embed(title=f"Viewing Evidence: {file_name}", description=f"**{case}** (`{case.id}`)")
+        embed = discord.Embed(title=f"Viewing Evidence: {file.filename}", description=f"**{case}** (`{case.id}`)")
         embed.add_field(name="Evidence ID", value=file.id, inline=False)
         embed.add_field(name="Evidence Filename", value=file.filename, inline=False)
         if file.alt_text:
@@ -378,16 +422,36 @@ class Justice(commands.Cog):
         embed.add_field(name="Filed By", value=case.nameUserByID(file.author), inline=False)
         embed.add_field(name="Filed On", value=discord_dynamic_timestamp(file.created, 'FR'), inline=False)
 
+        if file.preview is None:
+            if not case.archived:  # evidence from before previews existed, it'll have one next time
+                cm.queuePreview(case.id, file)
+        elif not original:
+            # show the preview right away, the full file is only downloaded if it's asked for
+            embed.add_field(name="File", value=file.describePreview(), inline=False)
+            embed.set_footer(text="Set original to True to get the full file.")
+            sidecar = await file.getPreviewFile()
+            if sidecar is None:
+                return await ctx.interaction.edit_original_response(content=None, embed=embed)
+            if file.preview["kind"] == "image":
+                embed.set_image(url="attachment://thumbnail.png")
+                return await ctx.interaction.edit_original_response(content=None, embed=embed, file=discord.File(sidecar["file"], "thumbnail.png"))
+            excerpt = sidecar["file"].read().decode("utf-8", "replace").replace("```", "`\u200b``")
+            excerpt = excerpt[:1024 - len("```\n\n```")]  # escaping makes it longer, fields take 1024 characters
+            embed.add_field(name="Preview", value=f"```\n{excerpt}\n```", inline=False)
+            return await ctx.interaction.edit_original_response(content=None, embed=embed)
+
+        file_name, file_bytes = await file.getRawFile()
         await ctx.interaction.edit_original_response(content=None, embed=embed, file=discord.File(file_bytes, file_name))
 
     jury = discord.SlashCommandGroup("jury", "Jury commands")
     
     async def juror_case_options(ctx: discord.AutocompleteContext):
-        return [f"{case}: {case.id}" for case in cm.ACTIVECASES if case.stage == 1 and ctx.interaction.user.id in case.jury_invites]
+        user_id = ctx.interaction.user.id
+        return autocomplete.CASES.search(ctx.value, predicate=lambda case: case.stage == 1 and user_id in case.jury_invites)
 
     @jury.command(name="join", description="Join an active case as a juror.")
-    async def jury_join(self, ctx: discord.ApplicationContext, case_id: discord.Option(str, autocomplete=discord.utils.basic_autocomplete(juror_case_options))):
-        case = cm.getCaseByID(case_id.split(" ")[-1])
+    async def jury_join(self, ctx: discord.ApplicationContext, case_id: discord.Option(str, autocomplete=juror_case_options)):
+        case = await cm.fetchCaseByID(case_id.split(" ")[-1])
         if case is None:
             return await ctx.respond("Invalid case ID.", ephemeral=True)
         if ctx.author.id not in case.jury_invites:
@@ -406,7 +470,7 @@ class Justice(commands.Cog):
     
     @jury.command(name="say", description="Say something privately to the other jurors.")
     async def jury_say(self, ctx: discord.ApplicationContext, message: str):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         if ctx.author.id not in case.jury_pool_ids:
@@ -421,7 +485,7 @@ class Justice(commands.Cog):
     @dbg.command(name='juryinvite', description='Invite a user to a case as a juror.')
     @option("member", discord.Member, description="The member to invite as a juror.")
     async def jury_invite(self, ctx: discord.ApplicationContext, member: discord.Member):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         if case is None:
@@ -441,7 +505,7 @@ class Justice(commands.Cog):
     @dbg.command(name='jurykick', description='Kick a juror from a case.')
     @option("member", discord.Member, description="The member to kick from the case.")
     async def jury_kick(self, ctx: discord.ApplicationContext, member: discord.Member):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         if case is None:
@@ -456,7 +520,7 @@ class Justice(commands.Cog):
     @dbg.command(name='changeprosecutor', description='Change the prosecutor of a case.')
     @option("member", discord.Member, description="The member to appoint as the prosecutor.")
     async def change_prosecutor(self, ctx: discord.ApplicationContext, member: discord.Member):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         if case is None:
@@ -480,7 +544,7 @@ class Justice(commands.Cog):
     @dbg.command(name='stuffvotes', description='Load a motion up with votes.')
     @option("passmotion", bool, description="True - Pass : False - Reject")
     async def stuffvotes(self, ctx: discord.ApplicationContext, passmotion: bool):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         if case is None:
@@ -511,7 +575,9 @@ class Justice(commands.Cog):
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         
-        for c in cm.ACTIVECASES:
+        for c in cm.ACTIVECASES.copy():
+            if not await c.hydrate():
+                continue
             await c.closeCase("Cases Wiped for Debugging")
             await c.deleteCase()
 
@@ -519,7 +585,7 @@ class Justice(commands.Cog):
 
     @dbg.command(name='viewtest', description="Test whatever view is being debugged right now.")
     async def view_test(self, ctx: discord.ApplicationContext):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("Invalid case ID.", ephemeral=True)
         
@@ -536,7 +602,7 @@ class Justice(commands.Cog):
     async def tick_case(self, ctx: discord.ApplicationContext):
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         await case.Tick()
@@ -546,7 +612,7 @@ class Justice(commands.Cog):
     async def adminstatement(self, ctx: discord.ApplicationContext):
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if case is None:
             return await ctx.respond("You do not have an active case.", ephemeral=True)
         
@@ -561,7 +627,7 @@ class Justice(commands.Cog):
     @option("member", discord.Member, description="The member to appoint as a juror.")
     @option("pseudonym", str, description="The pseudonym to use for the juror.", optional=True)
     async def appoint_juror(self, ctx: discord.ApplicationContext, member: discord.Member, pseudonym: Optional[str] = None):
-        case = getActiveCase(ctx.author)
+        case = await getActiveCase(ctx.author)
         if not ctx.author.guild_permissions.administrator:
             return await ctx.respond("You do not have permission to use this command.", ephemeral=True)
         if case is None:
@@ -619,8 +685,10 @@ class Justice(commands.Cog):
 
     @commands.Cog.listener()
     async def on_member_remove(self, member: discord.Member):
-        for case in cm.ACTIVECASES:
+        for case in cm.ACTIVECASES.copy():  # removing a juror can close the case and take it out of the list
             if member.id in case.jury_pool_ids:
+                if not await case.hydrate():
+                    continue
                 log("Case", "CaseManager", f"Removing Juror {utils.normalUsername(member)} from case {case.id} as they left the server.")
                 await case.removeJuror(member, "Juror left the server.")
         # for case in cm.ACTIVECASES:
@@ -634,8 +702,21 @@ class Justice(commands.Cog):
     @tasks.loop(minutes=15, reconnect=True)
     async def CaseManager(self):
         log("Case", "CaseManager", "Doing Periodic Case Manager Loop")
-        for case in cm.ACTIVECASES:
-            await case.Tick()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for case in cm.ACTIVECASES.copy():  # hydrate awaits, deletions and archives can land in between
+            if not case.needsTick(now):  # frozen cases, and lazily loaded ones with nothing due, stay unhydrated
+                continue
+            if await case.hydrate():
+                with cm.CASE_TICK_SECONDS.time():
+                    await case.Tick()
+        try:  # a failed archive pass shouldn't stop the loop, and case ticking with it
+            await cm.archiveClosedCases()
+        except Exception as e:
+            log("Case", "CaseManager", f"Archiving closed cases failed: {type(e).__name__}: {e}", level="error")
+        try:
+            await cm.reconcileGridFS()  # a few batches of the orphaned file sweep every loop
+        except Exception as e:
+            log("Case", "CaseManager", f"GridFS reconciliation failed: {type(e).__name__}: {e}", level="error")
         return
 
 def setup(bot):
@@ -0,0 +1,213 @@
+import bisect
+import time
+from typing import *
+
+from . import config
+
+"""
+Counters, gauges and histograms for the bot's hot paths, kept in memory and rendered in the Prometheus text format.
+Modules create their metrics at import time with counter() / gauge() / histogram() and update them as they go, all of
+that is just dict updates so it's fine on the event loop.
+Things that already keep their own numbers (the evidence cache, the role queue, ...) are hooked up with collect(), which
+is only called when someone asks for the metrics.
+If metrics.enabled is set in the config, serve() exposes them on http://<host>:<port>/metrics for a local scraper,
+/debug metrics shows them in discord either way.
+"""
+
+PREFIX = "stasi_"
+
+METRICS_DEFAULTS = {
+    "enabled": False,
+    "host": "127.0.0.1",  # keep it local, there's nothing in here for the outside world
+    "port": 9108,
+}
+
+def metricsConfig():
+    return {**METRICS_DEFAULTS, **(config.C.get("metrics", {}) or {})}
+
+def _labelKey(labelnames: Tuple[str, ...], labels: dict) -> Tuple[str, ...]:
+    return tuple(str(labels.get(name, "")) for name in labelnames)
+
+def _labelText(labelnames: Tuple[str, ...], key: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, key)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = ()):
+        self.name = PREFIX + name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.values: Dict[Tuple[str, ...], Any] = {}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labelText(self.labelnames, key)} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labelKey(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), fn: Callable[[], float] = None):
+        super().__init__(name, help, labels)
+        self.fn = fn  # read at render time instead of being set
+
+    def set(self, value: float, **labels):
+        self.values[_labelKey(self.labelnames, labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labelKey(self.labelnames, labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        if self.fn is not None:
+            try:
+                self.values[()] = self.fn()
+            except Exception:
+                pass
+        return super().render()
+
+# seconds, from a fast dict lookup to discord's 3 second interaction deadline and past it
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# bytes, for payload sizes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Iterable[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = _labelKey(self.labelnames, labels)
+        if key not in self.values:
+            self.values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+        series = self.values[key]
+        series["counts"][bisect.bisect_left(self.buckets, value)] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def time(self, **labels) -> "Timer":
+        # with histogram.time(command="case new"): ...
+        return Timer(self, labels)
+
+    def summary(self, **labels) -> Optional[dict]:
+        series = self.values.get(_labelKey(self.labelnames, labels))
+        if not series:
+            return None
+        return {"count": series["count"], "sum": series["sum"], "avg": series["sum"] / series["count"]}
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, series in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), series["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_labelText(self.labelnames, key, bucket)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labelText(self.labelnames, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_labelText(self.labelnames, key)} {series['count']}")
+        return lines
+
+class Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, **self.labels)
+        return False
+
+REGISTRY: Dict[str, Metric] = {}
+COLLECTORS: Dict[str, Callable[[], dict]] = {}
+
+def _register(metric: Metric) -> Metric:
+    # registering the same name twice hands back the first one, modules can be reloaded
+    return REGISTRY.setdefault(metric.name, metric)
+
+def counter(name: str, help: str, labels: Iterable[str] = ()) -> Counter:
+    return _register(Counter(name, help, labels))
+
+def gauge(name: str, help: str, labels: Iterable[str] = (), fn: Callable[[], float] = None) -> Gauge:
+    return _register(Gauge(name, help, labels, fn))
+
+def histogram(name: str, help: str, labels: Iterable[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help, labels, buckets))
+
+def collect(name: str, fn: Callable[[], dict]):
+    # fn returns a (possibly nested) dict of numbers, every number becomes a gauge named after its path
+    COLLECTORS[name] = fn
+
+def _flatten(value, path: Tuple[str, ...]) -> Iterator[Tuple[Tuple[str, ...], float]]:
+    if isinstance(value, dict):
+        for key, inner in value.items():
+            yield from _flatten(inner, path + (str(key),))
+    elif isinstance(value, bool):
+        yield path, int(value)
+    elif isinstance(value, (int, float)):
+        yield path, value
+
+def _metricName(text: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in text.lower()).strip("_")
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY.values():
+        lines.extend(metric.render())
+    for name, fn in COLLECTORS.items():
+        try:
+            values = list(_flatten(fn(), ()))
+        except Exception as e:
+            lines.append(f"# {name} failed: {type(e).__name__}")
+            continue
+        for path, value in values:
+            lines.append(f"{PREFIX}{_metricName(name)}_{_metricName('_'.join(path))} {value}")
+    return "\n".join(lines) + "\n"
+
+# metrics that don't belong to any one module
+
+COMMAND_SECONDS = histogram("command_seconds", "Application command wall time.", ["command"])
+COMMAND_ERRORS = counter("command_errors_total", "Application commands that failed with an unexpected error.", ["command"])
+DB_SECONDS = histogram("db_seconds", "MongoDB operation latency.", ["collection", "operation"])
+OPENAI_SECONDS = histogram("openai_seconds", "OpenAI request latency.", ["model"], buckets=(0.5, 1, 2.5, 5, 10, 20, 30, 60, 120))
+OPENAI_ERRORS = counter("openai_errors_total", "OpenAI requests that failed.", ["model"])
+OPENAI_RETRIES = counter("openai_retries_total", "OpenAI requests retried by the vetting interviewer.")
+
+SERVER = None
+
+async def serve():
+    # starts the scrape endpoint if it's enabled, only once
+    global SERVER
+    options = metricsConfig()
+    if SERVER is not None or not options["enabled"]:
+        return
+    from aiohttp import web
+
+    async def handler(request):
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8", headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handler)
+    SERVER = web.AppRunner(app, access_log=None)
+    await SERVER.setup()
+    await web.TCPSite(SERVER, options["host"], options["port"]).start()
@@ -0,0 +1,129 @@
+import contextlib
+import contextvars
+import time
+from collections import deque
+from typing import *
+
+import discord
+import discord.http
+import discord.webhook.async_
+
+from . import metrics
+
+"""
+Per command timing.
+The bot's before/after invoke hooks start and finish a CommandTiming for every application command, which is kept in a
+context variable so anything the command awaits can add to it: database.py adds the time spent in MongoDB, and the
+wrapped discord HTTP clients add the time spent talking to discord and notice the first response (respond or defer).
+Every finished command goes into the metrics histograms and into a rolling window per command that /debug perf reads
+its percentiles from.
+Discord drops an interaction that hasn't been responded to within 3 seconds, commands getting close to that are flagged.
+"""
+
+DEADLINE = 3.0
+WARN_AT = 0.75  # of the deadline, for the p95 time to first response
+WINDOW = 500  # most recent commands kept per command name
+
+COMMAND_FIRST_RESPONSE = metrics.histogram("command_first_response_seconds", "Time from invoking a command to its first response or defer.", ["command"])
+COMMAND_DB = metrics.histogram("command_db_seconds", "Time a command spent waiting on MongoDB.", ["command"])
+COMMAND_HTTP = metrics.histogram("command_http_seconds", "Time a command spent waiting on discord's API.", ["command"])
+DISCORD_HTTP = metrics.histogram("discord_http_seconds", "Discord API request latency.", ["method"])
+
+class CommandTiming:
+    def __init__(self, command: str):
+        self.command = command
+        self.started = time.perf_counter()
+        self.first_response: Optional[float] = None
+        self.db = 0.0
+        self.http = 0.0
+        self.finished: Optional[float] = None
+
+    def elapsed(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+CURRENT: contextvars.ContextVar[Optional[CommandTiming]] = contextvars.ContextVar("command_timing", default=None)
+WINDOWS: Dict[str, Deque[Tuple[float, Optional[float], float, float]]] = {}  # command -> (wall, first response, db, http)
+
+def begin(command: str) -> CommandTiming:
+    timing = CommandTiming(command)
+    CURRENT.set(timing)
+    return timing
+
+def end(timing: CommandTiming):
+    timing.finished = time.perf_counter()
+    wall = timing.elapsed()
+    metrics.COMMAND_SECONDS.observe(wall, command=timing.command)
+    if timing.first_response is not None:
+        COMMAND_FIRST_RESPONSE.observe(timing.first_response, command=timing.command)
+    COMMAND_DB.observe(timing.db, command=timing.command)
+    COMMAND_HTTP.observe(timing.http, command=timing.command)
+    WINDOWS.setdefault(timing.command, deque(maxlen=WINDOW)).append((wall, timing.first_response, timing.db, timing.http))
+
+def _running() -> Optional[CommandTiming]:
+    # tasks a command starts inherit its context, but shouldn't add to it once the command is done
+    timing = CURRENT.get()
+    if timing is not None and timing.finished is None:
+        return timing
+
+def addDB(seconds: float):
+    if timing := _running():
+        timing.db += seconds
+
+@contextlib.contextmanager
+def timeDB(collection: str, operation: str):
+    t = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t
+        metrics.DB_SECONDS.observe(elapsed, collection=collection, operation=operation)
+        addDB(elapsed)
+
+def _timeHTTP(request):
+    # wraps a discord http client's request() to time it, interaction callbacks are the command's first response
+    async def timed(self, route, *args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return await request(self, route, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - t
+            DISCORD_HTTP.observe(elapsed, method=route.method)
+            if timing := _running():
+                timing.http += elapsed
+                if timing.first_response is None and route.path.endswith("/callback"):
+                    timing.first_response = time.perf_counter() - timing.started
+    timed.__wrapped__ = request
+    return timed
+
+def instrumentDiscord():
+    # the bot's own client and the one interaction responses and followups go through, only once
+    for client in (discord.http.HTTPClient, discord.webhook.async_.AsyncWebhookAdapter):
+        if not hasattr(client.request, "__wrapped__"):
+            client.request = _timeHTTP(client.request)
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+def report() -> List[dict]:
+    # one entry per command, slowest p95 first
+    out = []
+    for command, window in WINDOWS.items():
+        walls = [sample[0] for sample in window]
+        firsts = [sample[1] for sample in window if sample[1] is not None]
+        first_p95 = percentile(firsts, 95)
+        out.append({
+            "command": command,
+            "count": len(window),
+            "p50": percentile(walls, 50),
+            "p95": percentile(walls, 95),
+            "p99": percentile(walls, 99),
+            "first_response_p95": first_p95,
+            "db_avg": sum(sample[2] for sample in window) / len(window),
+            "http_avg": sum(sample[3] for sample in window) / len(window),
+            # no response at all and still slow is just as bad, discord shows the interaction as failed either way
+            "at_risk": (first_p95 if first_p95 is not None else percentile(walls, 95)) >= DEADLINE * WARN_AT,
+        })
+    return sorted(out, key=lambda entry: -entry["p95"])
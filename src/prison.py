@@ -2,13 +2,15 @@ from typing import Optional
 
 import discord
 from discord import option, slash_command
-from discord.ext import commands, tasks, pages
+from discord.ext import commands, pages
 
+from . import autocomplete
 from . import database as db
 from . import config
+from . import rolequeue
 from . import utils
 from . import security
-from .stasilogging import log, log_user, discord_dynamic_timestamp
+from .stasilogging import log, log_user
 from . import warden
 
 import datetime
@@ -19,7 +21,6 @@ class Prison(commands.Cog):
 
     def __init__(self, bot):
         self.bot = bot
-        self.prisoner_loop.start()
 
     warrant = discord.SlashCommandGroup("warrant", "Warrant management commands.")
 
@@ -253,13 +254,16 @@ class Prison(commands.Cog):
     
     admin = warrant.create_subgroup(name='admin', description='Admin warrant commands.')
 
+    async def warrant_options(ctx: discord.AutocompleteContext):
+        return autocomplete.WARRANTS.search(ctx.value)
+
     @admin.command(name='void', description='Void a warrant.')
-    @option(name='warrant', description='The warrant to void.', type=str, required=True)
+    @option(name='warrant', description='The warrant to void.', type=str, required=True, autocomplete=warrant_options)
     async def void_warrant(self, ctx: discord.ApplicationContext, warrant: str):
         if not ctx.author.guild_permissions.manage_roles:
             await ctx.respond("You do not have permission to void warrants.", ephemeral=True)
             return
-        warrant = warden.getWarrantByID(warrant)
+        warrant = warden.getWarrantByID(warrant.split(" ")[-1])
         if not warrant:
             await ctx.respond(f"Warrant {warrant} not found.", ephemeral=True)
             return
@@ -270,7 +274,8 @@ class Prison(commands.Cog):
 
     @admin.command(name='voiduser', description='Void all warrants for a user.')
     @option(name='user', description='The user to void warrants for.', type=discord.Member, required=True)
-    async def void_user(self, ctx: discord.ApplicationContext, user: discord.Member):
+    @option(name='category', description='Only void warrants in this category.', type=str, required=False)
+    async def void_user(self, ctx: discord.ApplicationContext, user: discord.Member, category: str = None):
         if not ctx.author.guild_permissions.manage_roles:
             await ctx.respond("You do not have permission to void warrants.", ephemeral=True)
             return
@@ -278,21 +283,42 @@ class Prison(commands.Cog):
         if not prisoner:
             await ctx.respond(f"{utils.normalUsername(user)} is not a prisoner.", ephemeral=True)
             return
-        count = len(prisoner.warrants)
 
-        prisoner.warrants = []
+        embeds = await warden.voidWarrantsByPrisoner(user.id, category, f"Voided by {utils.normalUsername(ctx.author)}")
+        if not embeds:
+            await ctx.respond(f"{utils.normalUsername(user)} has no {category + ' ' if category else ''}warrants.", ephemeral=True)
+            return
 
-        log("justice", "warrant", f"All warrants voided by {utils.normalUsername(ctx.author)}: {prisoner.prisoner_name} ({count})")
-        embed = discord.Embed(title="Warrants Voided", description=f"All ({count}) warrants for {utils.normalUsername(user)} have been voided.", color=0x000000)
-        embed.add_field(name="Voided By", value=utils.normalUsername(ctx.author), inline=False)
-        embed.add_field(name="Voided At", value=discord_dynamic_timestamp(datetime.datetime.utcnow()), inline=False)
-        embed.add_field(name="Initially Committed At", value=discord_dynamic_timestamp(prisoner.committed), inline=False)
-        embed.add_field(name="Total Time Served", value=utils.seconds_to_time_long(prisoner.total_time_served()), inline=False)
-        embed.add_field(name="Total Time Remaining", value=utils.seconds_to_time_long(prisoner.total_time_remaining()), inline=False)
-        embed.set_author(name=prisoner.prisoner_name, icon_url=utils.twemojiPNG.ticket)
-        await prisoner.communicate(embed=embed)
+        log("justice", "warrant", f"Warrants voided by {utils.normalUsername(ctx.author)}: {prisoner.prisoner_name} (category: {category})")
+        await ctx.respond(embed=embeds[prisoner], ephemeral=True)
 
-        await prisoner.Tick()
+    @admin.command(name='voidbulk', description='Void every warrant matching all of the given filters.')
+    @option(name='category', description='Warrants in this category.', type=str, required=False)
+    @option(name='author', description='Warrants issued by this user.', type=discord.Member, required=False)
+    @option(name='older_than_days', description='Warrants issued more than this many days ago.', type=int, required=False)
+    async def void_bulk(self, ctx: discord.ApplicationContext, category: str = None, author: discord.Member = None, older_than_days: int = None):
+        if not ctx.author.guild_permissions.administrator:
+            await ctx.respond("You do not have permission to bulk void warrants.", ephemeral=True)
+            return
+        if category is None and author is None and older_than_days is None:
+            await ctx.respond("Give at least one filter, use voiduser to void a single user's warrants.", ephemeral=True)
+            return
+
+        created_before = None
+        if older_than_days is not None:
+            created_before = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=older_than_days)
+        warrants = warden.findWarrants(category=category, author=author.id if author else None, created_before=created_before)
+        if not warrants:
+            await ctx.respond("No warrants match.", ephemeral=True)
+            return
+
+        await ctx.defer(ephemeral=True)
+        embeds = await warden.voidWarrants(warrants, f"Voided by {utils.normalUsername(ctx.author)}")
+        log("justice", "warrant", f"{len(warrants)} warrants for {len(embeds)} prisoners voided by {utils.normalUsername(ctx.author)} (category: {category}, author: {author.id if author else None}, older than {older_than_days} days)")
+
+        embed = discord.Embed(title="Warrants Voided", description=f"Voided {len(warrants)} warrants for {len(embeds)} prisoners.", color=0x000000)
+        embed.add_field(name="Prisoners", value=", ".join(prisoner.prisoner_name for prisoner in embeds)[:1024] or "None", inline=False)
+        embed.set_author(name="Prison", icon_url=utils.twemojiPNG.ticket)
         await ctx.respond(embed=embed, ephemeral=True)
 
     @admin.command(name='tick', description='Create a warrant tick event.')
@@ -315,11 +341,11 @@ class Prison(commands.Cog):
         user = await db.get_user(member.id)
         if "roles" in user:
             roles = [member.guild.get_role(role) for role in user["roles"]]
-            await member.edit(roles=roles)
+            rolequeue.editRoles(member, roles, "Restoring roles")
 
         elif user == {}:
             unverified_role = member.guild.get_role(config.C["unverified_role"])
-            await member.edit(roles=[unverified_role])
+            rolequeue.editRoles(member, [unverified_role], "New member")
 
     @commands.Cog.listener()
     async def on_member_ban(self, guild, user):
@@ -338,13 +364,7 @@ class Prison(commands.Cog):
     @commands.Cog.listener()
     async def on_ready(self):
         await warden.populatePrisoners(self.bot.get_guild(config.C["guild_id"]))
-                
-
-    @tasks.loop(minutes=1, reconnect=True)
-    async def prisoner_loop(self):
-        log("justice", "loop", "Running prisoner loop", False)
-        for prisoner in warden.PRISONERS:
-            await prisoner.Tick()
+        await warden.SCHEDULER.start()  # ticks prisoners as their warrants expire, instead of all of them every minute
 
 def setup(bot):
     bot.add_cog(Prison(bot))
@@ -0,0 +1,406 @@
+import asyncio
+import datetime
+import gc
+import os
+import sys
+import sysconfig
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from typing import *
+
+from . import config
+from . import metrics
+from . import stasilogging
+from . import utils
+from .stasilogging import log
+
+"""
+On demand profiling for when the bot gets slow in production.
+The CPU profiler is a sampler: a thread looks at the event loop thread's current stack every few milliseconds and counts
+what it sees, so the loop itself isn't slowed down the way cProfile would slow it down. Only one session runs at a time.
+Results go to logs/profiles/, a collapsed stack file (one "frame;frame;frame count" line per stack, which flamegraph.pl
+and speedscope read) and a text report of the functions that showed up the most.
+"""
+
+IDLE_FUNCTIONS = {"select", "poll", "epoll", "_run_once"}  # at the top of the stack when the loop is waiting on nothing
+
+STDLIB = sysconfig.get_paths()["stdlib"]
+
+class ProfileBusy(Exception):
+    pass
+
+SESSION_LOCK = threading.Lock()
+
+def profileDirectory() -> str:
+    return os.path.join(stasilogging.logConfig()["directory"], "profiles")
+
+def _frameName(code) -> str:
+    return f"{code.co_name} ({_shortPath(code.co_filename)}:{code.co_firstlineno})"
+
+def _shortPath(path: str) -> str:
+    # the bot's own files relative to the repo, libraries relative to site-packages or the standard library
+    if "site-packages" + os.sep in path:
+        return path.split("site-packages" + os.sep, 1)[1]
+    if path.startswith(STDLIB):
+        return path[len(STDLIB):].lstrip(os.sep)
+    try:
+        return os.path.relpath(path)
+    except ValueError:
+        return path
+
+class CPUProfile:
+    def __init__(self, thread_id: int, seconds: float, interval: float):
+        self.thread_id = thread_id
+        self.seconds = seconds
+        self.interval = interval
+        self.stacks: Counter = Counter()  # tuple of frame names, outermost first -> samples
+        self.samples = 0
+        self.idle = 0
+        self.started = datetime.datetime.now()
+        self.path: Optional[str] = None  # where save() put it, without the extension
+
+    def run(self):
+        # runs in its own thread, sys._current_frames is cheap enough to call a few hundred times a second
+        end = time.monotonic() + self.seconds
+        while time.monotonic() < end:
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is not None:
+                stack = []
+                while frame is not None:
+                    stack.append(_frameName(frame.f_code))
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[tuple(stack)] += 1
+                self.samples += 1
+                if stack[-1].split(" ", 1)[0] in IDLE_FUNCTIONS:
+                    self.idle += 1
+            time.sleep(self.interval)
+
+    def topFunctions(self, n: int = 20) -> List[Tuple[str, int, int]]:
+        # (function, samples it was running in, samples it was anywhere on the stack), busiest first
+        own, total = Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            for name in set(stack):
+                total[name] += count
+        return [(name, samples, total[name]) for name, samples in own.most_common(n)]
+
+    def collapsed(self) -> str:
+        return "".join(f"{';'.join(stack)} {count}\n" for stack, count in self.stacks.most_common())
+
+    def report(self, n: int = 40) -> str:
+        lines = [
+            f"CPU profile started {self.started:%Y-%m-%d %H:%M:%S}, {self.seconds}s at {round(self.interval * 1000, 1)}ms",
+            f"{self.samples} samples, {self.idle} idle ({round(self.idle / max(self.samples, 1) * 100, 1)}%)",
+            "",
+            f"{'own':>7} {'total':>7}  function",
+        ]
+        for name, own, total in self.topFunctions(n):
+            lines.append(f"{own / max(self.samples, 1):>7.1%} {total / max(self.samples, 1):>7.1%}  {name}")
+        return "\n".join(lines) + "\n"
+
+    def save(self) -> Tuple[str, str]:
+        directory = profileDirectory()
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"cpu-{self.started:%Y%m%d-%H%M%S}")
+        with open(f"{self.path}.collapsed", "w", encoding="utf-8") as f:
+            f.write(self.collapsed())
+        with open(f"{self.path}.txt", "w", encoding="utf-8") as f:
+            f.write(self.report())
+        return f"{self.path}.collapsed", f"{self.path}.txt"
+
+async def profileCPU(seconds: float, interval: float = 0.005) -> CPUProfile:
+    # samples the thread this is called from (the event loop's) for seconds, raises ProfileBusy if one is already running
+    if not SESSION_LOCK.acquire(blocking=False):
+        raise ProfileBusy("A profile is already running.")
+    try:
+        profile = CPUProfile(threading.get_ident(), seconds, interval)
+        log("admin", "profile", f"CPU profile started for {seconds}s")
+        await utils.inThread(profile.run)
+        await utils.inThread(profile.save)
+        log("admin", "profile", f"CPU profile finished, {profile.samples} samples written to {profile.path}")
+        return profile
+    finally:
+        SESSION_LOCK.release()
+
+"""
+Memory snapshots.
+tracemalloc records where every allocation came from, which costs memory and some speed, so it's only on between
+startTracing() and stopTracing(). The first snapshot after starting is the baseline, later ones are diffed against it
+and against the one before to show what's growing.
+Object counts of the bot's own classes (Case, Motion, Prisoner, Warrant, ...) and the sizes of the structures modules
+watch() come from gc and work without tracing.
+"""
+
+MEMORY_FRAMES = 10  # frames kept per allocation, more is more precise and more expensive
+MAX_SNAPSHOTS = 6  # the baseline and the most recent ones after it
+BOT_PACKAGE = __name__.rsplit(".", 1)[0]
+
+TRACE_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+    tracemalloc.Filter(False, "<unknown>"),
+]
+
+MEMORY_LOCK = threading.Lock()
+WATCHED: Dict[str, Callable[[], int]] = {}
+
+def watch(name: str, fn: Callable[[], int]):
+    # fn returns how big something long lived is (entries, events, ...), shown with every memory snapshot
+    WATCHED[name] = fn
+
+class MemorySnapshot:
+    def __init__(self, snapshot: Optional[tracemalloc.Snapshot], types: Counter, sizes: Dict[str, Optional[int]]):
+        self.taken = datetime.datetime.now()
+        self.snapshot = snapshot  # None when tracing was off
+        self.types = types
+        self.sizes = sizes
+        self.traced, self.peak = tracemalloc.get_traced_memory() if snapshot else (None, None)
+
+SNAPSHOTS: List[MemorySnapshot] = []
+
+def botTypeCounts() -> Counter:
+    # instances of classes defined in the bot's own modules, by class name
+    counts = Counter()
+    for obj in gc.get_objects():
+        cls = type(obj)
+        module = cls.__dict__.get("__module__")  # not getattr, on type itself that's a descriptor
+        if not isinstance(module, str):
+            continue
+        if module == BOT_PACKAGE or module.startswith(BOT_PACKAGE + "."):
+            counts[cls.__qualname__] += 1
+    return counts
+
+def watchedSizes() -> Dict[str, Optional[int]]:
+    sizes = {}
+    for name, fn in WATCHED.items():
+        try:
+            sizes[name] = fn()
+        except Exception:
+            sizes[name] = None
+    return sizes
+
+def isTracing() -> bool:
+    return tracemalloc.is_tracing()
+
+async def startTracing() -> MemorySnapshot:
+    if not isTracing():
+        tracemalloc.start(MEMORY_FRAMES)
+        log("admin", "memory", f"Started tracing allocations ({MEMORY_FRAMES} frames)")
+    SNAPSHOTS.clear()
+    return await takeSnapshot()
+
+def stopTracing():
+    tracemalloc.stop()
+    SNAPSHOTS.clear()
+    log("admin", "memory", "Stopped tracing allocations")
+
+async def takeSnapshot() -> MemorySnapshot:
+    # raises ProfileBusy if another snapshot is being taken, both of them walk the whole heap
+    if not MEMORY_LOCK.acquire(blocking=False):
+        raise ProfileBusy("A memory snapshot is already being taken.")
+    try:
+        def take():
+            snapshot = tracemalloc.take_snapshot().filter_traces(TRACE_FILTERS) if isTracing() else None
+            return snapshot, botTypeCounts()
+        snapshot, types = await utils.inThread(take)
+        current = MemorySnapshot(snapshot, types, watchedSizes())
+        SNAPSHOTS.append(current)
+        if len(SNAPSHOTS) > MAX_SNAPSHOTS:
+            del SNAPSHOTS[1]
+        return current
+    finally:
+        MEMORY_LOCK.release()
+
+def _size(n: float) -> str:
+    for unit in ("B", "KiB", "MiB"):
+        if abs(n) < 1024:
+            return f"{round(n, 1):g} {unit}"
+        n /= 1024
+    return f"{round(n, 1):g} GiB"
+
+def _site(statistic) -> str:
+    frame = statistic.traceback[0]
+    return f"{_shortPath(frame.filename)}:{frame.lineno}"
+
+def _delta(now: Optional[int], before: Optional[int]) -> str:
+    if now is None or before is None or now == before:
+        return ""
+    return f" ({now - before:+})"
+
+def memoryReport(top: int = 10) -> Dict[str, List[str]]:
+    # sections of lines for the latest snapshot, diffed against the one before it and the baseline
+    current = SNAPSHOTS[-1]
+    previous = SNAPSHOTS[-2] if len(SNAPSHOTS) > 1 else None
+    baseline = SNAPSHOTS[0] if len(SNAPSHOTS) > 2 else None
+    sections = {}
+
+    if current.snapshot:
+        sections["Traced"] = [f"{_size(current.traced)} now, {_size(current.peak)} peak"]
+        sections["Top allocation sites"] = [
+            f"{_size(stat.size):>10} {stat.count:>8}  {_site(stat)}"
+            for stat in current.snapshot.statistics("lineno")[:top]
+        ]
+        for title, before in (("Growth since last snapshot", previous), ("Growth since baseline", baseline)):
+            if before and before.snapshot:
+                diff = [stat for stat in current.snapshot.compare_to(before.snapshot, "lineno") if stat.size_diff > 0]
+                sections[f"{title} ({before.taken:%H:%M:%S})"] = [
+                    f"{'+' + _size(stat.size_diff):>10} {stat.count_diff:>+8}  {_site(stat)}" for stat in diff[:top]
+                ]
+
+    before = previous.types if previous else {}
+    sections["Bot objects"] = [
+        f"{count:>8}{_delta(count, before.get(name, 0) if previous else None)}  {name}"
+        for name, count in current.types.most_common(top * 2)
+    ]
+    sections["Watched"] = [
+        f"{size if size is not None else '?':>8}{_delta(size, previous.sizes.get(name) if previous else None)}  {name}"
+        for name, size in current.sizes.items()
+    ]
+    return sections
+
+def memoryReportText(top: int = 25) -> str:
+    current = SNAPSHOTS[-1]
+    lines = [f"Memory snapshot {current.taken:%Y-%m-%d %H:%M:%S}, {len(SNAPSHOTS)} kept, tracing {'on' if current.snapshot else 'off'}"]
+    for title, section in memoryReport(top).items():
+        lines += ["", title] + (section or ["nothing"])
+    return "\n".join(lines) + "\n"
+
+def dumpSnapshot() -> str:
+    # the report and, when tracing, the raw snapshot, which tracemalloc.Snapshot.load() reads back for offline digging
+    current = SNAPSHOTS[-1]
+    directory = profileDirectory()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"memory-{current.taken:%Y%m%d-%H%M%S}")
+    with open(f"{path}.txt", "w", encoding="utf-8") as f:
+        f.write(memoryReportText())
+    if current.snapshot:
+        current.snapshot.dump(f"{path}.tracemalloc")
+    return path
+
+"""
+Event loop watchdog.
+A heartbeat task sleeps for a fixed interval and measures how late it wakes up, that's the loop's lag and it goes into
+the loop_lag_seconds histogram. A thread watches the heartbeat, and when it's overdue by more than the threshold the loop
+is stuck in something synchronous right now, so the thread grabs the loop thread's stack while it's still in there.
+Once the loop gets going again the heartbeat logs how long it was blocked together with that stack and counts it in
+loop_blocked_total under the innermost frame in the bot's own code, which is usually the call to fix.
+"""
+
+WATCHDOG_DEFAULTS = {
+    "enabled": True,
+    "interval": 0.5,  # seconds between heartbeats
+    "threshold": 0.25,  # lag that counts as the loop having been blocked
+    "stack_every": 300,  # seconds before the full stack is logged again for the same site
+    "stuck_after": 30,  # blocked this long, log the stack from the thread without waiting for the loop
+}
+
+def watchdogConfig():
+    return {**WATCHDOG_DEFAULTS, **(config.C.get("loop_watchdog", {}) or {})}
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOOP_LAG = metrics.histogram("loop_lag_seconds", "How late the event loop heartbeat woke up.", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+LOOP_BLOCKED = metrics.counter("loop_blocked_total", "Times the event loop was blocked past the watchdog threshold.", ["site"])
+
+def _isBotFrame(filename: str) -> bool:
+    return filename.startswith(REPO_ROOT) and "site-packages" not in filename
+
+def blockingSite(stack: traceback.StackSummary) -> str:
+    # innermost frame in the bot's own code, or the innermost frame at all if the loop was somewhere else entirely
+    for frame in reversed(stack):
+        if _isBotFrame(frame.filename):
+            break
+    else:
+        if not stack:
+            return "unknown"
+        frame = stack[-1]
+    return f"{frame.name} ({_shortPath(frame.filename)}:{frame.lineno})"
+
+class LoopWatchdog:
+    def __init__(self):
+        self.options = watchdogConfig()
+        self.thread_id = threading.get_ident()
+        self.beat = time.monotonic()  # when the heartbeat should wake up next, written by the loop and read by the thread
+        self.stack: Optional[traceback.StackSummary] = None
+        self.captured_for: Optional[float] = None  # the beat self.stack was captured during
+        self.stuck_logged: Optional[float] = None
+        self.logged: Dict[str, float] = {}  # site -> when its stack was last logged
+        self.blocks = 0
+        self.max_lag = 0.0
+        self.task = asyncio.create_task(self.heartbeat())
+        self.thread = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+
+    async def heartbeat(self):
+        interval = self.options["interval"]
+        while True:
+            expected = self.beat = time.monotonic() + interval
+            await asyncio.sleep(interval)
+            lag = max(0.0, time.monotonic() - expected)
+            LOOP_LAG.observe(lag)
+            if lag >= self.options["threshold"]:
+                self.blocked(lag, self.stack if self.captured_for == expected else None)
+
+    def blocked(self, lag: float, stack: Optional[traceback.StackSummary]):
+        self.blocks += 1
+        self.max_lag = max(self.max_lag, lag)
+        site = blockingSite(stack) if stack else "unknown"
+        LOOP_BLOCKED.inc(site=site)
+        now = time.monotonic()
+        if stack and now - self.logged.get(site, -self.options["stack_every"]) >= self.options["stack_every"]:
+            self.logged[site] = now
+            text = "".join(stack.format())
+            log("loop", "watchdog", f"Event loop blocked for {round(lag, 3)}s in {site}:\n{text}", preserve_newlines=True, level="warning", lag=lag, site=site)
+        else:
+            log("loop", "watchdog", f"Event loop blocked for {round(lag, 3)}s in {site}", level="warning", lag=lag, site=site)
+
+    def capture(self) -> Optional[traceback.StackSummary]:
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return None
+        stack = traceback.extract_stack(frame)
+        # everything above the callback the loop is running is the same asyncio plumbing every time
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i].name == "_run" and stack[i].filename.endswith(os.path.join("asyncio", "events.py")):
+                return traceback.StackSummary.from_list(stack[i + 1:])
+        return stack
+
+    def watch(self):
+        # the thread, wakes up a few times per threshold so the stack is caught while the loop is still stuck
+        options = self.options
+        while not self.task.done():
+            time.sleep(min(options["threshold"], options["interval"]) / 4)
+            beat = self.beat
+            overdue = time.monotonic() - beat
+            if overdue < options["threshold"] / 2:  # a bit early, or short blocks would slip through between checks
+                continue
+            if self.captured_for != beat:
+                self.stack = self.capture()
+                self.captured_for = beat
+            if overdue >= options["stuck_after"] and self.stuck_logged != beat and self.stack:
+                self.stuck_logged = beat
+                text = "".join(self.stack.format())
+                log("loop", "watchdog", f"Event loop has been blocked for {round(overdue, 1)}s in {blockingSite(self.stack)}:\n{text}", preserve_newlines=True, level="error")
+
+    def stats(self) -> dict:
+        return {"blocks": self.blocks, "max_lag_seconds": round(self.max_lag, 4), "sites": len(self.logged)}
+
+WATCHDOG: Optional[LoopWatchdog] = None
+
+def startWatchdog() -> Optional[LoopWatchdog]:
+    # called from the running loop, only starts one
+    global WATCHDOG
+    if WATCHDOG is not None and not WATCHDOG.task.done():
+        return WATCHDOG
+    if not watchdogConfig()["enabled"]:
+        return None
+    WATCHDOG = LoopWatchdog()
+    log("loop", "watchdog", f"Watching the event loop, blocked is {WATCHDOG.options['threshold']}s late")
+    return WATCHDOG
+
+metrics.collect("loop_watchdog", lambda: WATCHDOG.stats() if WATCHDOG else {})
@@ -0,0 +1,154 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import *
+
+import discord
+
+from . import config
+from . import metrics
+from .stasilogging import *
+
+"""
+Queue for replacing members' roles.
+Booking or releasing a lot of prisoners at once (a pile of warrants expiring together, /warrant admin tick) used to fire
+every member edit inline, which runs straight into discord's per-guild member edit rate limit and holds up whatever did it.
+Edits are queued per guild and sent by one worker per guild at a steady rate, with some burst allowance.
+If a member already has an edit waiting, the new roles replace the old ones instead of queueing a second edit, since
+only the last one would matter anyway.
+Failed edits are retried with backoff, except when discord says no (missing permissions, member gone).
+"""
+
+DEFAULTS = {
+    "per_second": 1,  # sustained edits per second per guild
+    "burst": 5,  # edits that can go out back to back after a quiet period
+    "retries": 3,
+    "backoff": 2,  # seconds before the first retry, doubled every time
+}
+
+STATS = {"queued": 0, "coalesced": 0, "edited": 0, "retries": 0, "failed": 0, "max_depth": 0, "wait_seconds": 0.0}
+
+def rateConfig():
+    return {**DEFAULTS, **(config.C.get("role_edits", {}) or {})}
+
+class PendingEdit:
+    def __init__(self, member: discord.Member, roles: List[discord.Role], reason: Optional[str]):
+        self.member = member
+        self.roles = roles
+        self.reason = reason
+        self.queued = time.monotonic()
+        self.futures: List[asyncio.Future] = []
+
+class GuildQueue:
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        self.pending: "OrderedDict[int, PendingEdit]" = OrderedDict()  # member id -> edit, oldest first
+        self.sending: Optional[PendingEdit] = None  # taken off pending, going out or being retried
+        self.wake = asyncio.Event()
+        self.tokens = rateConfig()["burst"]
+        self.refilled = time.monotonic()
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, member: discord.Member, roles: List[discord.Role], reason: str = None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if edit := self.pending.get(member.id):
+            # keeps its place in line, but ends up with the newest roles
+            edit.member = member
+            edit.roles = roles
+            edit.reason = reason or edit.reason
+            STATS["coalesced"] += 1
+        else:
+            edit = self.pending[member.id] = PendingEdit(member, roles, reason)
+        edit.futures.append(future)
+        STATS["queued"] += 1
+        STATS["max_depth"] = max(STATS["max_depth"], queueDepth())
+        self.wake.set()
+        return future
+
+    async def take(self):
+        # token bucket, waits until an edit is allowed to go out
+        options = rateConfig()
+        while True:
+            now = time.monotonic()
+            self.tokens = min(options["burst"], self.tokens + (now - self.refilled) * options["per_second"])
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / options["per_second"])
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                await self.wake.wait()
+                self.wake.clear()
+                continue
+            await self.take()
+            member_id, edit = self.pending.popitem(last=False)
+            STATS["wait_seconds"] += time.monotonic() - edit.queued
+            self.sending = edit
+            try:
+                await self.send(edit)
+            finally:
+                self.sending = None
+
+    async def send(self, edit: PendingEdit):
+        options = rateConfig()
+        error = None
+        for attempt in range(options["retries"] + 1):
+            try:
+                await edit.member.edit(roles=edit.roles, reason=edit.reason)
+                STATS["edited"] += 1
+                error = None
+                break
+            except (discord.Forbidden, discord.NotFound) as e:  # retrying won't help
+                error = e
+                break
+            except Exception as e:  # rate limits, server errors, dropped connections, timeouts
+                error = e
+                if attempt < options["retries"]:
+                    STATS["retries"] += 1
+                    await asyncio.sleep(options["backoff"] * 2 ** attempt)
+
+        if error:
+            STATS["failed"] += 1
+            log("admin", "roles", f"Failed to edit roles of {edit.member} ({edit.member.id}): {type(error).__name__}: {error}")
+        for future in edit.futures:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+                future.exception()  # nobody has to await it, this keeps asyncio from complaining that nobody did
+            else:
+                future.set_result(True)
+
+QUEUES: Dict[int, GuildQueue] = {}
+
+def editRoles(member: discord.Member, roles: List[discord.Role], reason: str = None) -> asyncio.Future:
+    # queues replacing all of member's roles with roles, await the result if you need to know it went through
+    queue = QUEUES.get(member.guild.id)
+    if queue is None or queue.task.done():
+        queue = QUEUES[member.guild.id] = GuildQueue(member.guild.id)
+    return queue.put(member, [role for role in roles if role], reason)
+
+def pendingRoles(member: discord.Member) -> List[discord.Role]:
+    # the roles member will have once their queued edit goes out, member.roles is stale until then
+    queue = QUEUES.get(member.guild.id)
+    if queue:
+        if edit := queue.pending.get(member.id):
+            return list(edit.roles)
+        if queue.sending and queue.sending.member.id == member.id:
+            return list(queue.sending.roles)
+    return list(member.roles)
+
+def queueDepth() -> int:
+    return sum(len(queue.pending) for queue in QUEUES.values())
+
+def roleQueueStats():
+    return {
+        **STATS,
+        "depth": queueDepth(),
+        "avg_wait_seconds": round(STATS["wait_seconds"] / STATS["edited"], 4) if STATS["edited"] else None,
+    }
+
+metrics.collect("role_queue", roleQueueStats)
@@ -1,13 +1,25 @@
+import atexit
 import base64
+import collections
 import datetime
+import glob
+import gzip
+import json
 import os
+import random
+import queue
+import shutil
 import sys
+import threading
+import time
 import sentry_sdk
+from typing import Callable, Dict, List, Optional, Union
 
 import discord
 import asyncio
 
 from . import config
+from . import metrics
 from . import utils
 
 if "sentry" in config.C and config.C["sentry"]:
@@ -53,26 +65,214 @@ def discord_dynamic_timestamp(timestamp: datetime.datetime, format_style: str =
     else:
         return f'<t:{epoch}:{format_style}>'
 
-def log(category_broad, category_fine, message, print_message=True, preserve_newlines=False):
-    
+LOG_DEFAULTS = {
+    "directory": "logs",
+    "max_bytes": 10485760,  # 10MB, a log file bigger than this gets rotated
+    "max_age_hours": 168,  # so does one this process has been writing to for longer than this
+    "backups": 10,  # rotated files kept per category, the oldest go first
+    "compress": True,  # gzip rotated files
+    "batch_lines": 1000,  # most lines written per batch
+    "format": "text",  # or "json" for one json object per line, in <category>.jsonl
+    "levels": {},  # "category" or "category.fine" -> lowest level written, "default" for everything else
+    "sampling": {},  # "category" or "category.fine" -> {"rate": fraction kept, "per_minute": most lines per minute}
+}
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+LOG_OPTIONS = None
+
+def logConfig():
+    global LOG_OPTIONS
+    if LOG_OPTIONS is None:
+        LOG_OPTIONS = {**LOG_DEFAULTS, **(config.C.get("logging", {}) or {})}
+    return LOG_OPTIONS
+
+def reloadLogConfig():
+    # levels and sampling are resolved once per category and cached, this starts over after config.C changes
+    global LOG_OPTIONS
+    LOG_OPTIONS = None
+    LOG_RULES.clear()
+
+class LogWriter(threading.Thread):
+    # log() only puts lines on the queue, this thread keeps the files open and writes them out in batches,
+    # so the event loop never waits on the disk. rotated files are compressed here too
+
+    def __init__(self):
+        super().__init__(name="LogWriter", daemon=True)
+        self.queue = queue.SimpleQueue()
+        self.files = {}  # file name -> [file, opened at]
+        self.stats = {"lines": 0, "batches": 0, "rotations": 0, "errors": 0}
+
+    def put(self, filename: str, line: str):
+        self.queue.put((filename, line))
+
+    def close(self, timeout: float = 10):
+        # writes out everything still queued, then stops
+        if self.is_alive():
+            self.queue.put(None)
+            self.join(timeout)
+
+    def run(self):
+        options = logConfig()
+        while True:
+            batch = [self.queue.get()]
+            while batch[-1] is not None and len(batch) < options["batch_lines"]:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1] is None
+            lines = {}
+            for item in batch:
+                if item is not None:
+                    lines.setdefault(item[0], []).append(item[1])
+            for filename, file_lines in lines.items():
+                try:
+                    self.write(filename, "".join(file_lines), options)
+                    self.stats["lines"] += len(file_lines)
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    print(f"Failed to write {len(file_lines)} lines to {filename}: {type(e).__name__}: {e}", file=sys.stderr)
+            self.stats["batches"] += 1
+
+            if stop:
+                for f, _ in self.files.values():
+                    f.close()
+                self.files.clear()
+                return
+
+    def write(self, filename: str, text: str, options: dict):
+        if filename not in self.files:
+            os.makedirs(options["directory"], exist_ok=True)
+            self.files[filename] = [open(os.path.join(options["directory"], filename), "a", encoding="utf-8"), time.time()]
+        f, opened = self.files[filename]
+        f.write(text)
+        f.flush()
+        if f.tell() > options["max_bytes"] or time.time() - opened > options["max_age_hours"] * 3600:
+            self.rotate(filename, options)
+
+    def rotate(self, filename: str, options: dict):
+        f, _ = self.files.pop(filename)
+        f.close()
+        category, extension = os.path.splitext(filename)
+        path = os.path.join(options["directory"], filename)
+        rotated = os.path.join(options["directory"], f"{category}.{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}{extension}")
+        os.replace(path, rotated)
+        if options["compress"]:
+            with open(rotated, "rb") as source, gzip.open(rotated + ".gz", "wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+        self.stats["rotations"] += 1
+
+        # the timestamp in the name sorts oldest first
+        backups = sorted(glob.glob(os.path.join(glob.escape(options["directory"]), f"{glob.escape(category)}.*{extension}*")))
+        for old in backups[:max(0, len(backups) - options["backups"])]:
+            os.remove(old)
+
+LOG_WRITER: LogWriter = None
+LOG_WRITER_LOCK = threading.Lock()
+
+def logWriter() -> LogWriter:
+    # started by the first log() call, and flushed when the bot exits
+    global LOG_WRITER
+    if LOG_WRITER is None or not LOG_WRITER.is_alive():
+        with LOG_WRITER_LOCK:
+            if LOG_WRITER is None or not LOG_WRITER.is_alive():
+                LOG_WRITER = LogWriter()
+                LOG_WRITER.start()
+    return LOG_WRITER
+
+@atexit.register
+def flushLogs():
+    if LOG_WRITER is not None:
+        LOG_WRITER.close()
+
+class LogRule:
+    # the level and sampling that apply to one category_broad.category_fine, worked out from the config once
+
+    def __init__(self, broad: str, fine: str, options: dict):
+        keys = [f"{broad}.{fine}", broad]
+        levels = {key.lower(): value for key, value in options["levels"].items()}
+        sampling = {key.lower(): value for key, value in options["sampling"].items()}
+        self.level = LEVELS[next((levels[key] for key in keys if key in levels), levels.get("default", "info")).lower()]
+        sample = next((sampling[key] for key in keys if key in sampling), {})
+        self.rate = sample.get("rate", 1)
+        self.per_minute = sample.get("per_minute")
+        self.tokens = self.per_minute
+        self.refilled = time.monotonic()
+        self.suppressed = 0  # lines sampled away since the last one that was written
+
+    def sample(self) -> bool:
+        if self.rate < 1 and random.random() >= self.rate:
+            return False
+        if self.per_minute is not None:
+            now = time.monotonic()
+            self.tokens = min(self.per_minute, self.tokens + (now - self.refilled) * self.per_minute / 60)
+            self.refilled = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+LOG_RULES = {}  # (broad, fine) -> LogRule
+LOG_STATS = {"written": 0, "filtered": 0, "sampled": 0}
+
+def logRule(broad: str, fine: str) -> LogRule:
+    rule = LOG_RULES.get((broad, fine))
+    if rule is None:
+        rule = LOG_RULES[(broad, fine)] = LogRule(broad.lower(), fine.lower(), logConfig())
+    return rule
+
+def logEnabled(category_broad: str, category_fine: str, level: str = "info") -> bool:
+    # for call sites that have to do work to even decide what to log
+    return LEVELS[level] >= logRule(category_broad, category_fine).level
+
+def logStats():
+    return {**LOG_STATS, "writer": dict(LOG_WRITER.stats) if LOG_WRITER else None}
+
+def log(category_broad, category_fine, message: Union[str, Callable[[], str]], print_message=True, preserve_newlines=False, level="info", **fields):
+    # message can be a function returning it, which is only called if the line is actually written
+    # warnings and errors are never sampled, anything passed as fields ends up as its own key in json logs
+    rule = logRule(category_broad, category_fine)
+    if LEVELS[level] < rule.level:
+        LOG_STATS["filtered"] += 1
+        return
+    if LEVELS[level] < LEVELS["warning"] and not rule.sample():
+        rule.suppressed += 1
+        LOG_STATS["sampled"] += 1
+        return
+    if rule.suppressed:
+        fields["suppressed"] = rule.suppressed
+        rule.suppressed = 0
+    if callable(message):
+        message = message()
+    message = str(message)
+    LOG_STATS["written"] += 1
+
     if "--debug" in sys.argv or "--verbose" in sys.argv:
         print_message = True
         
     # create timestamp like JAN 6 2021 12:00:00
-    os.makedirs("logs", exist_ok=True)
-    timestamp = datetime.datetime.now().strftime("%b %d %Y %H:%M:%S")
+    now = datetime.datetime.now()
+    timestamp = now.strftime("%b %d %Y %H:%M:%S")
     if not preserve_newlines:
         message = message.replace("\n", " ")
     # clean emojis, special characters
     print_msg = message.encode("latin-1", "replace").decode('latin-1')
     if print_message: print(f"[{timestamp}] [{category_broad.upper()}] [{category_fine.upper()}] {print_msg}")
-    with open(f"logs/{category_broad.lower()}.log", "a+", encoding='utf-8') as f:
-        f.write(f"[{timestamp}] [{category_fine.upper()}] {message}\n")
+
+    if logConfig()["format"] == "json":
+        line = json.dumps({"time": now.astimezone().isoformat(), "level": level, "category": category_broad, "event": category_fine, "message": message, **fields}, default=str)
+        logWriter().put(f"{category_broad.lower()}.jsonl", line + "\n")
+    else:
+        extra = "".join(f" {key}={value}" for key, value in fields.items())
+        logWriter().put(f"{category_broad.lower()}.log", f"[{timestamp}] [{category_fine.upper()}]{' [' + level.upper() + ']' if level != 'info' else ''} {message}{extra}\n")
 
 def custom_exception_handler(exception_type, exception, traceback):
     sentry_sdk.capture_exception(exception)
     error_raw = ''.join(traceback.format_exception(exception_type, exception, traceback))
-    log("runtimes", "error", f"Error {lid(exception)}: \n```\n{error_raw}\n```", False, True)
+    log("runtimes", "error", f"Error {lid(exception)}: \n```\n{error_raw}\n```", False, True, level="error")
 
 def log_user(user):
     return f"{utils.normalUsername(user)} ({user.id})"
@@ -89,48 +289,157 @@ class ChannelLogCategories:
     audit_log_public = "audit_log_public"
     warrant_updates = "warrant_updates"
 
-async def channelDispatch(content: str = None, embed: discord.Embed = None, channel: discord.TextChannel = None):
-    try:
-        await channel.send(content=content, embed=embed)
-    except discord.Forbidden:
-        pass
-    except discord.HTTPException as e:
-        if e.code == 50035:
-            # remove all fields from embed
-            embed.clear_fields()
-            embed.add_field(name="**[ERROR]**", value=e.text, inline=False)
-            await channel.send(content=content, embed=embed)
-
-async def channelLog(content: str = None, embed: discord.Embed = None, category: str = None, dry: bool = False):
+CHANNEL_LOG_DEFAULTS = {
+    "max_pending": 200,  # messages waiting per channel, the oldest are dropped past this
+    "min_interval": 1.0,  # seconds between messages to one channel, discord allows about 5 every 5 seconds
+}
+
+def channelLogConfig():
+    return {**CHANNEL_LOG_DEFAULTS, **(config.C.get("channel_logs", {}) or {})}
+
+def _cut(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit - 1] + "…"
+
+def fitEmbed(embed: discord.Embed) -> discord.Embed:
+    # trims a copy of an embed to discord's limits before sending it, instead of finding out from a 50035
+    # the caller's embed is left alone, it might still be edited or sent somewhere else
+    embed = discord.Embed.from_dict(embed.to_dict())
+    if embed.title:
+        embed.title = _cut(embed.title, 256)
+    if embed.description:
+        embed.description = _cut(embed.description, 4096)
+    fields = embed.fields
+    if len(fields) > 25:
+        embed.fields = fields[:24]
+        embed.add_field(name="…", value=f"{len(fields) - 24} more fields", inline=False)
+    for field in embed.fields:
+        field.name = _cut(str(field.name), 256) or "\u200b"
+        field.value = _cut(str(field.value), 1024) or "\u200b"
+    while len(embed) > 6000 and embed.fields:
+        embed.remove_field(-1)
+    if len(embed) > 6000 and embed.description:
+        embed.description = _cut(embed.description, max(1, len(embed.description) - (len(embed) - 6000)))
+    return embed
+
+def batchEmbeds(embeds: List[discord.Embed]) -> List[List[discord.Embed]]:
+    # discord takes up to 10 embeds and 6000 characters of them per message
+    batches, size = [], 0
+    for embed in embeds:
+        if not batches or len(batches[-1]) >= 10 or size + len(embed) > 6000:
+            batches.append([])
+            size = 0
+        batches[-1].append(embed)
+        size += len(embed)
+    return batches
+
+class ChannelQueue:
+    # one per log channel, a worker packs whatever is waiting into as few messages as it can
+    # (up to 10 embeds and 6000 characters of them each) and sends them no faster than min_interval
+
+    def __init__(self, channel: discord.abc.Messageable):
+        self.channel = channel
+        self.pending = collections.deque()  # (content, embeds)
+        self.wake = asyncio.Event()
+        self.stats = {"queued": 0, "sent": 0, "messages": 0, "dropped": 0, "errors": 0}
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, content: Optional[str], embeds: List[discord.Embed]):
+        content = _cut(content, 2000) if content else None
+        # an entry has to fit in one message on its own, more than that is split and the content goes with the first part
+        for batch in batchEmbeds([fitEmbed(embed) for embed in embeds]) or [[]]:
+            if len(self.pending) >= channelLogConfig()["max_pending"]:
+                self.pending.popleft()  # a burst (mass deletes and such) drops the oldest instead of piling up forever
+                self.stats["dropped"] += 1
+            self.pending.append((content, batch))
+            self.stats["queued"] += 1
+            content = None
+        self.wake.set()
+
+    def pack(self):
+        # takes as many queued entries as fit into one message
+        content, embeds, size, count = [], [], 0, 0
+        while self.pending:
+            next_content, next_embeds = self.pending[0]
+            next_size = sum(len(embed) for embed in next_embeds)
+            fits = (
+                len(embeds) + len(next_embeds) <= 10
+                and size + next_size <= 6000
+                and len("\n".join(content + ([next_content] if next_content else []))) <= 2000
+            )
+            if count and not fits:
+                break
+            self.pending.popleft()
+            count += 1
+            if next_content:
+                content.append(next_content)
+            embeds.extend(next_embeds)
+            size += next_size
+        return "\n".join(content) or None, embeds, count
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                await self.wake.wait()
+                self.wake.clear()
+                continue
+            content, embeds, count = self.pack()
+            try:
+                await self.channel.send(content=content, embeds=embeds)
+                self.stats["sent"] += count
+                self.stats["messages"] += 1
+            except Exception as e:  # Forbidden, dropped connections, timeouts, the entries are lost either way but the worker keeps going
+                self.stats["errors"] += 1
+                self.stats["dropped"] += count
+                log("runtimes", "channellog", f"Failed to send {count} log entries to {self.channel.id}: {type(e).__name__}: {e}", False, level="warning")
+            await asyncio.sleep(channelLogConfig()["min_interval"])
+
+CHANNEL_QUEUES: Dict[int, ChannelQueue] = {}
+LOG_CHANNELS: Dict[str, list] = {}  # category -> resolved channels, cached once they all resolve
+
+def logChannels(category: str) -> list:
+    if category in LOG_CHANNELS:
+        return LOG_CHANNELS[category]
     bot = config.get_global("bot")
-    if category not in config.C["log_channels"]:
+    channel_ids = config.C["log_channels"].get(category)
+    if isinstance(channel_ids, int):
+        channel_ids = [channel_ids]
+    if not isinstance(channel_ids, list) or bot is None:
+        return []
+    channels = [channel for channel in (bot.get_channel(channel_id) for channel_id in channel_ids) if channel]
+    if len(channels) == len(channel_ids):  # one that didn't resolve might just not be in the cache yet
+        LOG_CHANNELS[category] = channels
+    return channels
+
+async def channelDispatch(content: str = None, embed: discord.Embed = None, channel: discord.TextChannel = None, embeds: List[discord.Embed] = None):
+    # queues a message for one channel, it's sent (possibly together with others) by that channel's queue
+    embeds = embeds or ([embed] if embed else [])
+    if not content and not embeds:
         return
-    
-    channels = []
-
-    if isinstance(config.C["log_channels"][category], list):
-        for channel_id in config.C["log_channels"][category]:
-            channel = bot.get_channel(channel_id)
-            if channel:
-                channels.append(channel)
-
-    elif isinstance(config.C["log_channels"][category], int):
-        channel = bot.get_channel(config.C["log_channels"][category])
-        if channel:
-            channels.append(channel)
-    
-    else:
+    queue = CHANNEL_QUEUES.get(channel.id)
+    if queue is None or queue.task.done():
+        queue = CHANNEL_QUEUES[channel.id] = ChannelQueue(channel)
+    queue.put(content, embeds)
+
+async def channelLog(content: str = None, embed: discord.Embed = None, category: str = None, dry: bool = False, embeds: List[discord.Embed] = None):
+    if category not in config.C["log_channels"]:
         return
-    
+
+    channels = logChannels(category)
     if not channels:
         return
 
     if dry:  # can be used for custom behavior or testing
         return channels
 
-    tasks = []
     for channel in channels:
-        await asyncio.sleep(0.1)
-        tasks.append(channelDispatch(content=content, embed=embed, channel=channel))
-    
-    asyncio.gather(*tasks)
+        await channelDispatch(content=content, embed=embed, channel=channel, embeds=embeds)
+
+def channelLogStats():
+    return {
+        "depth": sum(len(queue.pending) for queue in CHANNEL_QUEUES.values()),
+        "channels": {channel_id: {**queue.stats, "depth": len(queue.pending)} for channel_id, queue in CHANNEL_QUEUES.items()},
+    }
+
+metrics.gauge("channel_log_depth", "Log channel messages waiting to be sent.", fn=lambda: channelLogStats()["depth"])
+metrics.collect("channel_logs", lambda: {"dropped": sum(queue.stats["dropped"] for queue in CHANNEL_QUEUES.values()), "messages": sum(queue.stats["messages"] for queue in CHANNEL_QUEUES.values()), "sent": sum(queue.stats["sent"] for queue in CHANNEL_QUEUES.values())})
+metrics.collect("logging", logStats)
@@ -1,5 +1,7 @@
 import random
 import base64
+import asyncio
+import functools
 
 nouns = open("wordlists/nouns.txt", "r").read().splitlines()
 adjectives = open("wordlists/adjectives.txt", "r").read().splitlines()
@@ -86,6 +88,15 @@ def seconds_to_time_long(time: int):  # "one day, 10 hours, 10 minutes, 10 secon
     else: # 0 seconds
         return "now"
 
+def bytes_to_human(n: int):  # 1536 -> "1.5 KB"
+    for unit in ["bytes", "KB", "MB", "GB"]:
+        if n < 1024 or unit == "GB":
+            return f"{n} {unit}" if unit == "bytes" else f"{round(n, 1)} {unit}"
+        n /= 1024
+
+def inThread(fn, *args, **kwargs):  # asyncio.to_thread, which 3.8 doesn't have
+    return asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args, **kwargs))
+
 def generate_random_id(): 
     return f"{random.choice(adjectives)}-{random.choice(adjectives)}-{random.choice(nouns)}"
 
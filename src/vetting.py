@@ -8,6 +8,7 @@ import asyncio
 from . import database as db
 from . import config
 from . import artificalint as ai
+from . import profiling
 from . import security
 from .stasilogging import log, log_user, lid, channelLog, ChannelLogCategories
 
@@ -243,6 +244,8 @@ class Verification(commands.Cog):
         self.bot = bot
 
 
+profiling.watch("Verification.currently_ai_verifying", lambda: len(Verification.currently_ai_verifying))
+profiling.watch("Verification.currently_beta_verifying", lambda: len(Verification.currently_beta_verifying))
 
 def setup(bot):
     bot.add_cog(Verification(bot))
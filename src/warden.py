@@ -1,9 +1,15 @@
+import asyncio
 import discord
+import heapq
+from . import autocomplete
 from . import database as db
 from typing import *
 import datetime
 import random
 from . import config
+from . import metrics
+from . import profiling
+from . import rolequeue
 from .stasilogging import *
 from . import utils
 
@@ -14,6 +20,9 @@ Warrants are issued by moderators or other cogs and are stored in the database.
 Warrants are stored under a "Prisoner" object which includes information like their role list and time committed.
 This is so that warrants can be individually managed and issued.
 
+Prisoners are ticked by the WarrantScheduler when their next warrant expires, and right away whenever their warrants change,
+not on a timer. Nothing is saved unless the prisoner actually changed.
+
 Warrants with a sentence are served one after the other, in the order they are issued.
 Warrants with no sentence are served indefinitely, until they are voided, frozen, or stayed.
 Timed warrants and indefinite warrants can be served at the same time, but no two timed warrants can be served at the same time.
@@ -28,12 +37,150 @@ When voiding a warrant from another cog, use the in-built warrant voiding functi
 
 Completion Guide
 - [ ] Handle warrants correctly if user has left the server. (db.set_roles())
-- [ ] Function which voids all warrants under a certain Prisoner's name.
-- [ ] Function which voids all warrants under a certain category for a certain Prisoner.
+- [x] Function which voids all warrants under a certain Prisoner's name. (voidWarrantsByPrisoner())
+- [x] Function which voids all warrants under a certain category for a certain Prisoner. (voidWarrantsByPrisoner(category=...))
 - [ ] Jumping back and forth in the warrant activation queue based on freeze status etc.
 """
 
-PRISONERS: List["Prisoner"] = []
+class WardenRegistry:
+    # every prisoner by user id and every warrant by lowercased id, so lookups don't have to scan everything
+    # iterating over it goes over the prisoners, like the list it replaced
+
+    def __init__(self):
+        self.prisoners: Dict[int, "Prisoner"] = {}
+        self.warrants: Dict[str, "Warrant"] = {}
+
+    def __iter__(self):
+        return iter(list(self.prisoners.values()))  # a copy, prisoners can be archived while looping over them
+
+    def __len__(self):
+        return len(self.prisoners)
+
+    def addPrisoner(self, prisoner: "Prisoner"):
+        self.prisoners[prisoner._id] = prisoner
+        for warrant in prisoner.warrants:
+            self.addWarrant(prisoner, warrant)
+
+    def removePrisoner(self, prisoner: "Prisoner"):
+        self.prisoners.pop(prisoner._id, None)
+        for warrant in prisoner.warrants:
+            self.removeWarrant(warrant)
+
+    def addWarrant(self, prisoner: "Prisoner", warrant: "Warrant"):
+        warrant.owner = prisoner
+        self.warrants[warrant._id.lower()] = warrant
+        indexWarrant(prisoner, warrant)
+
+    def removeWarrant(self, warrant: "Warrant"):
+        self.warrants.pop(warrant._id.lower(), None)
+        autocomplete.WARRANTS.remove(warrant._id)
+
+    def getPrisoner(self, user_id: int) -> Optional["Prisoner"]:
+        return self.prisoners.get(user_id)
+
+    def getWarrant(self, warrant_id: str) -> Optional["Warrant"]:
+        return self.warrants.get(warrant_id.lower())
+
+PRISONERS = WardenRegistry()
+
+metrics.gauge("prisoners", "Prisoners in the warden registry.", fn=lambda: len(PRISONERS))
+metrics.gauge("warrants", "Warrants in the warden registry.", fn=lambda: len(PRISONERS.warrants))
+profiling.watch("warden.PRISONERS", lambda: len(PRISONERS))
+profiling.watch("warden.PRISONERS warrants", lambda: len(PRISONERS.warrants))
+PRISONER_TICK_SECONDS = metrics.histogram("prisoner_tick_seconds", "Prisoner.Tick latency from the warrant scheduler.")
+
+class WarrantScheduler:
+    # a min heap of (when, user id) for every prisoner with a running sentence, the loop sleeps until the soonest one
+    # rearming a prisoner pushes a new entry, old ones are skipped when they come up since they don't match armed anymore
+
+    MAX_SLEEP = 3600  # wake up every now and then anyway, in case the clock jumps
+    RETRY_AFTER = 60  # seconds before a prisoner whose tick failed is ticked again, doubled every time it fails again
+    MAX_RETRY = 3600
+
+    def __init__(self):
+        self.heap: List[Tuple[datetime.datetime, int]] = []
+        self.armed: Dict[int, datetime.datetime] = {}
+        self.failures: Dict[int, int] = {}  # user id -> ticks failed in a row
+        self.wake = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.ticks = 0
+
+    def arm(self, prisoner: "Prisoner"):
+        deadline = prisoner.nextDeadline() if PRISONERS.getPrisoner(prisoner._id) is prisoner else None
+        if deadline is None:
+            self.armed.pop(prisoner._id, None)
+            return
+        if self.armed.get(prisoner._id) == deadline:
+            return
+        self.armed[prisoner._id] = deadline
+        heapq.heappush(self.heap, (deadline, prisoner._id))
+        self.wake.set()
+
+    def retry(self, prisoner: "Prisoner"):
+        # a failed tick (a save, a role edit) may have left an expired sentence unreleased and the prisoner unarmed,
+        # so they're ticked again in a while instead of never
+        if PRISONERS.getPrisoner(prisoner._id) is not prisoner:
+            return
+        failures = self.failures[prisoner._id] = self.failures.get(prisoner._id, 0) + 1
+        when = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=min(self.RETRY_AFTER * 2 ** (failures - 1), self.MAX_RETRY))
+        if (armed := self.armed.get(prisoner._id)) and armed <= when:
+            return
+        self.armed[prisoner._id] = when
+        heapq.heappush(self.heap, (when, prisoner._id))
+        self.wake.set()
+
+    async def start(self):
+        # everyone gets ticked once on startup to catch up on whatever happened while the bot was down, which also arms them
+        for prisoner in PRISONERS:
+            await self.tick(prisoner)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    async def tick(self, prisoner: "Prisoner"):
+        self.ticks += 1
+        try:
+            with PRISONER_TICK_SECONDS.time():
+                await prisoner.Tick()
+        except Exception as e:
+            retry = self.armed.get(prisoner._id)
+            log("justice", "scheduler", f"Failed to tick {prisoner.prisoner_name} ({prisoner._id}), trying again {retry:%H:%M:%S}: {type(e).__name__}: {e}" if retry else f"Failed to tick {prisoner.prisoner_name} ({prisoner._id}): {type(e).__name__}: {e}", level="warning")
+
+    async def run(self):
+        while True:
+            # drop entries that were rearmed or disarmed since they were pushed
+            while self.heap and self.armed.get(self.heap[0][1]) != self.heap[0][0]:
+                heapq.heappop(self.heap)
+
+            if not self.heap:
+                await self.wake.wait()
+                self.wake.clear()
+                continue
+
+            deadline, user_id = self.heap[0]
+            delay = (deadline - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), min(delay, self.MAX_SLEEP))
+                except asyncio.TimeoutError:
+                    pass
+                self.wake.clear()
+                continue
+
+            heapq.heappop(self.heap)
+            self.armed.pop(user_id, None)
+            if prisoner := PRISONERS.getPrisoner(user_id):
+                await self.tick(prisoner)
+
+SCHEDULER = WarrantScheduler()
+
+# messages that would've gone out without coalescing versus the ones that did, a DM and a log post each
+NOTIFICATION_STATS = {"requested": 0, "sent": 0}
+
+def notificationStats():
+    return {**NOTIFICATION_STATS, "saved": NOTIFICATION_STATS["requested"] - NOTIFICATION_STATS["sent"]}
+
+metrics.collect("warden_notifications", notificationStats)
+metrics.gauge("scheduler_armed", "Prisoners the warrant scheduler is waiting on.", fn=lambda: len(SCHEDULER.armed))
 
 class Warrant:
     def __init__(self):
@@ -48,6 +195,8 @@ class Warrant:
         self.expires = None
         self.frozen = None
         self.no_enforce = None
+        self.owner: Optional[Prisoner] = None  # the prisoner this is filed under, kept up to date by the registry and never saved
+        self.changed: Set[str] = set()  # fields changed since the last save, so Prisoner.Save only sends those
 
     def embed(self) -> discord.Embed:
         embed = discord.Embed(title="Warrant Info", description=f"Warrant `{self._id}`", color=discord.Color.red())
@@ -69,10 +218,7 @@ class Warrant:
         return embed
 
     def prisoner(self):
-        for prisoner in PRISONERS:
-            for warrant in prisoner.warrants:
-                if warrant._id == self._id:
-                    return prisoner
+        return self.owner
 
     def status(self) -> str:
         if self.expires:
@@ -88,16 +234,21 @@ class Warrant:
     def activate(self):
         self.started = datetime.datetime.now(datetime.timezone.utc)
         self.expires = self.started + datetime.timedelta(seconds=self.len_seconds)
+        self.changed.update(("started", "expires"))
 
     def deactivate(self):
         if self.expires:
             diff = self.expires - datetime.datetime.now(datetime.timezone.utc)
             self.len_seconds = diff.total_seconds()
             self.expires = None
+            self.changed.update(("len_seconds", "expires"))
         
     def freeze(self):
         self.deactivate()
         self.frozen = True
+        self.changed.add("frozen")
+        if self.owner:
+            SCHEDULER.arm(self.owner)
 
     def generateNewID(self):
         return f"{random.randint(1000,9999)}-{random.choice(utils.elements).title()}-{random.choice(utils.elements).title()}-{random.choice(utils.elements).title()}"
@@ -138,6 +289,12 @@ class Warrant:
         self.no_enforce = data["no_enforce"]
         return self
 
+    def toDict(self):
+        save = self.__dict__.copy()
+        del save["owner"]
+        del save["changed"]
+        return save
+
 class Prisoner:
     
     def __init__(self, guild):
@@ -148,11 +305,57 @@ class Prisoner:
         self.committed = None
         self.warrants: List[Warrant] = []
 
+        # what changed since the last save, none of this is saved itself
+        self.saved = False  # whether there's a document to update yet
+        self.changed: Set[str] = set()
+        self.added: List[Warrant] = []
+        self.removed: Set[str] = set()
+        self.save_lock = asyncio.Lock()  # saves go out one at a time and in order
+
+        # notifications waiting for flush()
+        self.outbox: List[discord.Embed] = []
+        self.outbox_content: List[str] = []
+
     def New(self, user: discord.Member, prisoner_name: str) -> "Prisoner":
         self._id = user.id
         self.prisoner_name = prisoner_name
         log("justice", "prisoner", f"New prisoner: {utils.normalUsername(user)} ({user.id})")
         return self
+
+    # warrants should only be added and removed through these so the registry stays in sync
+
+    def addWarrant(self, warrant: Warrant):
+        self.warrants.append(warrant)
+        PRISONERS.addWarrant(self, warrant)
+        self.added.append(warrant)
+
+    def removeWarrant(self, warrant: Warrant):
+        self.warrants.remove(warrant)
+        PRISONERS.removeWarrant(warrant)
+        self._forget(warrant)
+        SCHEDULER.arm(self)
+
+    def clearWarrants(self):
+        for warrant in self.warrants:
+            PRISONERS.removeWarrant(warrant)
+            self._forget(warrant)
+        self.warrants = []
+        SCHEDULER.arm(self)
+
+    def _forget(self, warrant: Warrant):
+        if warrant in self.added:  # never made it to the database, nothing to pull
+            self.added.remove(warrant)
+        else:
+            self.removed.add(warrant._id)
+
+    @property
+    def dirty(self) -> bool:
+        return bool(self.changed or self.added or self.removed or any(warrant.changed for warrant in self.warrants))
+
+    def nextDeadline(self) -> Optional[datetime.datetime]:
+        # when this prisoner next needs a tick, the soonest expiry of a running sentence
+        deadlines = [warrant.expires for warrant in self.warrants if warrant.expires and not warrant.frozen]
+        return min(deadlines) if deadlines else None
     
     def embed(self) -> discord.Embed:
         embed = discord.Embed(title="Prisoner Info", description=f"Prisoner `{self._id}`", color=discord.Color.red())
@@ -171,14 +374,32 @@ class Prisoner:
         return embed
 
     async def communicate(self, content: str = None, embed: discord.Embed = None):
-        try:
-            await self.prisoner().send(content=content, embed=embed)
-        except discord.Forbidden:  # blocked the bot, disabled dm's, etc.
-            pass
-        except AttributeError:  # they are not in the server
-            pass
-        
-        await channelLog(content=content, embed=embed, category=ChannelLogCategories.warrant_updates)
+        # held until flush(), which Tick calls, so everything from one tick or command goes out as one message
+        NOTIFICATION_STATS["requested"] += 2
+        if content:
+            self.outbox_content.append(content)
+        if embed:
+            self.outbox.append(embed)
+
+    async def flush(self):
+        # sends whatever communicate() collected, to the prisoner and the warrant_updates log
+        if not self.outbox and not self.outbox_content:
+            return
+        content = "\n".join(self.outbox_content)[:2000] or None
+        batches = batchEmbeds(self.outbox) or [[]]
+        self.outbox, self.outbox_content = [], []
+
+        for i, embeds in enumerate(batches):
+            batch_content = content if i == 0 else None
+            NOTIFICATION_STATS["sent"] += 2
+            try:
+                await self.prisoner().send(content=batch_content, embeds=embeds)
+            except discord.Forbidden:  # blocked the bot, disabled dm's, etc.
+                pass
+            except AttributeError:  # they are not in the server
+                pass
+
+            await channelLog(content=batch_content, embeds=embeds, category=ChannelLogCategories.warrant_updates)
 
     def prisoner(self) -> Optional[discord.Member]:
         if user := self.guild.get_member(self._id):
@@ -198,21 +419,24 @@ class Prisoner:
 
     async def book(self):  # takes their roles, memorizes time committed, and gives them the prisoner role
         if self.roles:
-            return
+            return False
 
         log("justice", "prisoner", f"Booking prisoner: {self.prisoner_name} ({self._id})")
 
         prisoner_role = self.guild.get_role(config.C["prison_role"])
         user = self.prisoner()
-        if prisoner_role in user.roles:
-            return
-        self.roles = [role.id for role in user.roles]
+        roles = rolequeue.pendingRoles(user)  # a release might still be queued, user.roles is stale until it goes out
+        if prisoner_role in roles:
+            return False
+        self.roles = [role.id for role in roles]
         self.committed = datetime.datetime.now(datetime.timezone.utc)
-        await user.edit(roles=[prisoner_role])
+        self.changed.update(("roles", "committed"))
+        rolequeue.editRoles(user, [prisoner_role], "Booked into prison")
+        return True
 
     async def release(self):  # gives them roles back and nothing more
         if not self.roles:
-            return
+            return False
         log("justice", "prisoner", f"Releasing prisoner: {self.prisoner_name} ({self._id})")
 
         embed = discord.Embed(title="Prisoner Released", description=f"You have been released from prison and can now access channels normally.", color=discord.Color.green())
@@ -224,11 +448,13 @@ class Prisoner:
 
         user = self.prisoner()
         if user:  # update the user's roles if they're still in the server
-            await user.edit(roles=[self.guild.get_role(role_id) for role_id in self.roles])
+            rolequeue.editRoles(user, [self.guild.get_role(role_id) for role_id in self.roles], "Released from prison")
             self.roles = []
         else:  # if not, update the database which restores their roles when they rejoin
             await db.set_roles(self._id, self.roles)
             self.roles = []
+        self.changed.add("roles")
+        return True
 
     def getNextWarrant(self) -> Optional[Warrant]:
         if not self.warrants:
@@ -264,6 +490,7 @@ class Prisoner:
         self.prisoner_name = data["prisoner_name"]
         if not data["prisoner_name"] and data["user_name"]:
             self.prisoner_name = data["user_name"]
+        self.saved = True
         log("justice", "prisoner", f"Loaded prisoner: {self.prisoner_name} ({self._id})")
         return
 
@@ -271,25 +498,84 @@ class Prisoner:
         log("justice", "prisoner", f"Archiving prisoner: {self.prisoner_name} ({self._id})")
         db_ = await db.create_connection("Warden")
         grab = await db_.delete_one({"_id": self._id})
-        PRISONERS.remove(self)
+        PRISONERS.removePrisoner(self)
+
+    def toDict(self):
+        return {
+            "_id": self._id,
+            "guild": self.guild.id,
+            "prisoner_name": self.prisoner_name,
+            "roles": self.roles,
+            "committed": self.committed,
+            "warrants": [warrant.toDict() for warrant in self.warrants]
+        }
 
     async def Save(self):
-        db_ = await db.create_connection("Warden")
-        save = self.__dict__.copy()
-        save["warrants"] = [warrant.__dict__ for warrant in save["warrants"]]
-        save["guild"] = save["guild"].id
-        await db_.update_one({"_id": self._id}, {"$set": save}, upsert=True)
+        # the whole document the first time, after that only what changed
+        # a scheduler tick and a command can save the same prisoner at once, so the lock keeps the updates in order and
+        # the pending changes are taken before the first await, anything changed while this is writing goes in the next save
+        async with self.save_lock:
+            full = None if self.saved else self.toDict()
+            removed, added, changed = self.removed, self.added, self.changed
+            warrant_changes = {warrant: warrant.changed for warrant in self.warrants if warrant.changed}
+            self.saved = True
+            self.removed, self.added, self.changed = set(), [], set()
+            for warrant in warrant_changes:
+                warrant.changed = set()
+
+            try:
+                db_ = await db.create_connection("Warden")
+                if full is not None:
+                    await db_.update_one({"_id": self._id}, {"$set": full}, upsert=True)
+                    return
+
+                # mongo won't $pull from, $set inside and $push to the same array in one update, so up to three of them
+                if removed:
+                    await db_.update_one({"_id": self._id}, {"$pull": {"warrants": {"_id": {"$in": list(removed)}}}})
+
+                update = {field: getattr(self, field) for field in changed}
+                array_filters = []
+                for warrant, fields in warrant_changes.items():
+                    if warrant not in added:
+                        name = f"w{len(array_filters)}"
+                        array_filters.append({f"{name}._id": warrant._id})
+                        update.update({f"warrants.$[{name}].{field}": getattr(warrant, field) for field in fields})
+                if update:
+                    await db_.update_one({"_id": self._id}, {"$set": update}, array_filters=array_filters or None)
+
+                if added:
+                    await db_.update_one({"_id": self._id}, {"$push": {"warrants": {"$each": [warrant.toDict() for warrant in added]}}})
+            except BaseException:
+                # put it all back so the next save tries again
+                self.saved = full is None
+                self.removed |= removed
+                self.added[:0] = added
+                self.changed |= changed
+                for warrant, fields in warrant_changes.items():
+                    warrant.changed |= fields
+                raise
 
     async def Tick(self):
-        await self.HeartBeat()
-        if not self.canArchive():
-            await self.Save()
-
-    async def HeartBeat(self):
+        # only writes to the database if something changed, either here or since the last save
+        try:
+            await self.HeartBeat()
+            if self.dirty and not self.canArchive():
+                await self.Save()
+        except Exception:
+            SCHEDULER.retry(self)  # whatever didn't get saved is still pending, the retry saves it
+            raise
+        SCHEDULER.failures.pop(self._id, None)
+        SCHEDULER.arm(self)
+        await self.flush()
+
+    async def HeartBeat(self) -> bool:
+        # returns whether anything changed
+        changed = False
         
-        for warrant in self.warrants:
+        for warrant in self.warrants.copy():
             if warrant.expires and datetime.datetime.now(datetime.timezone.utc) > warrant.expires:
-                self.warrants.remove(warrant)
+                self.removeWarrant(warrant)
+                changed = True
 
                 embed = discord.Embed(title="Warrant Expired", description=f"Warrant {warrant._id} has expired.", color=discord.Color.red())
                 embed.set_author(name=self.prisoner_name, icon_url=utils.twemojiPNG.chain)
@@ -299,6 +585,7 @@ class Prisoner:
         
         if nxt := self.getNextWarrant():
             nxt.activate()
+            changed = True
 
             embed = discord.Embed(title="Warrant Activated", description=f"Warrant `{nxt._id}` has been activated, you are now serving your sentence for this warrant specifically.", color=discord.Color.red())
             embed.add_field(name="Description", value=nxt.description)
@@ -314,57 +601,119 @@ class Prisoner:
             log("justice", "warrant", f"Warrant activated: {self.prisoner_name} ({nxt._id})")
         
         if self.canFree():
-            await self.release()
+            changed = await self.release() or changed
         else:
-            await self.book()
+            changed = await self.book() or changed
 
         if self.canArchive():
             await self.Archive()
 
+        return changed
+
 async def populatePrisoners(guild: discord.Guild):
     db_ = await db.create_connection("Warden")
     prisoners = await db_.find({}).to_list(length=None)
     for prisoner in prisoners:
         p = Prisoner(guild)
         p.loadFromDict(prisoner)
-        PRISONERS.append(p)
+        PRISONERS.addPrisoner(p)
+
+def indexWarrant(prisoner: "Prisoner", warrant: Warrant):
+    # for the warrant autocomplete, search by id, prisoner name or category
+    autocomplete.WARRANTS.add(
+        warrant._id,
+        autocomplete.optionLabel(f"{prisoner.prisoner_name} ({warrant.category})", warrant._id),
+        autocomplete.terms(warrant._id, prisoner.prisoner_name, warrant.category),
+        warrant.created.timestamp() if warrant.created else 0
+    )
 
 async def voidWarrantByID(warrant_id: str, reason: str = None):
-    for prisoner in PRISONERS:
-        for warrant in prisoner.warrants:
-            if warrant._id == warrant_id:
-                prisoner.warrants.remove(warrant)
-                embed = discord.Embed(title="Warrant Voided", description=f"Warrant `{warrant._id}` has been voided.", color=discord.Color.red())
-                if warrant.expires:
-                    embed.add_field(name="Expires", value=discord_dynamic_timestamp(warrant.expires, "FR"), inline=False)
-                    time_left_seconds = (warrant.expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
-                    embed.add_field(name="Expires (S)", value=utils.seconds_to_time_long(time_left_seconds), inline=False)
-                else:
-                    embed.add_field(name="Sentence Length", value=utils.seconds_to_time_long(warrant.len_seconds) if warrant.len_seconds > 0 else "Indefinite", inline=False)
-                embed.add_field(name="Description", value=warrant.description, inline=False)
-                if reason:
-                    embed.add_field(name="Reason For Voiding", value=reason, inline=False)
-                embed.set_author(name=prisoner.prisoner_name, icon_url=utils.twemojiPNG.ticket)
-                await prisoner.communicate(embed=embed)
-                log("justice", "warrant", f"Warrant voided: {prisoner.prisoner_name} ({warrant._id})")
-                return
+    warrant = PRISONERS.getWarrant(warrant_id)
+    if not warrant:
+        return
+    prisoner = warrant.owner
+    prisoner.removeWarrant(warrant)
+    embed = discord.Embed(title="Warrant Voided", description=f"Warrant `{warrant._id}` has been voided.", color=discord.Color.red())
+    if warrant.expires:
+        embed.add_field(name="Expires", value=discord_dynamic_timestamp(warrant.expires, "FR"), inline=False)
+        time_left_seconds = (warrant.expires - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        embed.add_field(name="Expires (S)", value=utils.seconds_to_time_long(time_left_seconds), inline=False)
+    else:
+        embed.add_field(name="Sentence Length", value=utils.seconds_to_time_long(warrant.len_seconds) if warrant.len_seconds > 0 else "Indefinite", inline=False)
+    embed.add_field(name="Description", value=warrant.description, inline=False)
+    if reason:
+        embed.add_field(name="Reason For Voiding", value=reason, inline=False)
+    embed.set_author(name=prisoner.prisoner_name, icon_url=utils.twemojiPNG.ticket)
+    await prisoner.communicate(embed=embed)
+    log("justice", "warrant", f"Warrant voided: {prisoner.prisoner_name} ({warrant._id})")
+    await prisoner.Tick()  # the next warrant might start, or they might be free now
+
+def findWarrants(prisoner: Prisoner = None, category: str = None, author: int = None, created_before: datetime.datetime = None) -> List[Warrant]:
+    # every warrant matching all of the filters given, only looks at one prisoner's warrants if there is one
+    warrants = prisoner.warrants if prisoner else PRISONERS.warrants.values()
+    return [
+        warrant for warrant in warrants
+        if (category is None or warrant.category == category)
+        and (author is None or warrant.author == author)
+        and (created_before is None or (warrant.created and warrant.created < created_before))
+    ]
+
+async def voidWarrants(warrants: List[Warrant], reason: str = None) -> Dict[Prisoner, discord.Embed]:
+    # voids them all in one go, each prisoner gets one message about all of theirs and one save instead of one per warrant
+    # returns the embed each prisoner was sent
+    by_prisoner: Dict[Prisoner, List[Warrant]] = {}
+    for warrant in warrants:
+        if warrant.owner and PRISONERS.getWarrant(warrant._id) is warrant:  # not already voided
+            by_prisoner.setdefault(warrant.owner, []).append(warrant)
+
+    embeds = {}
+    for prisoner, voided in by_prisoner.items():
+        for warrant in voided:
+            prisoner.removeWarrant(warrant)
+
+        embed = discord.Embed(title="Warrants Voided", description=f"{len(voided)} warrant{'s' if len(voided) != 1 else ''} voided, {len(prisoner.warrants)} remaining.", color=discord.Color.red())
+        for warrant in voided[:24]:  # discord allows 25 fields
+            if warrant.expires:
+                sentence = f"Expires {discord_dynamic_timestamp(warrant.expires, 'R')}"
+            else:
+                sentence = utils.seconds_to_time_long(warrant.len_seconds) if warrant.len_seconds > 0 else "Indefinite"
+            embed.add_field(name=f"`{warrant._id}` ({warrant.category})", value=f"{sentence}\n{warrant.description}"[:1024], inline=False)
+        if len(voided) > 24:
+            embed.add_field(name="More", value=f"And {len(voided) - 24} more.", inline=False)
+        if reason:
+            embed.add_field(name="Reason For Voiding", value=reason, inline=False)
+        if prisoner.committed:
+            embed.add_field(name="Total Time Served", value=utils.seconds_to_time_long(prisoner.total_time_served()), inline=False)
+        embed.set_author(name=prisoner.prisoner_name, icon_url=utils.twemojiPNG.ticket)
+        await prisoner.communicate(embed=embed)
+        log("justice", "warrant", f"Warrants voided: {prisoner.prisoner_name} ({', '.join(warrant._id for warrant in voided)})")
+        await prisoner.Tick()
+        embeds[prisoner] = embed
+    return embeds
+
+async def voidWarrantsByPrisoner(user_id: int, category: str = None, reason: str = None) -> Dict[Prisoner, discord.Embed]:
+    if prisoner := PRISONERS.getPrisoner(user_id):
+        return await voidWarrants(findWarrants(prisoner, category=category), reason)
+    return {}
+
+async def voidWarrantsByCategory(category: str, reason: str = None) -> Dict[Prisoner, discord.Embed]:
+    return await voidWarrants(findWarrants(category=category), reason)
+
+async def voidWarrantsByAuthor(author: int, reason: str = None) -> Dict[Prisoner, discord.Embed]:
+    return await voidWarrants(findWarrants(author=author), reason)
+
+async def voidWarrantsCreatedBefore(created_before: datetime.datetime, reason: str = None) -> Dict[Prisoner, discord.Embed]:
+    return await voidWarrants(findWarrants(created_before=created_before), reason)
 
 def getWarrantByID(warrant_id: str) -> Optional[Warrant]:
-    for prisoner in PRISONERS:
-        for warrant in prisoner.warrants:
-            if warrant._id.lower() == warrant_id.lower():
-                return warrant
+    return PRISONERS.getWarrant(warrant_id)
 
 def getPrisonerByWarrantID(warrant_id: str) -> Optional[Prisoner]:
-    for prisoner in PRISONERS:
-        for warrant in prisoner.warrants:
-            if warrant._id == warrant_id:
-                return prisoner
+    if warrant := PRISONERS.getWarrant(warrant_id):
+        return warrant.owner
 
 def getPrisonerByID(user_id: int) -> Optional[Prisoner]:
-    for prisoner in PRISONERS:
-        if prisoner._id == user_id:
-            return prisoner
+    return PRISONERS.getPrisoner(user_id)
 
 async def newWarrant(target: discord.Member, category: str, description: str, author: int, author_name: str, len_seconds: int) -> Warrant:
     warrant = Warrant().New(category, description, author, author_name, len_seconds)
@@ -383,14 +732,14 @@ async def newWarrant(target: discord.Member, category: str, description: str, au
     )
 
     if prisoner := getPrisonerByID(target.id):
-        prisoner.warrants.append(warrant)
+        prisoner.addWarrant(warrant)
         await prisoner.communicate(embed=embed)
         await prisoner.Tick()
         return warrant
     else:
         prisoner = Prisoner(target.guild).New(target, utils.normalUsername(target))
-        prisoner.warrants.append(warrant)
-        PRISONERS.append(prisoner)
+        PRISONERS.addPrisoner(prisoner)
+        prisoner.addWarrant(warrant)
         await prisoner.communicate(embed=embed)
         await prisoner.Tick()
         return warrant
\ No newline at end of file
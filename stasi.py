@@ -9,7 +9,7 @@ import yaml
 from discord.ext import commands
 import git
 
-from src import config, prison, vetting, administration, social, justice
+from src import config, metrics, perf, prison, vetting, administration, social, justice
 from src import stasilogging as logging
 
 # from disputils import BotEmbedPaginator, BotConfirmation, BotMultipleChoice
@@ -60,6 +60,17 @@ async def on_ready():  # I just like seeing basic info like this
         logging.log("main", "git", f"Git Commit: {sha}\nCommit Message: {message}\nBranch: {repo.active_branch}\nLast Commit Date: {repo.head.object.committed_datetime}", False, True)
         
 
+perf.instrumentDiscord()  # time spent on discord's API, and when each command first responds
+
+@bot.before_invoke
+async def before_command(ctx: discord.ApplicationContext):
+    ctx.timing = perf.begin(ctx.command.qualified_name)
+
+@bot.after_invoke
+async def after_command(ctx: discord.ApplicationContext):  # runs even if the command raised
+    if hasattr(ctx, "timing"):
+        perf.end(ctx.timing)
+
 @bot.event
 async def on_command_error(ctx: discord.ApplicationContext, error):  # share certain errors with the user
     if isinstance(error, commands.CommandNotFound):
@@ -81,7 +92,7 @@ async def on_command_error(ctx: discord.ApplicationContext, error):  # share cer
     logging.custom_exception_handler(type(error), error, error.__traceback__)
 
     logging.log("main", "runtime", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}'. Check runtimes.log for more details.")
-    logging.log("runtimes", "error", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}': \n```\n{error_raw}\n```", False, True)
+    logging.log("runtimes", "error", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}': \n```\n{error_raw}\n```", False, True, level="error")
 
 @bot.event
 async def on_application_command_error(ctx, error):  # share certain errors with the user
@@ -101,11 +112,12 @@ async def on_application_command_error(ctx, error):  # share certain errors with
         
     
     
+    metrics.COMMAND_ERRORS.inc(command=ctx.command.qualified_name if ctx.command else "unknown")
     error_raw = ''.join(traceback.format_exception(type(error), error, error.__traceback__))
     errortracking.report_error(error_raw)
 
     logging.log("main", "runtime", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}'. Check runtimes.log for more details.")
-    logging.log("runtimes", "error", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}': \n```\n{error_raw}\n```", False, True)
+    logging.log("runtimes", "error", f"Error {logging.lid(error)} in '{ctx.command}' by '{logging.log_user(ctx.author) if ctx.author else 'unknown'}': \n```\n{error_raw}\n```", False, True, level="error")
 
     await ctx.respond("That command caused an error. This has been reported to the developer.", ephemeral = True)
 
@@ -0,0 +1,293 @@
+"""
+Benchmarks the justice system's case lifecycle against a fake guild and in-memory storage.
+
+Drives Case.New, addJuror, motions (StatementMotion, OrderMotion, RushMotion) and voting, newEvidence,
+HeartBeat, Save, Zip and closeCase for a range of active case counts, then times Save/Zip/HeartBeat on
+cases with very large event logs. Results are written as JSON so two commits can be compared:
+
+    python tools/bench_cases.py --output before.json
+    (make changes)
+    python tools/bench_cases.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchfakes as bf
+
+bf.install()
+
+from src import casemanager as cm
+
+JURORS = list(range(2000, 2200))  # pool of eligible jurors
+PARTIES = list(range(1000, 1010))  # prosecutors and defendants are drawn from a small pool
+
+EVIDENCE_BYTES = 64 * 1024
+
+
+class Recorder:
+    def __init__(self):
+        self.latency: Dict[str, List[float]] = {}
+        self.bytes: Dict[str, List[int]] = {}
+        self.errors: Dict[str, int] = {}
+
+    async def run(self, name: str, coro):
+        before = bf.STATS.snapshot()
+        t = time.perf_counter()
+        try:
+            result = await coro
+        except Exception as e:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            if self.errors[name] == 1:
+                print(f"  {name} raised {type(e).__name__}: {e}", file=sys.stderr)
+            return None
+        elapsed = time.perf_counter() - t
+        after = bf.STATS.snapshot()
+        self.latency.setdefault(name, []).append(elapsed)
+        self.bytes.setdefault(name, []).append(
+            (after["bytes_written"] - before["bytes_written"]) + (after["gridfs_bytes_written"] - before["gridfs_bytes_written"])
+        )
+        return result
+
+    def report(self) -> dict:
+        out = {}
+        for name, samples in self.latency.items():
+            out[name] = bf.percentiles(samples)
+            written = self.bytes.get(name, [])
+            out[name]["bytes_per_op"] = round(sum(written) / len(written), 1) if written else 0
+        for name, count in self.errors.items():
+            out.setdefault(name, {"count": 0})["errors"] = count
+        return out
+
+
+def build_guild() -> bf.FakeGuild:
+    guild = bf.FakeGuild()
+    for member_id in PARTIES + JURORS:
+        guild.add_member(member_id)
+    return guild
+
+
+async def seed_users():
+    users = await cm.db.create_connection("users")
+    now = datetime.datetime.utcnow()
+    for member_id in JURORS:
+        await users.update_one({"_id": member_id}, {"$set": {"last_seen": now, "messages": 500}}, upsert=True)
+
+
+async def settle():
+    # Announce() and friends fire-and-forget with asyncio.gather, let them run before the next measurement
+    await asyncio.sleep(0)
+
+
+async def lifecycle(rec: Recorder, bot, guild: bf.FakeGuild, case: cm.Case):
+    jurors = random.sample(JURORS, cm.JURY_SIZE)
+    for juror_id in jurors:
+        await rec.run("addJuror", case.addJuror(guild.get_member(juror_id)))
+    await settle()
+
+    author = guild.get_member(case.prosecutor_id)
+    statement = await rec.run("StatementMotion.New", cm.StatementMotion(case).New(author, "The jury finds the benchmark to be satisfactory. " * 4))
+    await rec.run("HeartBeat", case.HeartBeat())  # puts the statement up for a vote
+
+    if statement is not None and case.motion_in_consideration is statement:
+        for juror_id in jurors:
+            statement.votes["Yes"].append(juror_id)
+            await rec.run("vote", case.Save())  # /case vote appends and saves
+        await rec.run("HeartBeat", case.HeartBeat())  # closes the vote and executes the motion
+
+    await rec.run("OrderMotion.New", cm.OrderMotion(case).New(author, "The defendant", "Comply with the benchmark. " * 4))
+    second = await rec.run("StatementMotion.New", cm.StatementMotion(case).New(author, "A second statement to be rushed ahead. " * 4))
+
+    exhibit = await rec.run("newEvidence", case.newEvidence(author, "exhibit.txt", io.BytesIO(os.urandom(EVIDENCE_BYTES))))
+    if exhibit is not None:
+        exhibit.alt_text = "Benchmark exhibit"  # /case evidence upload sets this right after newEvidence
+    await rec.run("Save", case.Save())
+    await rec.run("Zip", case.Zip())
+    await rec.run("Zip (admin)", case.Zip(admin=True))
+
+    if second is not None:
+        await rec.run("RushMotion.New", cm.RushMotion(case).New(author, second.id, "It's urgent."))
+
+    await rec.run("closeCase", case.closeCase("Benchmark finished"))
+    await settle()
+
+
+async def bench_case_counts(counts: List[int], sample: int) -> dict:
+    results = {}
+    for count in counts:
+        bf.reset()
+        cm.ACTIVECASES.clear()
+        guild = build_guild()
+        bot = bf.FakeBot(guild)
+        cm.config.set_global("bot", bot)
+        cm.config.set_global("guild", guild)
+        await seed_users()
+
+        rec = Recorder()
+        t = time.perf_counter()
+
+        # Case.New only has 900 ids per day (MMDDYYYY-100 to -999), so the bulk of the active cases are
+        # loaded from documents with their own ids, the same way populateActiveCases does at startup
+        for i in range(max(0, count - sample)):
+            await rec.run("loadFromDict", load_case(bot, guild, background_case(i)))
+
+        cases = []
+        for i in range(min(sample, count)):
+            prosecutor, defense = random.sample(PARTIES, 2)
+            case = await rec.run("Case.New", cm.Case(bot, guild).New(
+                guild.get_member(prosecutor), guild.get_member(defense), [], f"Benchmark case {i}"
+            ))
+            if case is not None:
+                cases.append(case)
+        await settle()
+
+        for case in cases:
+            await lifecycle(rec, bot, guild, case)
+
+        results[str(count)] = {
+            "operations": rec.report(),
+            "total_seconds": round(time.perf_counter() - t, 3),
+            "storage": bf.STATS.snapshot(),
+        }
+        print(f"cases={count}: {results[str(count)]['total_seconds']}s", file=sys.stderr)
+    return results
+
+
+def background_case(i: int) -> dict:
+    now = datetime.datetime.utcnow()
+    prosecutor, defense = random.sample(PARTIES, 2)
+    return {
+        "_id": f"bench-{i}",
+        "title": f"member{prosecutor} v. member{defense}",
+        "description": f"Background case {i}",
+        "status": "Argumentation and Case Body",
+        "filed_date": now,
+        "prosecutor_id": prosecutor,
+        "defense_id": defense,
+        "personal_statements": [],
+        "motion_in_consideration": None,
+        "locks": [],
+        "penalties": [],
+        "plea_deal_penalties": [],
+        "plea_deal_expiration": None,
+        "stage": 2,
+        "guilty": None,
+        "evidence_number": 101,
+        "evidence": [],
+        "motion_number": 101,
+        "motion_queue": [],
+        "jury_pool_ids": random.sample(JURORS, cm.JURY_SIZE),
+        "jury_invites": [],
+        "anonymization": {},
+        "known_users": {},
+        "votes": {},
+        "event_log": [],
+        "juror_chat_log": [],
+        "no_tick": False,
+    }
+
+
+async def load_case(bot, guild, d: dict) -> cm.Case:
+    case = cm.Case(bot, guild).loadFromDict(d)
+    cm.ACTIVECASES.append(case)
+    cm.indexCase(case)
+    return case
+
+
+def synthetic_events(case: cm.Case, n: int) -> List[dict]:
+    now = datetime.datetime.now(datetime.timezone.utc)
+    events = []
+    for i in range(n):
+        ts = now - datetime.timedelta(seconds=n - i)
+        events.append({
+            "event_id": "personal_statement",
+            "name": f"Statement {i}",
+            "desc": f"Synthetic event {i} for case {case.id}. " * 3,
+            "timestamp": ts,
+            "timestamp_utc": ts.timestamp(),
+            "statement": {"author_id": case.prosecutor_id, "content": "filler " * 10, "timestamp": ts},
+        })
+    return events
+
+
+async def bench_event_logs(sizes: List[int], repeat: int) -> dict:
+    results = {}
+    for size in sizes:
+        bf.reset()
+        cm.ACTIVECASES.clear()
+        guild = build_guild()
+        bot = bf.FakeBot(guild)
+        cm.config.set_global("bot", bot)
+        cm.config.set_global("guild", guild)
+        await seed_users()
+
+        prosecutor, defense = random.sample(PARTIES, 2)
+        case = await cm.Case(bot, guild).New(guild.get_member(prosecutor), guild.get_member(defense), [], "Event log benchmark")
+        for juror_id in random.sample(JURORS, cm.JURY_SIZE):
+            await case.addJuror(guild.get_member(juror_id))
+        case.event_log.extend(synthetic_events(case, size))
+        await settle()
+
+        rec = Recorder()
+        for _ in range(repeat):
+            await rec.run("Save", case.Save())
+            await rec.run("HeartBeat", case.HeartBeat())
+            await rec.run("Zip", case.Zip())
+            await settle()
+        results[str(size)] = {"operations": rec.report()}
+        print(f"event_log={size}: Save p50 {results[str(size)]['operations'].get('Save', {}).get('p50_ms')}ms", file=sys.stderr)
+    return results
+
+
+async def main(args):
+    random.seed(args.seed)
+    results = {
+        "case_counts": await bench_case_counts(args.cases, args.sample),
+        "event_logs": await bench_event_logs(args.events, args.repeat),
+    }
+    return {
+        "benchmark": "cases",
+        "commit": bf.git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "args": vars(args),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", type=int, nargs="+", default=[10, 100, 1000, 5000], help="active case counts to run the lifecycle against")
+    parser.add_argument("--sample", type=int, default=20, help="cases per count that go through the full lifecycle")
+    parser.add_argument("--events", type=int, nargs="+", default=[100, 1000, 10000], help="event log sizes for the Save/Zip benchmark")
+    parser.add_argument("--repeat", type=int, default=10, help="iterations per event log size")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_cases.json")
+    parser.add_argument("--compare", help="previous result file to diff against")
+    args = parser.parse_args()
+
+    # motions and cases print from __del__ and close(), keep that out of the way of the results
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        output = asyncio.run(main(args))
+    compare_to = args.compare
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"Wrote {args.output}")
+
+    if compare_to:
+        with open(compare_to) as f:
+            previous = json.load(f)
+        for line in bf.compare(previous, output) or ["No p50 moved more than 10%"]:
+            print(line)
@@ -0,0 +1,306 @@
+"""
+Load simulation for the warden against a fake guild and in-memory storage.
+
+Seeds N prisoners with M warrants each in a mix of states (timed and running, timed and waiting, indefinite, frozen,
+no_enforce), loads them with populatePrisoners, and then drives them the way the bot would:
+
+    startup   every prisoner ticked once, like WarrantScheduler.start()
+    idle      every prisoner ticked again with nothing due, which should write nothing
+    expiry    a virtual clock is moved forward in steps, ticking whoever the scheduler has due at each step
+    issue     newWarrant against existing prisoners and members who aren't prisoners yet
+    void      voidWarrantByID on random warrants
+    void_bulk voidWarrantsByCategory on one of the categories
+
+Each phase reports per-operation latency along with database writes, bytes written, role edits and notifications
+(DMs to prisoners plus posts to the warrant_updates log, and how many there would've been without coalescing). Results are written as JSON, like bench_cases.py:
+
+    python tools/bench_warden.py --output before.json
+    (make changes)
+    python tools/bench_warden.py --output after.json --compare before.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import heapq
+import json
+import os
+import platform
+import random
+import sys
+import time
+from typing import *
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import benchfakes as bf
+
+bf.install()
+
+from src import config
+from src import rolequeue
+from src import warden
+
+FIRST_MEMBER = 10000
+HOUR = 3600
+
+CHANNEL_LOGS = {"count": 0}
+
+
+async def countingChannelLog(content=None, embed=None, category=None, dry=False, embeds=None):
+    # the real one sleeps 0.1s per channel before posting, which would be all this measures at 10k prisoners
+    CHANNEL_LOGS["count"] += 1
+
+
+class Phase:
+    def __init__(self, guild: bf.FakeGuild):
+        self.guild = guild
+        self.latency: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+        self.before = self.counters()
+        self.started = time.perf_counter()
+
+    def counters(self) -> dict:
+        stats = bf.STATS.snapshot()
+        return {
+            "db_writes": stats["db_writes"],
+            "bytes_written": stats["bytes_written"],
+            "dms": stats["messages_sent"],
+            "channel_logs": CHANNEL_LOGS["count"],
+            "role_edits_queued": rolequeue.STATS["queued"],
+            "notifications_requested": warden.NOTIFICATION_STATS["requested"],
+        }
+
+    async def run(self, name: str, coro):
+        t = time.perf_counter()
+        try:
+            result = await coro
+        except Exception as e:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            if self.errors[name] == 1:
+                print(f"  {name} raised {type(e).__name__}: {e}", file=sys.stderr)
+            return None
+        self.latency.setdefault(name, []).append(time.perf_counter() - t)
+        return result
+
+    def report(self, **extra) -> dict:
+        after = self.counters()
+        totals = {key: after[key] - self.before[key] for key in after}
+        totals["notifications"] = totals["dms"] + totals["channel_logs"]
+        out = {
+            "operations": {name: bf.percentiles(samples) for name, samples in self.latency.items()},
+            "totals": totals,
+            "seconds": round(time.perf_counter() - self.started, 3),
+            **extra,
+        }
+        for name, count in self.errors.items():
+            out["operations"].setdefault(name, {"count": 0})["errors"] = count
+        return out
+
+
+def warrant_doc(i: int, state: str, now: datetime.datetime, horizon: float) -> dict:
+    length = random.randint(600, int(horizon))
+    doc = {
+        "_id": f"{1000 + i % 9000}-Bench-{i}",
+        "category": random.choice(["mute", "ban", "court", "admin"]),
+        "description": f"Benchmark warrant {i} ({state})",
+        "author": 1,
+        "author_name": "stasi",
+        "created": now - datetime.timedelta(seconds=random.randint(0, 7 * 24 * HOUR)),
+        "started": None,
+        "len_seconds": length,
+        "expires": None,
+        "frozen": None,
+        "no_enforce": None,
+    }
+    if state == "running":
+        doc["started"] = now - datetime.timedelta(seconds=random.randint(0, length))
+        doc["expires"] = doc["started"] + datetime.timedelta(seconds=length)
+    elif state == "indefinite":
+        doc["len_seconds"] = -1
+    elif state == "frozen":
+        doc["frozen"] = True
+    elif state == "no_enforce":
+        doc["no_enforce"] = True
+    return doc
+
+
+def prisoner_doc(user_id: int, warrants: int, now: datetime.datetime, horizon: float, counter: Iterator[int]) -> dict:
+    # at most one running sentence and it has to come first, that's how the warden leaves them
+    states = []
+    if random.random() < 0.6:
+        states.append("running")
+    while len(states) < warrants:
+        states.append(random.choices(["waiting", "indefinite", "frozen", "no_enforce"], weights=[5, 2, 2, 1])[0])
+    docs = [warrant_doc(next(counter), state, now, horizon) for state in states]
+    enforced = any(not doc["frozen"] and not doc["no_enforce"] for doc in docs)
+    return {
+        "_id": user_id,
+        "guild": 1,
+        "prisoner_name": f"member{user_id}",
+        "roles": [config.C["leftwing_role"]] if enforced else [],
+        "committed": now - datetime.timedelta(hours=random.randint(1, 48)) if enforced else None,
+        "warrants": docs,
+    }
+
+
+def reset_warden():
+    warden.PRISONERS.prisoners.clear()
+    warden.PRISONERS.warrants.clear()
+    warden.SCHEDULER.heap.clear()
+    warden.SCHEDULER.armed.clear()
+    warden.SCHEDULER.failures.clear()
+    warden.SCHEDULER.ticks = 0
+    for key in rolequeue.STATS:
+        rolequeue.STATS[key] = 0
+    for key in warden.NOTIFICATION_STATS:
+        warden.NOTIFICATION_STATS[key] = 0
+    CHANNEL_LOGS["count"] = 0
+
+
+def due(now: datetime.datetime) -> List[warden.Prisoner]:
+    # what WarrantScheduler.run would tick at now, without sleeping for it
+    scheduler = warden.SCHEDULER
+    prisoners = []
+    while scheduler.heap and scheduler.heap[0][0] <= now:
+        deadline, user_id = heapq.heappop(scheduler.heap)
+        if scheduler.armed.get(user_id) != deadline:
+            continue
+        del scheduler.armed[user_id]
+        if prisoner := warden.PRISONERS.getPrisoner(user_id):
+            prisoners.append(prisoner)
+    return prisoners
+
+
+async def drain():
+    # lets the role queue catch up so its edits land in the phase that caused them
+    while rolequeue.queueDepth():
+        await asyncio.sleep(0.01)
+
+
+async def simulate(count: int, args, clock: bf.VirtualClock) -> dict:
+    bf.reset()
+    reset_warden()
+    clock.set(datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc))
+    horizon = args.hours * HOUR
+
+    guild = bf.FakeGuild()
+    guild.add_member(1, name="stasi")  # authors the warrants newWarrant issues
+    bot = bf.FakeBot(guild)
+    config.set_global("bot", bot)
+    config.set_global("guild", guild)
+    prison_role = guild.get_role(config.C["prison_role"])
+
+    collection = bf.DB["Warden"]
+    counter = iter(range(10 ** 9))
+    for user_id in range(FIRST_MEMBER, FIRST_MEMBER + count):
+        member = guild.add_member(user_id)
+        doc = prisoner_doc(user_id, args.warrants, clock.now(datetime.timezone.utc), horizon, counter)
+        if doc["roles"]:
+            member.roles = [prison_role]
+        collection.docs[user_id] = bf.roundtrip(doc)
+    newcomers = [guild.add_member(FIRST_MEMBER + count + i) for i in range(args.operations)]
+    bf.STATS.reset()
+
+    results = {}
+
+    phase = Phase(guild)
+    await phase.run("populatePrisoners", warden.populatePrisoners(guild))
+    results["populate"] = phase.report(prisoners=len(warden.PRISONERS), warrants=len(warden.PRISONERS.warrants))
+
+    for name in ("startup", "idle"):
+        phase = Phase(guild)
+        for prisoner in warden.PRISONERS:
+            await phase.run("Tick", warden.SCHEDULER.tick(prisoner))
+        await drain()
+        results[name] = phase.report(prisoners=len(warden.PRISONERS))
+
+    phase = Phase(guild)
+    steps, ticked = 0, []
+    while steps * args.step < horizon:
+        clock.advance(args.step)
+        steps += 1
+        prisoners = due(clock.now(datetime.timezone.utc))
+        ticked.append(len(prisoners))
+        t = time.perf_counter()
+        for prisoner in prisoners:
+            await phase.run("Tick", warden.SCHEDULER.tick(prisoner))
+        if prisoners:
+            phase.latency.setdefault("step", []).append(time.perf_counter() - t)
+        await drain()
+    results["expiry"] = phase.report(
+        virtual_hours=args.hours, steps=steps, max_due_per_step=max(ticked, default=0),
+        prisoners_left=len(warden.PRISONERS), armed=len(warden.SCHEDULER.armed),
+    )
+
+    phase = Phase(guild)
+    existing = random.sample(list(warden.PRISONERS.prisoners), min(args.operations, len(warden.PRISONERS)))
+    targets = [guild.get_member(user_id) for user_id in existing] + newcomers
+    random.shuffle(targets)
+    for target in targets[:args.operations]:
+        await phase.run("newWarrant", warden.newWarrant(target, "bench", "Issued by the benchmark", 1, "stasi", random.randint(600, int(horizon))))
+    await drain()
+    results["issue"] = phase.report()
+
+    phase = Phase(guild)
+    for warrant_id in random.sample(list(warden.PRISONERS.warrants), min(args.operations, len(warden.PRISONERS.warrants))):
+        await phase.run("voidWarrantByID", warden.voidWarrantByID(warrant_id, "Voided by the benchmark"))
+    await drain()
+    results["void"] = phase.report()
+
+    phase = Phase(guild)
+    await phase.run("voidWarrantsByCategory", warden.voidWarrantsByCategory("admin", "Voided by the benchmark"))
+    await drain()
+    results["void_bulk"] = phase.report(warrants_left=len(warden.PRISONERS.warrants))
+
+    results["role_edits"] = sum(member.role_edits for member in guild.members.values())
+    line = ", ".join(f"{name} {results[name]['totals']['db_writes']}w/{results[name]['totals']['notifications']}n" for name in ("startup", "idle", "expiry", "issue", "void", "void_bulk"))
+    print(f"prisoners={count}: {line}", file=sys.stderr)
+    return results
+
+
+async def main(args):
+    random.seed(args.seed)
+    clock = bf.VirtualClock()
+    clock.install(warden)
+    warden.channelLog = countingChannelLog
+    # the queue's rate limit is real time, it would only make the benchmark wait on nothing
+    config.C["role_edits"] = {"per_second": 1000000, "burst": 1000000, "retries": 0, "backoff": 0}
+
+    results = {}
+    for count in args.prisoners:
+        results[str(count)] = await simulate(count, args, clock)
+    return {
+        "benchmark": "warden",
+        "commit": bf.git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "args": vars(args),
+        "results": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--prisoners", type=int, nargs="+", default=[100, 1000, 10000], help="prisoner counts to simulate")
+    parser.add_argument("--warrants", type=int, default=3, help="warrants per prisoner")
+    parser.add_argument("--hours", type=float, default=48, help="virtual time to run the expiry phase for, also the longest sentence")
+    parser.add_argument("--step", type=float, default=300, help="virtual seconds between scheduler checks")
+    parser.add_argument("--operations", type=int, default=100, help="warrants issued and voided in their phases")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench_warden.json")
+    parser.add_argument("--compare", help="previous result file to diff against")
+    args = parser.parse_args()
+
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        output = asyncio.run(main(args))
+
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2, default=str)
+    print(f"Wrote {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        for line in bf.compare(previous, output) or ["No p50 moved more than 10%"]:
+            print(line)
@@ -0,0 +1,756 @@
+"""
+Fake discord objects and an in-memory stand-in for MongoDB/GridFS, used by the benchmark scripts in this folder.
+
+install() has to be called before anything from src is imported, it replaces src.config and src.database
+(both of which read config.yml and connect to mongo on import) and swaps the GridFS bucket in src.gridfs
+for an in-memory one. Everything written to the fake storage is counted so benchmarks can report bytes written.
+"""
+
+import copy
+import datetime
+import io
+import os
+import sys
+import types
+from typing import *
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import bson
+except ImportError:  # comes with pymongo, but sizes can still be estimated without it
+    bson = None
+
+
+def encoded_size(doc) -> int:
+    if bson is not None:
+        try:
+            return len(bson.encode(doc))
+        except Exception:
+            pass
+    return len(repr(doc).encode("utf-8"))
+
+
+def roundtrip(doc):
+    # what comes back out of mongo is never the same object that went in, and datetimes come back naive
+    if bson is not None:
+        try:
+            return bson.decode(bson.encode(doc))
+        except Exception:
+            pass
+    return copy.deepcopy(doc)
+
+
+class Stats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.db_writes = 0
+        self.db_reads = 0
+        self.bytes_written = 0
+        self.gridfs_writes = 0
+        self.gridfs_reads = 0
+        self.gridfs_bytes_written = 0
+        self.messages_sent = 0
+
+    def snapshot(self) -> dict:
+        return dict(self.__dict__)
+
+
+STATS = Stats()
+
+
+# --- storage ---
+
+def _get_path(doc: dict, path: str):
+    parts = path.split(".")
+    for i, part in enumerate(parts):
+        if isinstance(doc, list):
+            # "evidence.file_id" matches against the file_id of every entry, like mongo does
+            values = []
+            for item in doc:
+                value, exists = _get_path(item, ".".join(parts[i:]))
+                if exists:
+                    values.extend(value if isinstance(value, list) else [value])
+            return values, bool(values)
+        if not isinstance(doc, dict) or part not in doc:
+            return None, False
+        doc = doc[part]
+    return doc, True
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for key, condition in query.items():
+        if key == "$or":
+            if not any(_matches(doc, sub) for sub in condition):
+                return False
+            continue
+        value, exists = _get_path(doc, key)
+        if isinstance(condition, dict) and any(k.startswith("$") for k in condition):
+            for op, operand in condition.items():
+                if op == "$exists":
+                    if exists != bool(operand):
+                        return False
+                elif op == "$gt":
+                    if not exists or value is None or not value > operand:
+                        return False
+                elif op == "$gte":
+                    if not exists or value is None or not value >= operand:
+                        return False
+                elif op == "$lt":
+                    if not exists or value is None or not value < operand:
+                        return False
+                elif op == "$lte":
+                    if not exists or value is None or not value <= operand:
+                        return False
+                elif op == "$in":
+                    if not (any(v in operand for v in value) if isinstance(value, list) else value in operand):
+                        return False
+                elif op == "$nin":
+                    if value in operand:
+                        return False
+                elif op == "$ne":
+                    if value == operand:
+                        return False
+                elif op in ("$regex", "$options"):
+                    import re
+                    if op == "$options":
+                        continue
+                    flags = re.I if "i" in condition.get("$options", "") else 0
+                    if not isinstance(value, str) or not re.search(operand, value, flags):
+                        return False
+                else:
+                    raise NotImplementedError(f"Fake collection doesn't support {op}")
+        elif isinstance(value, list) and not isinstance(condition, list):
+            if condition not in value:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _project(doc: dict, projection: Optional[dict]) -> dict:
+    if not projection:
+        return doc
+    included = [key for key, on in projection.items() if on]
+    if not included:
+        return {k: v for k, v in doc.items() if k not in projection}
+    out = {"_id": doc.get("_id")}
+    for path in included:
+        head, _, rest = path.partition(".")
+        if head not in doc:
+            continue
+        if not rest:
+            out[head] = doc[head]
+        elif isinstance(doc[head], list):
+            existing = out.setdefault(head, [{} for _ in doc[head]])
+            for i, item in enumerate(doc[head]):
+                if isinstance(item, dict) and rest in item:
+                    existing[i][rest] = item[rest]
+        elif isinstance(doc[head], dict):
+            out.setdefault(head, {}).update(_project(doc[head], {rest: True}))
+    return out
+
+
+def _set_path(doc: dict, path: str, value, array_filters: List[dict] = None):
+    parts = path.split(".")
+    targets = [doc]
+    for i, part in enumerate(parts):
+        last = i == len(parts) - 1
+        next_targets = []
+        for target in targets:
+            if part.startswith("$[") and part.endswith("]"):
+                name = part[2:-1]
+                conditions = {}
+                for f in array_filters or []:
+                    for key, cond in f.items():
+                        if key.split(".")[0] == name:
+                            conditions[key.partition(".")[2]] = cond
+                for j, item in enumerate(target):
+                    if _matches(item, conditions):
+                        if last:
+                            target[j] = value
+                        else:
+                            next_targets.append(item)
+            else:
+                if last:
+                    target[part] = value
+                else:
+                    next_targets.append(target.setdefault(part, {}))
+        targets = next_targets
+
+
+class FakeCursor:
+    def __init__(self, docs: List[dict]):
+        self.docs = docs
+
+    def sort(self, key, direction=1):
+        self.docs.sort(key=lambda d: (d.get(key) is None, d.get(key)), reverse=direction == -1)
+        return self
+
+    def limit(self, n):
+        if n:
+            self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, length=None):
+        STATS.db_reads += 1
+        return self.docs[:length] if length else list(self.docs)
+
+    def __aiter__(self):
+        self._iter = iter(self.docs)
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._iter)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeResult:
+    def __init__(self, count=0, upserted_id=None):
+        self.modified_count = count
+        self.matched_count = count
+        self.deleted_count = count
+        self.upserted_id = upserted_id
+        self.inserted_id = upserted_id
+
+
+class FakeCollection:
+    def __init__(self, name: str):
+        self.name = name
+        self.docs: Dict[Any, dict] = {}
+
+    def find(self, query: dict = None, projection: dict = None, **kwargs):
+        query = query or {}
+        return FakeCursor([_project(roundtrip(doc), projection) for doc in self.docs.values() if _matches(doc, query)])
+
+    async def find_one(self, query: dict = None, projection: dict = None):
+        STATS.db_reads += 1
+        query = query or {}
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self.docs.get(query["_id"])
+            return _project(roundtrip(doc), projection) if doc is not None and _matches(doc, query) else None
+        for doc in self.docs.values():
+            if _matches(doc, query):
+                return _project(roundtrip(doc), projection)
+        return None
+
+    async def count_documents(self, query: dict):
+        return len([doc for doc in self.docs.values() if _matches(doc, query)])
+
+    async def insert_one(self, doc: dict):
+        STATS.db_writes += 1
+        STATS.bytes_written += encoded_size(doc)
+        self.docs[doc["_id"]] = roundtrip(doc)
+        return FakeResult(1, doc["_id"])
+
+    async def update_one(self, query: dict, update: dict, upsert: bool = False, array_filters: List[dict] = None):
+        doc = self._update(query, update, upsert, array_filters)
+        return FakeResult(1 if doc is not None else 0)
+
+    async def find_one_and_update(self, query: dict, update: dict, upsert: bool = False, return_document=False, **kwargs):
+        before = None
+        for candidate in self.docs.values():
+            if _matches(candidate, query):
+                before = roundtrip(candidate)
+                break
+        doc = self._update(query, update, upsert, kwargs.get("array_filters"))
+        if doc is None:
+            return None
+        return roundtrip(doc) if return_document else before
+
+    def _update(self, query: dict, update: dict, upsert: bool, array_filters: List[dict]):
+        STATS.db_writes += 1
+        STATS.bytes_written += encoded_size({"q": query, "u": update})
+        doc = None
+        for candidate in self._candidates(query):
+            if _matches(candidate, query):
+                doc = candidate
+                break
+        update = roundtrip(update)
+        if doc is None:
+            if not upsert:
+                return None
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            self.docs[doc["_id"]] = doc
+            for key, value in update.get("$setOnInsert", {}).items():
+                _set_path(doc, key, value)
+        for key, value in update.get("$set", {}).items():
+            _set_path(doc, key, value, array_filters)
+        for key in update.get("$unset", {}):
+            doc.pop(key, None)
+        for key, value in update.get("$inc", {}).items():
+            current, _ = _get_path(doc, key)
+            _set_path(doc, key, (current or 0) + value)
+        for key, value in update.get("$push", {}).items():
+            current, _ = _get_path(doc, key)
+            values = value["$each"] if isinstance(value, dict) and "$each" in value else [value]
+            _set_path(doc, key, (current or []) + values)
+        for key, condition in update.get("$pull", {}).items():
+            current, _ = _get_path(doc, key)
+            if current:
+                if isinstance(condition, dict):
+                    _set_path(doc, key, [item for item in current if not _matches(item, condition)])
+                else:
+                    _set_path(doc, key, [item for item in current if item != condition])
+        return doc
+
+    async def delete_one(self, query: dict):
+        STATS.db_writes += 1
+        for doc in self._candidates(query):
+            if _matches(doc, query):
+                del self.docs[doc["_id"]]
+                return FakeResult(1)
+        return FakeResult(0)
+
+    def _candidates(self, query: dict) -> List[dict]:
+        # an exact _id only has to look at one document, the warden benchmark updates thousands of them by _id
+        if "_id" in query and not isinstance(query["_id"], dict):
+            doc = self.docs.get(query["_id"])
+            return [doc] if doc is not None else []
+        return list(self.docs.values())
+
+    async def delete_many(self, query: dict):
+        STATS.db_writes += 1
+        doomed = [key for key, doc in self.docs.items() if _matches(doc, query)]
+        for key in doomed:
+            del self.docs[key]
+        return FakeResult(len(doomed))
+
+    async def create_index(self, *args, **kwargs):
+        return None
+
+
+class FakeDatabase:
+    def __init__(self):
+        self.collections: Dict[str, FakeCollection] = {}
+
+    def __getitem__(self, name: str) -> FakeCollection:
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+    def reset(self):
+        self.collections = {}
+
+
+DB = FakeDatabase()
+
+
+class FakeGridOut:
+    def __init__(self, file_id, stored: dict):
+        self._id = file_id
+        self.filename = stored["filename"]
+        self.metadata = stored["metadata"]
+        self.length = len(stored["data"])
+        self.upload_date = stored["uploadDate"]
+        self.uploadDate = stored["uploadDate"]
+        self._data = io.BytesIO(stored["data"])
+
+    async def read(self, size=-1):
+        STATS.gridfs_reads += 1
+        return self._data.read(size)
+
+    async def readchunk(self):
+        return self._data.read(255 * 1024)
+
+
+class FakeGridIn:
+    def __init__(self, bucket: "FakeGridFSBucket", file_id, filename: str, metadata: dict):
+        self.bucket = bucket
+        self._id = file_id
+        self.filename = filename
+        self.metadata = metadata
+        self._data = io.BytesIO()
+        self.closed = False
+
+    async def write(self, data):
+        self._data.write(data)
+
+    async def close(self):
+        self.bucket._store(self._id, self.filename, self._data.getvalue(), self.metadata)
+        self.closed = True
+
+    async def abort(self):
+        self.closed = True
+
+
+class FakeGridFSBucket:
+    def __init__(self):
+        self.files: Dict[Any, dict] = {}
+
+    def _store(self, file_id, filename, data: bytes, metadata):
+        STATS.gridfs_writes += 1
+        STATS.gridfs_bytes_written += len(data)
+        self.files[file_id] = {
+            "filename": filename,
+            "data": data,
+            "metadata": metadata or {},
+            "uploadDate": datetime.datetime.utcnow(),
+        }
+
+    async def upload_from_stream_with_id(self, file_id, filename, source, metadata=None, **kwargs):
+        data = source.read() if hasattr(source, "read") else bytes(source)
+        self._store(file_id, filename, data, metadata)
+
+    async def upload_from_stream(self, filename, source, metadata=None, **kwargs):
+        from bson import ObjectId
+        file_id = ObjectId()
+        await self.upload_from_stream_with_id(file_id, filename, source, metadata)
+        return file_id
+
+    def open_upload_stream_with_id(self, file_id, filename, metadata=None, **kwargs):
+        return FakeGridIn(self, file_id, filename, metadata)
+
+    def open_upload_stream(self, filename, metadata=None, **kwargs):
+        from bson import ObjectId
+        return FakeGridIn(self, ObjectId(), filename, metadata)
+
+    async def open_download_stream(self, file_id):
+        if file_id not in self.files:
+            import gridfs
+            raise gridfs.errors.NoFile(f"no file {file_id}")
+        return FakeGridOut(file_id, self.files[file_id])
+
+    async def delete(self, file_id):
+        if file_id not in self.files:
+            import gridfs
+            raise gridfs.errors.NoFile(f"no file {file_id}")
+        del self.files[file_id]
+
+    def find(self, query: dict = None, **kwargs):
+        docs = [
+            {"_id": file_id, "filename": f["filename"], "metadata": f["metadata"], "length": len(f["data"]), "uploadDate": f["uploadDate"]}
+            for file_id, f in self.files.items()
+        ]
+        docs = [doc for doc in docs if _matches(doc, query or {})]
+        for key, direction in reversed(kwargs.get("sort") or []):
+            docs.sort(key=lambda doc: doc[key], reverse=direction == -1)
+        if kwargs.get("limit"):
+            docs = docs[:kwargs["limit"]]
+        # motor's cursor hands out GridOut objects, not documents
+        return FakeCursor([FakeGridOut(doc["_id"], self.files[doc["_id"]]) for doc in docs])
+
+
+BUCKET = FakeGridFSBucket()
+
+
+# --- discord ---
+
+class FakePermissions:
+    def __init__(self, administrator=False):
+        self.administrator = administrator
+        self.ban_members = administrator
+        self.kick_members = administrator
+        self.manage_roles = administrator
+
+
+class FakeRole:
+    def __init__(self, role_id: int, name: str = None):
+        self.id = role_id
+        self.name = name or f"role-{role_id}"
+
+    def __eq__(self, other):
+        return isinstance(other, FakeRole) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMessage:
+    def __init__(self, content=None, embed=None, embeds=None):
+        self.content = content
+        self.embeds = embeds or ([embed] if embed else [])
+
+    async def edit(self, **kwargs):
+        return self
+
+
+class FakeMessageable:
+    async def send(self, content=None, embed=None, embeds=None, file=None, files=None, **kwargs):
+        STATS.messages_sent += 1
+        return FakeMessage(content, embed, embeds)
+
+
+class FakeMember(FakeMessageable):
+    def __init__(self, guild: "FakeGuild", member_id: int, name: str = None, administrator: bool = False):
+        self.guild = guild
+        self.id = member_id
+        self.name = name or f"member{member_id}"
+        self.discriminator = "0"
+        self.display_name = self.name
+        self.mention = f"<@{member_id}>"
+        self.bot = False
+        self.guild_permissions = FakePermissions(administrator)
+        self.roles: List[FakeRole] = []
+        self.role_edits = 0
+
+    async def edit(self, roles=None, **kwargs):
+        self.role_edits += 1
+        if roles is not None:
+            self.roles = [role for role in roles if role]
+
+    def __str__(self):
+        return self.name
+
+
+class FakeChannel(FakeMessageable):
+    def __init__(self, guild: "FakeGuild", channel_id: int):
+        self.guild = guild
+        self.id = channel_id
+        self.name = f"channel{channel_id}"
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int = 1, members: int = 0):
+        self.id = guild_id
+        self.name = "Benchmark Guild"
+        self.members: Dict[int, FakeMember] = {}
+        self.roles: Dict[int, FakeRole] = {}
+        self.channels: Dict[int, FakeChannel] = {}
+        for i in range(members):
+            self.add_member(1000 + i)
+
+    def add_member(self, member_id: int, **kwargs) -> FakeMember:
+        member = FakeMember(self, member_id, **kwargs)
+        self.members[member_id] = member
+        return member
+
+    def get_member(self, member_id: int) -> Optional[FakeMember]:
+        return self.members.get(member_id)
+
+    def get_role(self, role_id: int) -> Optional[FakeRole]:
+        if role_id not in self.roles:
+            self.roles[role_id] = FakeRole(role_id)
+        return self.roles[role_id]
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+
+class FakeBot:
+    def __init__(self, guild: FakeGuild):
+        self.guild = guild
+        self.guilds = [guild]
+        self.user = FakeMember(guild, 1, "stasi")
+
+    def get_guild(self, guild_id):
+        return self.guild
+
+    def get_channel(self, channel_id):
+        return self.guild.get_channel(channel_id)
+
+    def get_user(self, user_id):
+        return self.guild.get_member(user_id)
+
+
+# --- time ---
+
+class VirtualClock:
+    """
+    Stands in for datetime.datetime.now() in the modules it's installed into, so a benchmark can skip ahead hours
+    without waiting for them. Only now() is faked, the rest of the datetime module is the real one.
+    """
+
+    def __init__(self, start: datetime.datetime = None):
+        self.current = start or datetime.datetime.now(datetime.timezone.utc)
+
+    def now(self, tz=None) -> datetime.datetime:
+        if tz is None:
+            return self.current.replace(tzinfo=None)
+        return self.current.astimezone(tz)
+
+    def advance(self, seconds: float) -> datetime.datetime:
+        self.current += datetime.timedelta(seconds=seconds)
+        return self.current
+
+    def set(self, when: datetime.datetime):
+        self.current = when if when.tzinfo else when.replace(tzinfo=datetime.timezone.utc)
+
+    def install(self, *modules):
+        clock = self
+
+        class ClockDatetime(datetime.datetime):
+            @classmethod
+            def now(cls, tz=None):
+                return clock.now(tz)
+
+            @classmethod
+            def utcnow(cls):
+                return clock.now()
+
+        shim = types.ModuleType("datetime")
+        shim.__dict__.update({key: getattr(datetime, key) for key in dir(datetime) if not key.startswith("__")})
+        shim.datetime = ClockDatetime
+        for module in modules:
+            module.datetime = shim
+
+
+# --- module replacement ---
+
+FAKE_CONFIG = {
+    "token": "benchmark",
+    "guild_id": 1,
+    "prison_role": 2,
+    "leftwing_role": 3,
+    "rightwing_role": 4,
+    "unverified_role": 5,
+    "log_channels": {
+        "verification": [],
+        "case_updates": [],
+        "case_private": [],
+        "warrant_updates": [],
+        "audit_log": [],
+        "stasi_audit_log": [],
+        "audit_log_public": [],
+    },
+    "mongodb": {"url": "localhost", "username": "", "password": "", "name": "Stasi"},
+    "sudoers": [1],
+    "lazy_case_loading": False,
+    "openai": {"vettingmodel": "", "key": "benchmark", "tutor_prompt": "", "vetting_prompt": ""},
+}
+
+
+def _fake_config_module():
+    module = types.ModuleType("src.config")
+    module.C = copy.deepcopy(FAKE_CONFIG)
+    module.G = {}
+
+    def get_global(key):
+        if key in module.G:
+            return module.G[key]
+
+    def set_global(key, value):
+        module.G[key] = value
+
+    module.get_global = get_global
+    module.set_global = set_global
+    module.load_config = lambda: None
+    module.initialize_globals = lambda: None
+    return module
+
+
+def _fake_database_module():
+    module = types.ModuleType("src.database")
+    module.C = None
+
+    try:  # src.gridfs builds its bucket from database.client at import time, a lazy motor client never connects
+        import motor.motor_asyncio
+        module.client = motor.motor_asyncio.AsyncIOMotorClient("mongodb://127.0.0.1:1", connect=False)
+    except ImportError:
+        module.client = None
+
+    async def create_connection(table):
+        return DB[table]
+
+    async def get_global(name):
+        glob = await DB["globals"].find_one({"_id": name})
+        return glob["value"] if glob else None
+
+    async def set_global(name, value):
+        return await DB["globals"].update_one({"_id": name}, {"$set": {"value": value}}, upsert=True)
+
+    async def del_global(name):
+        return await DB["globals"].delete_one({"_id": name})
+
+    async def set_roles(member_id, roles):
+        return await DB["users"].update_one({"_id": member_id}, {"$set": {"roles": roles}}, upsert=True)
+
+    async def get_user(member_id):
+        return await DB["users"].find_one({"_id": member_id}) or {}
+
+    async def add_note(member_id, author_id, note):
+        note = {"_id": f"note-{len(DB['notes'].docs)}", "note": note, "timestamp": datetime.datetime.utcnow(), "author": author_id, "user": member_id}
+        await DB["notes"].insert_one(note)
+        return note
+
+    for fn in (create_connection, get_global, set_global, del_global, set_roles, get_user, add_note):
+        setattr(module, fn.__name__, fn)
+    return module
+
+
+def install(log_to_disk: bool = False):
+    os.chdir(ROOT)  # wordlists are opened relative to the working directory
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    import src
+    config = _fake_config_module()
+    database = _fake_database_module()
+    sys.modules["src.config"] = config
+    sys.modules["src.database"] = database
+    src.config = config
+    src.database = database
+
+    from src import gridfs
+    gridfs.fs = BUCKET
+
+    if not log_to_disk:  # benchmarks measure the bot, not the disk the logs would've gone to
+        from src import stasilogging
+        stasilogging.log = lambda *args, **kwargs: None
+        gridfs.log = stasilogging.log  # already star-imported the real one
+
+    return config
+
+
+def reset():
+    STATS.reset()
+    DB.reset()
+    BUCKET.files = {}
+    from src import autocomplete, gridfs
+    for index in autocomplete.INDEXES:
+        index.clear()
+    gridfs.MEMORY_CACHE.clear()
+    gridfs.CACHE_STATS.update({key: 0 for key in gridfs.CACHE_STATS})
+
+
+# --- reporting ---
+
+def percentiles(samples: List[float]) -> dict:
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean_ms": round(sum(ordered) / len(ordered) * 1000, 4),
+        "p50_ms": round(pct(50) * 1000, 4),
+        "p95_ms": round(pct(95) * 1000, 4),
+        "p99_ms": round(pct(99) * 1000, 4),
+        "max_ms": round(ordered[-1] * 1000, 4),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        import subprocess
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(old: dict, new: dict, threshold: float = 0.1) -> List[str]:
+    # flattens both result files down to {path: p50} and reports anything that moved more than threshold
+    def flatten(d, prefix=""):
+        out = {}
+        for key, value in d.items():
+            if isinstance(value, dict):
+                if "p50_ms" in value:
+                    out[f"{prefix}{key}"] = value["p50_ms"]
+                else:
+                    out.update(flatten(value, f"{prefix}{key}/"))
+        return out
+
+    old_flat, new_flat = flatten(old.get("results", {})), flatten(new.get("results", {}))
+    lines = []
+    for key in sorted(set(old_flat) & set(new_flat)):
+        before, after = old_flat[key], new_flat[key]
+        if before and abs(after - before) / before > threshold:
+            lines.append(f"{'REGRESSION' if after > before else 'improved  '} {key}: p50 {before}ms -> {after}ms ({round((after - before) / before * 100, 1)}%)")
+    return lines